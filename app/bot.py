@@ -1,43 +1,139 @@
-import requests
-from sqlmodel import Session
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import threading
+from typing import TYPE_CHECKING, Optional
+
+from cachetools import LRUCache
 from app.config import Settings, settings
-import tweepy
 
-from app.db import TwitterUser, get_create_post, get_on_youtube_post
+from app import metrics, ratelimit
+from app.db import TwitterUser
+from app.ratelimit import RateLimited
+
+if TYPE_CHECKING:
+    import tweepy
+
+logger = logging.getLogger(__name__)
+
+# tweepy.Client is synchronous, so tweets are sent from a bounded pool of threads
+# to keep the event loop free while Twitter responds.
+tweet_executor = ThreadPoolExecutor(
+    max_workers=settings.twitter_max_workers, thread_name_prefix="tweet"
+)
+
+# one client per user, its requests session keeps the connections to Twitter
+# open between tweets
+twitter_clients = LRUCache(maxsize=settings.twitter_clients_cache_size)
+twitter_clients_lock = threading.Lock()
 
 
-def get_twitter_client(config: Settings, user: TwitterUser) -> tweepy.Client:
+# tweepy and requests take a noticeable part of the boot time, they are only
+# imported once the first tweet is sent
+def get_twitter_client(config: Settings, user: TwitterUser) -> "tweepy.Client":
+    """Returns the user's client, replacing it when the credentials changed."""
+    with twitter_clients_lock:
+        api = twitter_clients.get(user.user)
+    if (
+        api
+        and api.access_token == user.access_token
+        and api.access_token_secret == user.access_token_secret
+    ):
+        return api
+
+    import requests
+    import tweepy
+
     api = tweepy.Client(
         consumer_key=config.twitter_api_key,
         consumer_secret=config.twitter_api_key_secret,
         access_token=user.access_token,
-        access_token_secret=user.access_token_secret
+        access_token_secret=user.access_token_secret,
+        # the raw response carries the rate limit headers
+        return_type=requests.Response,
     )
+    # every tweet thread may hold a connection of the same user
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.twitter_max_workers)
+    api.session.mount("https://", adapter)
+    with twitter_clients_lock:
+        old = twitter_clients.get(user.user)
+        twitter_clients[user.user] = api
+    if old:
+        old.session.close()
     return api
 
 
-async def process_youtube(session: Session, title: str, link: str, config: Settings, user: TwitterUser):
-    # Initialize Twitter client
+def close_twitter_clients() -> None:
+    with twitter_clients_lock:
+        clients = list(twitter_clients.values())
+        twitter_clients.clear()
+    for api in clients:
+        api.session.close()
+
+
+async def create_tweet(api: "tweepy.Client", text: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        tweet_executor, functools.partial(api.create_tweet, text=text)
+    )
+
+
+async def send_tweet(config: Settings, user: TwitterUser, text: str):
+    """Posts a tweet once the rate limits allow it.
+
+    Raises RateLimited if Twitter or the local limits say to come back later.
+    """
+    import requests
+    import tweepy
+
     api = get_twitter_client(config, user)
-    _, is_newly_created = get_create_post(session, link)
-    if not is_newly_created:
-        print("Tweet already posted.")
-        return
-    post_text = get_on_youtube_post(session, title, link, settings.default_user)
-    if not post_text:
-        print("No post text saved.")
-        return
-    try:
-        print(f"Posting youtube tweet...")
-        response = api.create_tweet(text=post_text)
+    await ratelimit.acquire(user.user)
+    with metrics.tweet_seconds.time(result="ok") as labels:
         try:
-            if isinstance(response, requests.models.Response):
-                print(f"{response.status_code}: {response.text}")
-            elif isinstance(response, tweepy.Response):
-                print(f"{response.data} {response.errors}")
-            else:
-                print(response)
+            logger.debug("Posting tweet", extra={"user": user.user})
+            response = await create_tweet(api, text)
+        except tweepy.TooManyRequests as e:
+            labels["result"] = "rate_limited"
+            ratelimit.update_from_headers(user.user, e.response.headers)
+            retry_in = ratelimit.wait_time(user.user)
+            logger.warning(
+                "Rate limited by Twitter",
+                extra={"user": user.user, "retry_in": round(retry_in)},
+            )
+            if retry_in > 0:
+                raise RateLimited(retry_in) from e
+            raise
         except Exception as e:
-            print(e)
-    except Exception as e:
-        print("Error in posting tweet:", e)
\ No newline at end of file
+            labels["result"] = "error"
+            logger.error(
+                "Error in posting tweet", extra={"user": user.user, "error": str(e)}
+            )
+            raise
+    if isinstance(response, requests.models.Response):
+        ratelimit.update_from_headers(user.user, response.headers)
+        logger.info(
+            "Posted tweet",
+            extra={
+                "user": user.user,
+                "status": response.status_code,
+                "response": response.text,
+            },
+        )
+    else:
+        logger.info(
+            "Posted tweet", extra={"user": user.user, "response": str(response)}
+        )
+    return response
+
+
+def tweet_id(response) -> Optional[str]:
+    """The id of the tweet a create_tweet response is for, if it tells."""
+    import requests
+
+    if not isinstance(response, requests.models.Response):
+        return None
+    try:
+        return str(response.json()["data"]["id"])
+    except (ValueError, KeyError, TypeError):
+        return None
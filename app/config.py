@@ -1,7 +1,12 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
     app_name: str = "HexAPI"
+    # DEBUG logs every request, WARNING only problems
+    log_level: str = "INFO"
+    log_json: bool = False
     base_url: str
     db_connection_string: str
     default_user: str
@@ -10,6 +15,111 @@ class Settings(BaseSettings):
     youtube_verify_token: str
     hub_topic: str
     secret_key: str
+    # connection pool of each engine (sync and async), ignored for SQLite
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout_seconds: float = 30
+    # connections older than this are replaced, -1 keeps them forever
+    db_pool_recycle_seconds: int = 1800
+    db_pool_pre_ping: bool = True
+    # compiled SQL kept by SQLAlchemy, and prepared statements per asyncpg
+    # connection (0 behind pgbouncer in transaction mode)
+    db_query_cache_size: int = 500
+    db_statement_cache_size: int = 100
+    # pragmas set on every SQLite connection. WAL lets the hook read while a
+    # worker writes, NORMAL only syncs at checkpoints in WAL mode.
+    sqlite_journal_mode: Literal[
+        "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"
+    ] = "WAL"
+    sqlite_synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    # how long a writer waits for the database lock before failing
+    sqlite_busy_timeout_ms: int = 5000
+    # threads used to send tweets without blocking the event loop
+    twitter_max_workers: int = 8
+    # client side rate limits, kept in sync with Twitter's rate limit headers
+    twitter_user_posts_per_window: int = 100
+    twitter_user_window_seconds: float = 900
+    twitter_app_posts_per_window: int = 10_000
+    twitter_app_window_seconds: float = 86400
+    # posts that would wait longer than this for the rate limit are requeued
+    twitter_max_wait_seconds: float = 10
+    # background workers draining the youtube outbox
+    outbox_workers: int = 4
+    outbox_batch_size: int = 10
+    outbox_poll_seconds: float = 5
+    # a worker that holds an item longer than this is assumed to have crashed
+    outbox_lock_seconds: int = 300
+    outbox_max_attempts: int = 5
+    outbox_retry_seconds: float = 30
+    # pooled http client used for hub requests and webhook sinks
+    hub_url: str = "https://pubsubhubbub.appspot.com/subscribe"
+    http_pool_size: int = 100
+    http_keepalive_seconds: float = 30
+    http_timeout_seconds: float = 30
+    # hub requests sent at the same time when renewing leases
+    hub_concurrency: int = 50
+    # the leader also polls every topic's feed, in case the hub missed a
+    # video or a lease lapsed. Unchanged feeds cost a 304. 0 disables it.
+    feed_poll_seconds: float = 900
+    feed_poll_concurrency: int = 20
+    feed_poll_per_host: int = 10
+    # leases are renewed this long before they expire, plus a random part of
+    # the jitter window
+    lease_renew_margin_seconds: float = 86400
+    lease_renew_jitter_seconds: float = 43200
+    # wait before retrying a renewal that failed or was never verified
+    lease_retry_seconds: float = 3600
+    # one process runs the lease renewals, holding a lease in the database
+    # that it renews every leader_renew_seconds. Another takes over once it
+    # has expired, so clocks must agree to well within leader_lease_seconds.
+    leader_lease_seconds: float = 30
+    leader_renew_seconds: float = 10
+    # how often the leader re-reads the leases, to pick up those verified by
+    # other processes
+    lease_check_seconds: float = 600
+    # posts sent at the same time across all outbox workers
+    post_concurrency: int = 16
+    # a webhook sink that doesn't answer in time is retried later, so it
+    # doesn't hold up the other sinks of its batch
+    sink_timeout_seconds: float = 10
+    # due scheduled posts claimed together
+    scheduled_posts_batch_size: int = 100
+    # items accepted by one call to the bulk post endpoints
+    bulk_posts_max_items: int = 1000
+    # claimed videos are kept this long for deduplication and history. Hub
+    # notifications older than app.feed.MAX_AGE are ignored anyway, so older
+    # rows are pruned by the leader in batches. 0 keeps them forever.
+    upload_retention_days: float = 90
+    upload_prune_seconds: float = 3600
+    upload_prune_batch_size: int = 10_000
+    # share of requests and scheduler jobs profiled, 0 turns profiling off.
+    # Profiles are served by GET /admin/profile to holders of profile_token.
+    profile_sample_rate: float = 0
+    profile_interval_ms: float = 5
+    profile_token: str = ""
+    # uploads returned by one page of GET /history
+    history_page_size: int = 50
+    history_max_page_size: int = 500
+    # limits for hub notifications, larger bodies are rejected unread
+    feed_max_bytes: int = 1_000_000
+    feed_max_entries: int = 50
+    # reject hub notifications without an X-Hub-Signature, once every
+    # subscription has been renewed with a hub.secret
+    hub_require_signature: bool = False
+    # digests of recent notifications, re-deliveries within the window are
+    # answered without being parsed again
+    delivery_cache_size: int = 10_000
+    delivery_cache_seconds: float = 3600
+    # recently posted links remembered in memory
+    posted_links_cache_size: int = 10_000
+    # parsed post texts kept in memory
+    post_templates_cache_size: int = 1000
+    post_templates_cache_seconds: float = 300
+    # users (with their credentials) kept in memory, and long-lived Twitter
+    # clients whose connections are reused between tweets
+    twitter_users_cache_size: int = 10_000
+    twitter_users_cache_seconds: float = 300
+    twitter_clients_cache_size: int = 1000
     
     model_config = SettingsConfigDict(env_file=".env")
 
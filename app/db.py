@@ -1,10 +1,50 @@
 import datetime
 from enum import StrEnum
-from typing import List, Optional, Tuple
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
 
-from sqlmodel import Field, SQLModel, Session, create_engine, select
+from sqlmodel import (
+    Field,
+    Index,
+    SQLModel,
+    Session,
+    and_,
+    case,
+    create_engine,
+    delete,
+    exists,
+    func,
+    insert,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy import (
+    DateTime,
+    Engine,
+    String,
+    event,
+    literal,
+    make_url,
+    text as sql_text,
+    tuple_,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from cachetools import LRUCache, TTLCache
 
 from app.config import settings
+from app.migrations import is_current, migrate
+from app.templates import (
+    ParsedTemplate,
+    TemplateError,
+    parse_template,
+    render_template,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class PostScheduleTime(StrEnum):
@@ -12,30 +52,234 @@ class PostScheduleTime(StrEnum):
     on_scheduled = "scheduled"
 
 
+class ScheduledPostStatus(StrEnum):
+    pending = "pending"
+    processing = "processing"
+    posted = "posted"
+    failed = "failed"
+
+
 class TwitterUser(SQLModel, table=True):
+    # covers the topic lookups and the per-topic lease scan
+    __table_args__ = (
+        Index("ix_twitteruser_hub_topic_lease_date", "hub_topic", "lease_date"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    user: str
+    user: str = Field(index=True)
     access_token: Optional[str]
     access_token_secret: Optional[str]
-    lease_date: Optional[datetime.datetime]
+    lease_date: Optional[datetime.datetime] = Field(index=True)
     hub_topic: Optional[str]
+    # when lease_date last changed, so the leader only re-reads changed leases
+    lease_updated_at: Optional[datetime.datetime] = Field(default=None, index=True)
 
 
 class PostText(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_posttext_user_post_trigger", "user", "post_trigger"),
+        # pending scheduled posts in due order
+        Index("ix_posttext_schedule", "post_trigger", "posted_at", "post_time"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     text: str
     user: str
     post_trigger: Optional[PostScheduleTime]
     # if post_trigger is on_scheduled
     post_time: Optional[datetime.datetime]
+    # set once a scheduled post has been sent
+    posted_at: Optional[datetime.datetime] = None
+    status: Optional[ScheduledPostStatus] = None
+    attempts: int = 0
+    # a processing post whose lock has expired belongs to a crashed process,
+    # a pending one isn't retried before it
+    locked_until: Optional[datetime.datetime] = None
+    last_error: Optional[str] = None
+
+
+class UploadStatus(StrEnum):
+    queued = "queued"
+    posted = "posted"
+    failed = "failed"
 
 
 class YoutubeUpload(SQLModel, table=True):
+    """A video claimed for a user, which keeps it from being posted twice."""
+
+    __table_args__ = (
+        Index("ix_youtubeupload_link_user", "link", "user", unique=True),
+        # history pages of one user
+        Index("ix_youtubeupload_user_id", "user", "id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    link: str
+    # None on rows stored by older releases, which were shared by every user
+    user: Optional[str] = None
+    # when the video was claimed, rows older than the retention are pruned
+    posted_at: Optional[datetime.datetime] = Field(default=None, index=True)
+    status: Optional[UploadStatus] = None
+    # of the tweet, once posted to the user's Twitter account
+    tweet_id: Optional[str] = None
+
+
+class OutboxStatus(StrEnum):
+    pending = "pending"
+    processing = "processing"
+    failed = "failed"
+
+
+class YoutubeOutbox(SQLModel, table=True):
+    """Videos received from the hub that are waiting to be posted."""
+
+    __table_args__ = (
+        Index("ix_youtubeoutbox_status_available_at", "status", "available_at"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
+    title: str
     link: str
+    user: str
+    status: OutboxStatus = OutboxStatus.pending
+    attempts: int = 0
+    # when a pending item may next be picked up
+    available_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+    # a processing item whose lock has expired belongs to a crashed worker
+    locked_until: Optional[datetime.datetime] = None
+    last_error: Optional[str] = None
+    # the Sink to publish to, None for the user's Twitter account
+    sink_id: Optional[int] = None
+
+
+class SinkKind(StrEnum):
+    twitter = "twitter"
+    discord = "discord"
+
+
+class PublishResult(SQLModel, table=True):
+    """The outcome of publishing a video to one of a user's sinks."""
+
+    __table_args__ = (Index("ix_publishresult_link_user", "link", "user"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    link: str
+    user: str
+    # None for the user's Twitter account
+    sink_id: Optional[int] = None
+    status: UploadStatus
+    tweet_id: Optional[str] = None
+    error: Optional[str] = None
+    finished_at: datetime.datetime = Field(
+        default_factory=datetime.datetime.now, index=True
+    )
+
+
+class Sink(SQLModel, table=True):
+    """A place a user's new videos are published to.
+
+    Every user publishes to their Twitter account as well, unless they have a
+    disabled Twitter sink.
+    """
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user: str = Field(index=True)
+    kind: SinkKind
+    # the webhook of a Discord sink
+    url: Optional[str] = None
+    enabled: bool = True
+
+
+class LeaderLease(SQLModel, table=True):
+    """The process that runs a background job, until its lease expires."""
+
+    name: str = Field(primary_key=True)
+    holder: str
+    expires_at: datetime.datetime
 
 
-engine = create_engine(settings.db_connection_string, pool_pre_ping=True)
+def async_connection_string(connection_string: str) -> str:
+    """The same database, reached through its asyncio driver."""
+    url = make_url(connection_string)
+    if url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    elif url.get_backend_name() == "postgresql":
+        url = url.set(drivername="postgresql+asyncpg")
+    return url.render_as_string(hide_password=False)
+
+
+def engine_options(connection_string: str, is_async: bool = False) -> dict:
+    """Engine arguments for the pool and statement cache settings."""
+    options = {
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "query_cache_size": settings.db_query_cache_size,
+    }
+    backend = make_url(connection_string).get_backend_name()
+    if backend == "sqlite":
+        # one file, the pool size doesn't change how many can write
+        return options
+    options.update(
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout_seconds,
+        pool_recycle=settings.db_pool_recycle_seconds,
+    )
+    if is_async and backend == "postgresql":
+        options["connect_args"] = {
+            "statement_cache_size": settings.db_statement_cache_size
+        }
+    return options
+
+
+def set_sqlite_pragmas(engine: Engine) -> None:
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout_ms)}")
+        cursor.close()
+
+
+# the sync engine is kept for startup work (create_all, migrations) and scripts
+engine = create_engine(
+    settings.db_connection_string, **engine_options(settings.db_connection_string)
+)
+async_engine = create_async_engine(
+    async_connection_string(settings.db_connection_string),
+    **engine_options(settings.db_connection_string, is_async=True),
+)
+set_sqlite_pragmas(engine)
+set_sqlite_pragmas(async_engine.sync_engine)
+# objects stay usable after a commit, reloading them would need another await
+async_session = async_sessionmaker(
+    async_engine, class_=AsyncSession, expire_on_commit=False
+)
+
+# links known to be in YoutubeUpload, so hub re-deliveries skip the database
+posted_links = LRUCache(maxsize=settings.posted_links_cache_size)
+posted_links_lock = threading.Lock()
+
+# parsed post texts by (user, post_trigger), replaced whenever a text is saved
+# here and expired so edits made by other processes are picked up
+post_templates = TTLCache(
+    maxsize=settings.post_templates_cache_size,
+    ttl=settings.post_templates_cache_seconds,
+)
+post_templates_lock = threading.Lock()
+# tells a cache miss from a user known to have no post text (None)
+_MISSING = object()
+
+# detached copies of users by name, dropped when the user is updated here and
+# expired so updates made by other processes are picked up
+twitter_users = TTLCache(
+    maxsize=settings.twitter_users_cache_size,
+    ttl=settings.twitter_users_cache_seconds,
+)
+twitter_users_lock = threading.Lock()
 
 
 def get_session():
@@ -43,28 +287,35 @@ def get_session():
         yield session
 
 
+async def get_async_session():
+    async with async_session() as session:
+        yield session
+
+
 def init_db() -> None:
-    print("Creating tables")
-    SQLModel.metadata.create_all(engine)
+    # on a restart the schema is up to date, only check the version
+    if not is_current(engine):
+        logger.info("Creating tables")
+        SQLModel.metadata.create_all(engine)
+        migrate(engine)
     with Session(engine) as session:
-        user = session.exec(
-            select(TwitterUser).where(TwitterUser.user == settings.default_user)
-        ).first()
-        if not user:
-            print("Creating default user")
+        # both seed checks in one round trip
+        has_user, has_post = session.exec(
+            select(
+                exists().where(TwitterUser.user == settings.default_user),
+                exists().where(
+                    PostText.user == settings.default_user,
+                    PostText.post_trigger == PostScheduleTime.on_new_video,
+                ),
+            )
+        ).one()
+        if not has_user:
+            logger.info("Creating default user")
             session.add(
                 TwitterUser(user=settings.default_user, hub_topic=settings.hub_topic)
             )
-            session.commit()
-
-        default_post = session.exec(
-            select(PostText).where(
-                PostText.user == settings.default_user
-                and PostText.post_trigger == PostScheduleTime.on_new_video
-            )
-        ).first()
-        if not default_post:
-            print("Creating default post")
+        if not has_post:
+            logger.info("Creating default post")
             session.add(
                 PostText(
                     text="🚨 New Video 🚨\n\nCheck out my latest video over on YouTube and whilst you're there, don't forget to like, comment and subscribe!\n\nHex 👋\n\n{link}\n#mtgmkm #mtgkarlovmanor #karlovmanor #mtg #mtgarena",
@@ -72,13 +323,14 @@ def init_db() -> None:
                     post_trigger=PostScheduleTime.on_new_video,
                 )
             )
+        if not (has_user and has_post):
             session.commit()
 
 
 def create_update_user(
     session: Session, user_name: str, access_token: str, access_token_secret: str
 ) -> None:
-    print(f"Updating user {user_name}")
+    logger.info("Updating user", extra={"user": user_name})
     user = session.exec(
         select(TwitterUser).where(TwitterUser.user == user_name)
     ).first()
@@ -94,22 +346,63 @@ def create_update_user(
         user.access_token = access_token
         user.access_token_secret = access_token_secret
     session.commit()
-    print(f"User {user_name} updated")
+    with twitter_users_lock:
+        twitter_users.pop(user_name, None)
+    logger.info("User updated", extra={"user": user_name})
 
 
 def get_user(session: Session, user_name: str) -> Optional[TwitterUser]:
+    """Returns the user, only querying on a cache miss. The user is a copy
+    that isn't attached to any session, so it must not be changed."""
+    with twitter_users_lock:
+        user = twitter_users.get(user_name)
+    if user:
+        return user
     user = session.exec(
         select(TwitterUser).where(TwitterUser.user == user_name)
     ).first()
+    if not user:
+        return None
+    user = TwitterUser(**user.model_dump())
+    with twitter_users_lock:
+        twitter_users[user_name] = user
     return user
 
 
+def get_users(session: Session, user_names: List[str]) -> Dict[str, TwitterUser]:
+    """get_user for many users, with one query for the cache misses. Users that
+    don't exist are left out."""
+    users = {}
+    with twitter_users_lock:
+        for user_name in user_names:
+            user = twitter_users.get(user_name)
+            if user:
+                users[user_name] = user
+    missing = [user_name for user_name in user_names if user_name not in users]
+    if not missing:
+        return users
+    found = {}
+    for user in session.exec(
+        select(TwitterUser)
+        .where(TwitterUser.user.in_(missing))
+        .order_by(TwitterUser.id.desc())
+    ):
+        # the same row get_user's .first() would pick
+        found[user.user] = TwitterUser(**user.model_dump())
+    with twitter_users_lock:
+        twitter_users.update(found)
+    users.update(found)
+    return users
+
+
 def create_update_on_youtube_post(session: Session, text: str, user_name: str):
-    print(f"Updating user {user_name}")
+    # fail here rather than when the video is posted
+    template = parse_template(text)
+    logger.info("Updating user", extra={"user": user_name})
     post = session.exec(
         select(PostText).where(
-            PostText.user == user_name
-            and PostText.post_trigger == PostScheduleTime.on_new_video
+            PostText.user == user_name,
+            PostText.post_trigger == PostScheduleTime.on_new_video,
         )
     ).first()
     if not post:
@@ -124,41 +417,326 @@ def create_update_on_youtube_post(session: Session, text: str, user_name: str):
     else:
         post.text = text
     session.commit()
-    print(f"User {user_name} updated")
+    with post_templates_lock:
+        post_templates[(user_name, PostScheduleTime.on_new_video)] = template
+    logger.info("User updated", extra={"user": user_name})
     return session.exec(
         select(PostText).where(
-            PostText.user == user_name
-            and PostText.post_trigger == PostScheduleTime.on_new_video
+            PostText.user == user_name,
+            PostText.post_trigger == PostScheduleTime.on_new_video,
         )
     ).first()
 
 
-def get_on_youtube_post(
-    session: Session, title: str, link: str, user_name: str
-) -> Optional[str]:
+def get_post_template(
+    session: Session, user_name: str, post_trigger: PostScheduleTime
+) -> Optional[ParsedTemplate]:
+    """Returns the user's parsed post text, only querying on a cache miss."""
+    key = (user_name, post_trigger)
+    with post_templates_lock:
+        # one lookup, the entry may expire between a check and a read
+        template = post_templates.get(key, _MISSING)
+    if template is not _MISSING:
+        return template
     post = session.exec(
         select(PostText).where(
             PostText.user == user_name,
-            PostText.post_trigger == PostScheduleTime.on_new_video,
+            PostText.post_trigger == post_trigger,
         )
     ).first()
-    if not post:
+    template = parse_template(post.text) if post else None
+    with post_templates_lock:
+        post_templates[key] = template
+    return template
+
+
+def get_on_youtube_post(
+    session: Session, title: str, link: str, user_name: str
+) -> Optional[str]:
+    template = get_post_template(session, user_name, PostScheduleTime.on_new_video)
+    if not template:
         return None
-    return post.text.format(title=title, link=link)
+    return render_template(template, title=title, link=link)
 
 
-def get_create_post(session: Session, link: str) -> Tuple[YoutubeUpload, bool]:
+def get_post_templates(
+    session: Session, user_names: List[str], post_trigger: PostScheduleTime
+) -> Dict[str, Optional[ParsedTemplate]]:
+    """get_post_template for many users, with one query for the cache misses."""
+    templates = {}
+    with post_templates_lock:
+        for user_name in user_names:
+            template = post_templates.get((user_name, post_trigger), _MISSING)
+            if template is not _MISSING:
+                templates[user_name] = template
+    missing = [user_name for user_name in user_names if user_name not in templates]
+    if not missing:
+        return templates
+    for user_name in missing:
+        templates[user_name] = None
+    texts = {}
+    for user_name, text in session.exec(
+        select(PostText.user, PostText.text)
+        .where(PostText.user.in_(missing), PostText.post_trigger == post_trigger)
+        .order_by(PostText.id.desc())
+    ):
+        # the same row get_post_template's .first() would pick
+        texts[user_name] = text
+    for user_name in missing:
+        if user_name in texts:
+            templates[user_name] = parse_template(texts[user_name])
+    with post_templates_lock:
+        for user_name in missing:
+            post_templates[(user_name, post_trigger)] = templates[user_name]
+    return templates
 
-    post = session.exec(select(YoutubeUpload).where(YoutubeUpload.link == link)).first()
-    is_not_found = post is None
 
-    if is_not_found:
-        session.add(YoutubeUpload(link=link))
-        session.commit()
-        post = session.exec(
-            select(YoutubeUpload).where(YoutubeUpload.link == link)
-        ).first()
-    return post, is_not_found
+def render_posts(
+    session: Session, title: str, link: str, user_names: List[str]
+) -> Dict[str, Optional[str]]:
+    """get_on_youtube_post for many users."""
+    templates = get_post_templates(session, user_names, PostScheduleTime.on_new_video)
+    return {
+        user_name: (
+            render_template(template, title=title, link=link) if template else None
+        )
+        for user_name, template in templates.items()
+    }
+
+
+def upsert_posts(
+    session: Session,
+    items: List[Tuple[str, str, PostScheduleTime, Optional[datetime.datetime]]],
+) -> List[Tuple[Optional[PostText], Optional[str]]]:
+    """Sets the new video post text or adds a scheduled post for each
+    (text, user_name, post_trigger, post_time), all in one transaction.
+
+    Returns (post, None) for each item, or (None, error) for a post text that
+    is not a valid template, which is skipped.
+    """
+    users = {
+        user_name
+        for _, user_name, post_trigger, _ in items
+        if post_trigger == PostScheduleTime.on_new_video
+    }
+    existing = {}
+    if users:
+        for post in session.exec(
+            select(PostText)
+            .where(
+                PostText.user.in_(users),
+                PostText.post_trigger == PostScheduleTime.on_new_video,
+            )
+            .order_by(PostText.id.desc())
+        ):
+            existing[post.user] = post
+    templates = {}
+    results = []
+    for text, user_name, post_trigger, post_time in items:
+        if post_trigger == PostScheduleTime.on_scheduled:
+            post = scheduled_post(text, user_name, post_time)
+            session.add(post)
+            results.append((post, None))
+            continue
+        try:
+            templates[(user_name, post_trigger)] = parse_template(text)
+        except TemplateError as e:
+            results.append((None, str(e)))
+            continue
+        post = existing.get(user_name)
+        if post:
+            post.text = text
+        else:
+            post = existing[user_name] = PostText(
+                text=text, user=user_name, post_trigger=post_trigger, post_time=None
+            )
+            session.add(post)
+        results.append((post, None))
+    session.commit()
+    with post_templates_lock:
+        post_templates.update(templates)
+    logger.info("Updated posts", extra={"count": len(items)})
+    return results
+
+
+def scheduled_post(text: str, user_name: str, post_time: datetime.datetime) -> PostText:
+    """A new scheduled post, waiting to be claimed."""
+    return PostText(
+        text=text,
+        user=user_name,
+        post_trigger=PostScheduleTime.on_scheduled,
+        post_time=post_time,
+        status=ScheduledPostStatus.pending,
+    )
+
+
+def create_scheduled_post(
+    session: Session, text: str, user_name: str, post_time: datetime.datetime
+) -> PostText:
+    post = scheduled_post(text, user_name, post_time)
+    session.add(post)
+    session.commit()
+    session.refresh(post)
+    return post
+
+
+def _unsent_scheduled_posts():
+    return and_(
+        PostText.post_trigger == PostScheduleTime.on_scheduled,
+        PostText.posted_at.is_(None),
+        PostText.status.in_(
+            [ScheduledPostStatus.pending, ScheduledPostStatus.processing]
+        ),
+    )
+
+
+def get_pending_scheduled_posts(
+    session: Session, post_ids: Optional[List[int]] = None
+) -> List[Tuple[datetime.datetime, int]]:
+    """(time, id) of every scheduled post, or of the given ones, that has not
+    been sent or given up on. The time is when the post may next be claimed:
+    its post time, or the end of its lock."""
+    due_at = func.coalesce(PostText.locked_until, PostText.post_time)
+    statement = select(due_at, PostText.id).where(
+        _unsent_scheduled_posts(), PostText.post_time.is_not(None)
+    )
+    if post_ids is not None:
+        statement = statement.where(PostText.id.in_(post_ids))
+    return session.exec(statement.order_by(due_at)).all()
+
+
+def claim_scheduled_posts(
+    session: Session, post_ids: List[int], lock_seconds: int
+) -> List[PostText]:
+    """Locks the scheduled posts for the caller and returns the ones this call
+    claimed, so each post is sent once even if several processes dispatch it.
+
+    A post is marked posted only once it has been sent (`complete_scheduled_post`),
+    so the post of a process that crashed mid-send is claimable again when its
+    lock expires.
+    """
+    now = datetime.datetime.now()
+    claimed = session.scalars(
+        update(PostText)
+        .where(
+            PostText.id.in_(post_ids),
+            _unsent_scheduled_posts(),
+            or_(PostText.locked_until.is_(None), PostText.locked_until <= now),
+        )
+        .values(
+            status=ScheduledPostStatus.processing,
+            locked_until=now + datetime.timedelta(seconds=lock_seconds),
+            attempts=PostText.attempts + 1,
+        )
+        .returning(PostText)
+    ).all()
+    session.commit()
+    return sorted(claimed, key=lambda post: post.id)
+
+
+def complete_scheduled_post(session: Session, post_id: int) -> None:
+    session.execute(
+        update(PostText)
+        .where(PostText.id == post_id)
+        .values(
+            status=ScheduledPostStatus.posted,
+            posted_at=datetime.datetime.now(),
+            locked_until=None,
+            last_error=None,
+        )
+    )
+    session.commit()
+
+
+def retry_scheduled_post(
+    session: Session,
+    post_id: int,
+    error: str,
+    retry_in: Optional[float],
+    count_attempt: bool = True,
+) -> None:
+    """Puts a claimed scheduled post back until `retry_in` seconds from now, or
+    marks it failed if `retry_in` is None.
+
+    With `count_attempt` False the attempt doesn't count towards the maximum.
+    """
+    values = {"last_error": error, "locked_until": None}
+    if not count_attempt:
+        values["attempts"] = PostText.attempts - 1
+    if retry_in is None:
+        values["status"] = ScheduledPostStatus.failed
+    else:
+        values["status"] = ScheduledPostStatus.pending
+        values["locked_until"] = datetime.datetime.now() + datetime.timedelta(
+            seconds=retry_in
+        )
+    session.execute(update(PostText).where(PostText.id == post_id).values(**values))
+    session.commit()
+
+
+def _insert(session: Session):
+    """The insert construct of the session's dialect, for on_conflict_do_nothing."""
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+def claim_posts(
+    session: Session, links: List[str], user_names: List[str]
+) -> List[Tuple[str, str]]:
+    """Records links as posted for the users, whatever their number, in two
+    statements: an IN query for the links already posted, then an
+    insert-or-ignore of a row per new link and user. The insert still ignores
+    links claimed concurrently, and skipping the known ones first saves
+    Postgres a sequence value per conflicting row.
+
+    Returns the (link, user) pairs this call claimed, in order. The caller
+    commits.
+    """
+    links = list(dict.fromkeys(links))
+    user_names = list(dict.fromkeys(user_names))
+    if not links or not user_names:
+        return []
+    posted = set(
+        session.exec(
+            select(YoutubeUpload.link).where(YoutubeUpload.link.in_(links))
+        ).all()
+    )
+    new = [link for link in links if link not in posted]
+    if not new:
+        return []
+    now = datetime.datetime.now()
+    claimed = set(
+        session.execute(
+            _insert(session)(YoutubeUpload)
+            .values(
+                [
+                    {
+                        "link": link,
+                        "user": user_name,
+                        "posted_at": now,
+                        "status": UploadStatus.queued,
+                    }
+                    for link in new
+                    for user_name in user_names
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["link", "user"])
+            .returning(YoutubeUpload.link, YoutubeUpload.user)
+        ).all()
+    )
+    return [
+        (link, user_name)
+        for link in new
+        for user_name in user_names
+        if (link, user_name) in claimed
+    ]
+
+
+def remember_posted(links: List[str]) -> None:
+    with posted_links_lock:
+        for link in links:
+            posted_links[link] = True
 
 
 def update_lease(session: Session, user_name: str, lease_seconds: int, hub_topic: str):
@@ -166,20 +744,643 @@ def update_lease(session: Session, user_name: str, lease_seconds: int, hub_topic
         select(TwitterUser).where(TwitterUser.user == user_name)
     ).first()
     if user:
-        user.lease_date = datetime.datetime.now() + datetime.timedelta(
-            seconds=lease_seconds
-        )
+        now = datetime.datetime.now()
+        user.lease_date = now + datetime.timedelta(seconds=lease_seconds)
+        user.lease_updated_at = now
         user.hub_topic = hub_topic
         session.commit()
+        with twitter_users_lock:
+            twitter_users.pop(user_name, None)
     else:
-        print(f"User {user_name} not found")
+        logger.warning("User not found", extra={"user": user_name})
+
+
+def update_topic_lease(
+    session: Session, hub_topic: str, lease_seconds: int
+) -> datetime.datetime:
+    """Updates the lease of every user subscribed to the topic and returns the
+    new expiry.
+
+    Topics nobody is subscribed to belong to the default user.
+    """
+    now = datetime.datetime.now()
+    lease_date = now + datetime.timedelta(seconds=lease_seconds)
+    result = session.execute(
+        update(TwitterUser)
+        .where(TwitterUser.hub_topic == hub_topic)
+        .values(lease_date=lease_date, lease_updated_at=now)
+    )
+    session.commit()
+    if not result.rowcount:
+        update_lease(session, settings.default_user, lease_seconds, hub_topic)
+    return lease_date
+
+
+def count_expiring_leases(
+    session: Session, windows: Dict[str, datetime.timedelta]
+) -> Dict[str, int]:
+    """Number of users whose lease expires within each window, in one query."""
+    now = datetime.datetime.now()
+    row = session.exec(
+        select(
+            *(
+                func.count(case((TwitterUser.lease_date < now + window, 1)))
+                for window in windows.values()
+            )
+        ).where(TwitterUser.lease_date.is_not(None))
+    ).one()
+    return dict(zip(windows, row))
 
 
-def get_users_to_resub(session: Session) -> List[TwitterUser]:
+def get_topic_users(session: Session, topics: List[str]) -> List[str]:
+    """Names of the users subscribed to any of the topics.
+
+    Topics nobody is subscribed to belong to the default user.
+    """
     users = session.exec(
-        select(TwitterUser).where(
-            TwitterUser.lease_date
-            < datetime.datetime.now() + datetime.timedelta(days=2)
+        select(TwitterUser.user).where(TwitterUser.hub_topic.in_(topics)).distinct()
+    ).all()
+    return list(users) or [settings.default_user]
+
+
+def get_topics(session: Session) -> List[str]:
+    """Every topic a user is subscribed to."""
+    return session.exec(
+        select(TwitterUser.hub_topic)
+        .where(TwitterUser.hub_topic.is_not(None))
+        .distinct()
+    ).all()
+
+
+def get_topic_leases(
+    session: Session, since: Optional[datetime.datetime] = None
+) -> List[Tuple[str, datetime.datetime]]:
+    """The earliest lease expiry of every subscribed topic, or with `since` of
+    the topics with a lease updated since then. Those are found through the
+    index on lease_updated_at, instead of scanning every user."""
+    statement = (
+        select(TwitterUser.hub_topic, func.min(TwitterUser.lease_date))
+        .where(TwitterUser.hub_topic.is_not(None), TwitterUser.lease_date.is_not(None))
+        .group_by(TwitterUser.hub_topic)
+    )
+    if since is not None:
+        statement = statement.where(
+            TwitterUser.hub_topic.in_(
+                select(TwitterUser.hub_topic).where(
+                    TwitterUser.lease_updated_at >= since
+                )
+            )
+        )
+    return session.exec(statement).all()
+
+
+def acquire_leadership(
+    session: Session, name: str, holder: str, lease_seconds: float
+) -> bool:
+    """Takes or extends the named lease, unless another holder's lease has not
+    expired yet. Returns whether `holder` holds it now."""
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=lease_seconds)
+    result = session.execute(
+        update(LeaderLease)
+        .where(
+            LeaderLease.name == name,
+            or_(LeaderLease.holder == holder, LeaderLease.expires_at < now),
         )
+        .values(holder=holder, expires_at=expires_at)
+    )
+    if result.rowcount == 0:
+        # first election, or the row belongs to a live holder
+        result = session.execute(
+            _insert(session)(LeaderLease)
+            .values(name=name, holder=holder, expires_at=expires_at)
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+    session.commit()
+    return result.rowcount == 1
+
+
+def release_leadership(session: Session, name: str, holder: str) -> None:
+    """Expires the lease now, so another process takes over without waiting."""
+    session.execute(
+        update(LeaderLease)
+        .where(LeaderLease.name == name, LeaderLease.holder == holder)
+        .values(expires_at=datetime.datetime.now())
+    )
+    session.commit()
+
+
+def create_sink(
+    session: Session,
+    user_name: str,
+    kind: SinkKind,
+    url: Optional[str] = None,
+    enabled: bool = True,
+) -> Sink:
+    sink = Sink(user=user_name, kind=kind, url=url, enabled=enabled)
+    session.add(sink)
+    session.commit()
+    session.refresh(sink)
+    return sink
+
+
+def delete_sink(session: Session, sink_id: int) -> bool:
+    result = session.execute(delete(Sink).where(Sink.id == sink_id))
+    session.commit()
+    return result.rowcount > 0
+
+
+def get_user_sinks(session: Session, user_name: str) -> List[Sink]:
+    return session.exec(select(Sink).where(Sink.user == user_name)).all()
+
+
+def get_sinks(session: Session, user_names: List[str]) -> Dict[str, List[Sink]]:
+    """The sinks of each of the users, disabled ones included, with one query."""
+    sinks: Dict[str, List[Sink]] = {}
+    for sink in session.exec(
+        select(Sink).where(Sink.user.in_(user_names)).order_by(Sink.id)
+    ):
+        sinks.setdefault(sink.user, []).append(sink)
+    return sinks
+
+
+def sink_targets(sinks: List[Sink]) -> List[Optional[int]]:
+    """The sink ids a user's videos are queued for, None being their Twitter
+    account. It is kept when other sinks are added, a disabled Twitter sink
+    turns it off."""
+    targets = [sink.id for sink in sinks if sink.enabled]
+    if not any(sink.kind == SinkKind.twitter for sink in sinks):
+        targets.insert(0, None)
+    return targets
+
+
+def get_sinks_by_id(session: Session, sink_ids: List[int]) -> Dict[int, Sink]:
+    return {
+        sink.id: sink
+        for sink in session.exec(select(Sink).where(Sink.id.in_(sink_ids)))
+    }
+
+
+def enqueue_youtube_posts(
+    session: Session, topics: List[str], entries: List[Tuple[str, str]]
+) -> int:
+    """Queues the (title, link) entries that were not posted yet for every user
+    subscribed to one of the topics.
+
+    Links are claimed and queued in the same transaction, so a video is queued
+    once no matter how many times the hub delivers it. However many entries
+    there are, this takes a fixed number of statements.
+    """
+    with posted_links_lock:
+        entries = [(title, link) for title, link in entries if link not in posted_links]
+    if not entries:
+        return 0
+    user_names = get_topic_users(session, topics)
+    sinks = get_sinks(session, user_names)
+    claimed = claim_posts(session, [link for _, link in entries], user_names)
+    titles = {link: title for title, link in entries}
+    now = datetime.datetime.now()
+    # one item per sink, so every sink is retried and completed on its own
+    rows = [
+        {
+            "title": titles[link],
+            "link": link,
+            "user": user_name,
+            "sink_id": sink_id,
+            "status": OutboxStatus.pending,
+            "attempts": 0,
+            "available_at": now,
+        }
+        for link, user_name in claimed
+        for sink_id in sink_targets(sinks.get(user_name, []))
+    ]
+    if rows:
+        session.execute(insert(YoutubeOutbox), rows)
+    session.commit()
+    remember_posted([link for _, link in entries])
+    return len(rows)
+
+
+def count_outbox(session: Session) -> Dict[str, int]:
+    """Number of outbox items by status."""
+    return dict(
+        session.exec(
+            select(YoutubeOutbox.status, func.count()).group_by(YoutubeOutbox.status)
+        ).all()
+    )
+
+
+def _claimable_outbox(now: datetime.datetime):
+    return or_(
+        and_(
+            YoutubeOutbox.status == OutboxStatus.pending,
+            YoutubeOutbox.available_at <= now,
+        ),
+        and_(
+            YoutubeOutbox.status == OutboxStatus.processing,
+            YoutubeOutbox.locked_until < now,
+        ),
+    )
+
+
+def claim_outbox(
+    session: Session, limit: int, lock_seconds: int
+) -> List[YoutubeOutbox]:
+    """Locks up to `limit` due outbox items for the calling worker.
+
+    Each row is claimed with a conditional UPDATE so concurrent workers, in this
+    process or another one, never pick up the same item.
+    """
+    now = datetime.datetime.now()
+    ids = session.exec(
+        select(YoutubeOutbox.id)
+        .where(_claimable_outbox(now))
+        .order_by(YoutubeOutbox.id)
+        .limit(limit)
     ).all()
-    return users
+    if not ids:
+        return []
+    # rows another worker claimed since the select no longer match
+    claimed = session.scalars(
+        update(YoutubeOutbox)
+        .where(YoutubeOutbox.id.in_(ids), _claimable_outbox(now))
+        .values(
+            status=OutboxStatus.processing,
+            locked_until=now + datetime.timedelta(seconds=lock_seconds),
+            attempts=YoutubeOutbox.attempts + 1,
+        )
+        .returning(YoutubeOutbox)
+    ).all()
+    session.commit()
+    return sorted(claimed, key=lambda item: item.id)
+
+
+def record_outcome(
+    session: Session,
+    outbox_id: int,
+    status: UploadStatus,
+    tweet_id: Optional[str] = None,
+    error: Optional[str] = None,
+) -> None:
+    """Records the outcome of an outbox item: a PublishResult for its sink, and
+    a summary on the user's upload row, where a failed sink doesn't hide that
+    another one posted. The caller commits."""
+    session.execute(
+        insert(PublishResult).from_select(
+            [
+                "link",
+                "user",
+                "sink_id",
+                "status",
+                "tweet_id",
+                "error",
+                "finished_at",
+            ],
+            select(
+                YoutubeOutbox.link,
+                YoutubeOutbox.user,
+                YoutubeOutbox.sink_id,
+                literal(status, PublishResult.__table__.c.status.type),
+                literal(tweet_id, String),
+                literal(error, String),
+                literal(datetime.datetime.now(), DateTime),
+            ).where(YoutubeOutbox.id == outbox_id),
+        )
+    )
+    item = select(YoutubeOutbox.link, YoutubeOutbox.user).where(
+        YoutubeOutbox.id == outbox_id
+    )
+    values = {"status": status}
+    if tweet_id is not None:
+        values["tweet_id"] = tweet_id
+    statement = update(YoutubeUpload).where(
+        tuple_(YoutubeUpload.link, YoutubeUpload.user).in_(item)
+    )
+    if status == UploadStatus.failed:
+        statement = statement.where(
+            or_(
+                YoutubeUpload.status.is_(None),
+                YoutubeUpload.status != UploadStatus.posted,
+            )
+        )
+    session.execute(statement.values(**values))
+
+
+def complete_outbox(
+    session: Session, outbox_id: int, tweet_id: Optional[str] = None
+) -> None:
+    record_outcome(session, outbox_id, UploadStatus.posted, tweet_id)
+    session.execute(delete(YoutubeOutbox).where(YoutubeOutbox.id == outbox_id))
+    session.commit()
+
+
+def retry_outbox(
+    session: Session,
+    outbox_id: int,
+    error: str,
+    retry_in: Optional[float],
+    count_attempt: bool = True,
+) -> None:
+    """Puts an item back in the queue, or marks it failed if `retry_in` is None.
+
+    With `count_attempt` False the attempt doesn't count towards the maximum.
+    """
+    values = {"last_error": error, "locked_until": None}
+    if not count_attempt:
+        values["attempts"] = YoutubeOutbox.attempts - 1
+    if retry_in is None:
+        values["status"] = OutboxStatus.failed
+        record_outcome(session, outbox_id, UploadStatus.failed, error=error)
+    else:
+        values["status"] = OutboxStatus.pending
+        values["available_at"] = datetime.datetime.now() + datetime.timedelta(
+            seconds=retry_in
+        )
+    session.execute(
+        update(YoutubeOutbox).where(YoutubeOutbox.id == outbox_id).values(**values)
+    )
+    session.commit()
+
+
+def get_upload_history(
+    session: Session,
+    limit: int,
+    user_name: Optional[str] = None,
+    before: Optional[int] = None,
+) -> List[YoutubeUpload]:
+    """A page of uploads, newest first, starting below the `before` id.
+
+    Seeks on the primary key (or the user's index) instead of an offset, so a
+    page costs the same however deep it is.
+    """
+    statement = select(YoutubeUpload)
+    if user_name is not None:
+        statement = statement.where(YoutubeUpload.user == user_name)
+    if before is not None:
+        statement = statement.where(YoutubeUpload.id < before)
+    return session.exec(statement.order_by(YoutubeUpload.id.desc()).limit(limit)).all()
+
+
+def _prune(session: Session, column, before: datetime.datetime, limit: int) -> int:
+    table = column.class_
+    ids = select(table.id).where(column < before).order_by(column).limit(limit)
+    result = session.execute(delete(table).where(table.id.in_(ids.scalar_subquery())))
+    session.commit()
+    return result.rowcount
+
+
+def prune_uploads(session: Session, before: datetime.datetime, batch_size: int) -> int:
+    """Deletes up to `batch_size` uploads claimed before `before`, oldest first,
+    and returns how many. Small batches keep each transaction short."""
+    return _prune(session, YoutubeUpload.posted_at, before, batch_size)
+
+
+def prune_publish_results(
+    session: Session, before: datetime.datetime, batch_size: int
+) -> int:
+    """prune_uploads for the publish results."""
+    return _prune(session, PublishResult.finished_at, before, batch_size)
+
+
+def get_publish_results(
+    session: Session, uploads: List[YoutubeUpload]
+) -> Dict[Tuple[str, str], List[PublishResult]]:
+    """The results of each upload's sinks, by (link, user), with one query."""
+    keys = [(upload.link, upload.user) for upload in uploads if upload.user]
+    results: Dict[Tuple[str, str], List[PublishResult]] = {}
+    if not keys:
+        return results
+    for result in session.exec(
+        select(PublishResult)
+        .where(tuple_(PublishResult.link, PublishResult.user).in_(keys))
+        .order_by(PublishResult.id)
+    ):
+        results.setdefault((result.link, result.user), []).append(result)
+    return results
+
+
+def compact_uploads(session: Session) -> None:
+    """Refreshes the planner statistics of the uploads table after a prune, so
+    the dedup lookups keep using its indexes."""
+    session.execute(sql_text(f"ANALYZE {YoutubeUpload.__tablename__}"))
+    session.commit()
+
+
+# Awaitable variants of the helpers above, for the async engine. They run the
+# same queries through AsyncSession.run_sync, so the logic lives in one place.
+
+
+async def create_update_user_async(
+    session: AsyncSession, user_name: str, access_token: str, access_token_secret: str
+) -> None:
+    await session.run_sync(
+        create_update_user, user_name, access_token, access_token_secret
+    )
+
+
+async def get_user_async(
+    session: AsyncSession, user_name: str
+) -> Optional[TwitterUser]:
+    return await session.run_sync(get_user, user_name)
+
+
+async def create_update_on_youtube_post_async(
+    session: AsyncSession, text: str, user_name: str
+):
+    return await session.run_sync(create_update_on_youtube_post, text, user_name)
+
+
+async def get_on_youtube_post_async(
+    session: AsyncSession, title: str, link: str, user_name: str
+) -> Optional[str]:
+    return await session.run_sync(get_on_youtube_post, title, link, user_name)
+
+
+async def get_users_async(
+    session: AsyncSession, user_names: List[str]
+) -> Dict[str, TwitterUser]:
+    return await session.run_sync(get_users, user_names)
+
+
+async def get_post_templates_async(
+    session: AsyncSession, user_names: List[str], post_trigger: PostScheduleTime
+) -> Dict[str, Optional[ParsedTemplate]]:
+    return await session.run_sync(get_post_templates, user_names, post_trigger)
+
+
+async def render_posts_async(
+    session: AsyncSession, title: str, link: str, user_names: List[str]
+) -> Dict[str, Optional[str]]:
+    return await session.run_sync(render_posts, title, link, user_names)
+
+
+async def upsert_posts_async(
+    session: AsyncSession,
+    items: List[Tuple[str, str, PostScheduleTime, Optional[datetime.datetime]]],
+) -> List[Tuple[Optional[PostText], Optional[str]]]:
+    return await session.run_sync(upsert_posts, items)
+
+
+async def update_lease_async(
+    session: AsyncSession, user_name: str, lease_seconds: int, hub_topic: str
+):
+    await session.run_sync(update_lease, user_name, lease_seconds, hub_topic)
+
+
+async def update_topic_lease_async(
+    session: AsyncSession, hub_topic: str, lease_seconds: int
+) -> datetime.datetime:
+    return await session.run_sync(update_topic_lease, hub_topic, lease_seconds)
+
+
+async def count_expiring_leases_async(
+    session: AsyncSession, windows: Dict[str, datetime.timedelta]
+) -> Dict[str, int]:
+    return await session.run_sync(count_expiring_leases, windows)
+
+
+async def get_topic_users_async(session: AsyncSession, topics: List[str]) -> List[str]:
+    return await session.run_sync(get_topic_users, topics)
+
+
+async def get_topics_async(session: AsyncSession) -> List[str]:
+    return await session.run_sync(get_topics)
+
+
+async def get_topic_leases_async(
+    session: AsyncSession, since: Optional[datetime.datetime] = None
+) -> List[Tuple[str, datetime.datetime]]:
+    return await session.run_sync(get_topic_leases, since)
+
+
+async def acquire_leadership_async(
+    session: AsyncSession, name: str, holder: str, lease_seconds: float
+) -> bool:
+    return await session.run_sync(acquire_leadership, name, holder, lease_seconds)
+
+
+async def release_leadership_async(
+    session: AsyncSession, name: str, holder: str
+) -> None:
+    await session.run_sync(release_leadership, name, holder)
+
+
+async def create_sink_async(
+    session: AsyncSession,
+    user_name: str,
+    kind: SinkKind,
+    url: Optional[str] = None,
+    enabled: bool = True,
+) -> Sink:
+    return await session.run_sync(create_sink, user_name, kind, url, enabled)
+
+
+async def delete_sink_async(session: AsyncSession, sink_id: int) -> bool:
+    return await session.run_sync(delete_sink, sink_id)
+
+
+async def get_user_sinks_async(session: AsyncSession, user_name: str) -> List[Sink]:
+    return await session.run_sync(get_user_sinks, user_name)
+
+
+async def get_sinks_by_id_async(
+    session: AsyncSession, sink_ids: List[int]
+) -> Dict[int, Sink]:
+    return await session.run_sync(get_sinks_by_id, sink_ids)
+
+
+async def enqueue_youtube_posts_async(
+    session: AsyncSession, topics: List[str], entries: List[Tuple[str, str]]
+) -> int:
+    return await session.run_sync(enqueue_youtube_posts, topics, entries)
+
+
+async def count_outbox_async(session: AsyncSession) -> Dict[str, int]:
+    return await session.run_sync(count_outbox)
+
+
+async def claim_outbox_async(
+    session: AsyncSession, limit: int, lock_seconds: int
+) -> List[YoutubeOutbox]:
+    return await session.run_sync(claim_outbox, limit, lock_seconds)
+
+
+async def complete_outbox_async(
+    session: AsyncSession, outbox_id: int, tweet_id: Optional[str] = None
+) -> None:
+    await session.run_sync(complete_outbox, outbox_id, tweet_id)
+
+
+async def get_upload_history_async(
+    session: AsyncSession,
+    limit: int,
+    user_name: Optional[str] = None,
+    before: Optional[int] = None,
+) -> List[YoutubeUpload]:
+    return await session.run_sync(get_upload_history, limit, user_name, before)
+
+
+async def prune_publish_results_async(
+    session: AsyncSession, before: datetime.datetime, batch_size: int
+) -> int:
+    return await session.run_sync(prune_publish_results, before, batch_size)
+
+
+async def get_publish_results_async(
+    session: AsyncSession, uploads: List[YoutubeUpload]
+) -> Dict[Tuple[str, str], List[PublishResult]]:
+    return await session.run_sync(get_publish_results, uploads)
+
+
+async def prune_uploads_async(
+    session: AsyncSession, before: datetime.datetime, batch_size: int
+) -> int:
+    return await session.run_sync(prune_uploads, before, batch_size)
+
+
+async def compact_uploads_async(session: AsyncSession) -> None:
+    await session.run_sync(compact_uploads)
+
+
+async def retry_outbox_async(
+    session: AsyncSession,
+    outbox_id: int,
+    error: str,
+    retry_in: Optional[float],
+    count_attempt: bool = True,
+) -> None:
+    await session.run_sync(retry_outbox, outbox_id, error, retry_in, count_attempt)
+
+
+async def create_scheduled_post_async(
+    session: AsyncSession, text: str, user_name: str, post_time: datetime.datetime
+) -> PostText:
+    return await session.run_sync(create_scheduled_post, text, user_name, post_time)
+
+
+async def get_pending_scheduled_posts_async(
+    session: AsyncSession, post_ids: Optional[List[int]] = None
+) -> List[Tuple[datetime.datetime, int]]:
+    return await session.run_sync(get_pending_scheduled_posts, post_ids)
+
+
+async def claim_scheduled_posts_async(
+    session: AsyncSession, post_ids: List[int], lock_seconds: int
+) -> List[PostText]:
+    return await session.run_sync(claim_scheduled_posts, post_ids, lock_seconds)
+
+
+async def complete_scheduled_post_async(session: AsyncSession, post_id: int) -> None:
+    await session.run_sync(complete_scheduled_post, post_id)
+
+
+async def retry_scheduled_post_async(
+    session: AsyncSession,
+    post_id: int,
+    error: str,
+    retry_in: Optional[float],
+    count_attempt: bool = True,
+) -> None:
+    await session.run_sync(
+        retry_scheduled_post, post_id, error, retry_in, count_attempt
+    )
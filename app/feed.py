@@ -0,0 +1,101 @@
+import datetime
+from typing import AsyncIterable, AsyncIterator, NamedTuple, Optional
+import xml.etree.ElementTree as ET
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+YT = "{http://www.youtube.com/xml/schemas/2015}"
+
+# older videos are not posted, e.g. when an old video is edited
+MAX_AGE = datetime.timedelta(hours=12)
+
+
+# raised for malformed XML
+ParseError = ET.ParseError
+
+
+class FeedError(Exception):
+    pass
+
+
+class FeedTooLarge(FeedError):
+    pass
+
+
+class FeedEntry(NamedTuple):
+    title: str
+    link: str
+    published: datetime.datetime
+    channel_id: Optional[str]
+    # the feed's rel="self" link, which is the topic it was subscribed as
+    topic: Optional[str]
+
+
+def is_recent(entry: "FeedEntry") -> bool:
+    return datetime.datetime.now(datetime.UTC) - entry.published <= MAX_AGE
+
+
+def _parse_entry(entry: ET.Element, topic: Optional[str]) -> FeedEntry:
+    title = entry.findtext(ATOM + "title")
+    published = entry.findtext(ATOM + "published")
+    link = entry.find(ATOM + "link")
+    if title is None or published is None or link is None or "href" not in link.attrib:
+        raise FeedError("Entry is missing title, published or link")
+    try:
+        published_date = datetime.datetime.fromisoformat(published)
+    except ValueError:
+        raise FeedError(f"Invalid published date {published}")
+    return FeedEntry(
+        title,
+        link.attrib["href"],
+        published_date,
+        entry.findtext(YT + "channelId"),
+        topic,
+    )
+
+
+async def parse_feed(
+    chunks: AsyncIterable[bytes], max_bytes: int, max_entries: int
+) -> AsyncIterator[FeedEntry]:
+    """Incrementally parses an Atom feed, yielding each entry once it is complete.
+
+    The body is never buffered as a whole: parsed entries are discarded and the
+    stream is abandoned as soon as the document is not an Atom feed or exceeds
+    `max_bytes` or `max_entries`. Malformed XML raises `ParseError`.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    topic = None
+    size = 0
+    count = 0
+
+    def read_events():
+        nonlocal root, topic, count
+        for event, element in parser.read_events():
+            if event == "start":
+                if root is None:
+                    if element.tag != ATOM + "feed":
+                        raise FeedError(f"Not an Atom feed: {element.tag}")
+                    root = element
+                continue
+            if element.tag == ATOM + "link" and element.get("rel") == "self":
+                if element in root:
+                    topic = element.get("href")
+                continue
+            if element.tag != ATOM + "entry":
+                continue
+            count += 1
+            if count > max_entries:
+                raise FeedTooLarge(f"Feed has more than {max_entries} entries")
+            yield _parse_entry(element, topic)
+            root.remove(element)
+
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > max_bytes:
+            raise FeedTooLarge(f"Feed is larger than {max_bytes} bytes")
+        parser.feed(chunk)
+        for entry in read_events():
+            yield entry
+    parser.close()
+    for entry in read_events():
+        yield entry
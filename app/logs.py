@@ -0,0 +1,46 @@
+import json
+import logging
+import sys
+
+from app.config import settings
+
+# attributes every LogRecord has, anything else was passed through `extra`
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as `key=value` pairs, or JSON lines, including the
+    fields passed in `extra`."""
+
+    def __init__(self, as_json: bool = False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in STANDARD_ATTRIBUTES
+        )
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        if self.as_json:
+            return json.dumps(fields, default=str)
+        return " ".join(
+            f"{key}={json.dumps(value, default=str)}" for key, value in fields.items()
+        )
+
+
+def setup_logging() -> None:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(StructuredFormatter(as_json=settings.log_json))
+    logger = logging.getLogger("app")
+    logger.handlers = [handler]
+    logger.setLevel(settings.log_level.upper())
+    logger.propagate = False
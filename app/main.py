@@ -1,34 +1,81 @@
 import datetime
-from discord import HTTPException
+import hmac
+import logging
+from typing import List, Literal, Optional
 from fastapi.concurrency import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import Depends, FastAPI, Query, Request, Response
 from fastapi.responses import RedirectResponse
-from app import bot
+from app import bot, metrics, profiling, ratelimit, worker
 from app.config import settings
-import xml.etree.ElementTree as ET
-import tweepy
+from app.feed import FeedError, FeedTooLarge, ParseError, is_recent
 
 from app.db import (
+    OutboxStatus,
     PostScheduleTime,
-    create_update_on_youtube_post,
-    get_on_youtube_post,
-    get_session,
-    get_user,
+    count_expiring_leases_async,
+    count_outbox_async,
+    create_scheduled_post_async,
+    create_update_on_youtube_post_async,
+    create_update_user_async,
+    create_sink_async,
+    delete_sink_async,
+    enqueue_youtube_posts_async,
+    get_async_session,
+    get_on_youtube_post_async,
+    get_publish_results_async,
+    get_upload_history_async,
+    get_user_async,
+    get_user_sinks_async,
     init_db,
-    create_update_user,
-    update_lease,
+    render_posts_async,
+    upsert_posts_async,
+    update_topic_lease_async,
 )
-from app.models import Post
-from app.scheduler import init_scheduler
-from app.youtube import resubscribe, unsubscribe
+from app.logs import setup_logging
+from app.models import NewSink, Post, RenderPosts
+from app.poller import close_poll_session
+from app.scheduled_posts import schedule_post, start_dispatcher, stop_dispatcher
+from app.scheduler import init_scheduler, schedule_lease, shutdown_scheduler
+from app.templates import TemplateError
+from app.youtube import (
+    SIGNATURE_ALGORITHMS,
+    channel_topics,
+    close_http_session,
+    is_duplicate,
+    read_delivery,
+    remember_delivery,
+    resubscribe,
+    self_topic,
+    topic_secret,
+    unsubscribe,
+)
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# windows reported by the hexbot_leases_expiring gauge
+LEASE_WINDOWS = {
+    "expired": datetime.timedelta(0),
+    "1d": datetime.timedelta(days=1),
+    "2d": datetime.timedelta(days=2),
+}
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_db()
     init_scheduler()
+    worker.start_workers()
+    start_dispatcher()
     yield
+    await shutdown_scheduler()
+    await stop_dispatcher()
+    await worker.stop_workers()
+    await close_http_session()
+    await close_poll_session()
+    bot.close_twitter_clients()
+    profiling.stop_sampler()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -42,6 +89,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# does nothing unless profile_sample_rate is set
+app.add_middleware(profiling.ProfilerMiddleware)
 
 
 # templates = Jinja2Templates(directory="templates")
@@ -57,6 +106,8 @@ async def root():
 
 @app.get("/twitter")
 async def twitter():
+    import tweepy
+
     auth = tweepy.OAuth1UserHandler(
         settings.twitter_api_key, settings.twitter_api_key_secret
     )
@@ -66,13 +117,15 @@ async def twitter():
 
         return RedirectResponse(url=redirect_url)
     except tweepy.TweepyException as e:
-        print({"error": str(e)})
+        logger.error("Twitter authorization failed", extra={"error": str(e)})
 
 
 @app.get("/twitter/callback")
 async def twitter_oauth(
-    oauth_token: str, oauth_verifier: str, session=Depends(get_session)
+    oauth_token: str, oauth_verifier: str, session=Depends(get_async_session)
 ):
+    import tweepy
+
     auth = tweepy.OAuth1UserHandler(
         settings.twitter_api_key, settings.twitter_api_key_secret
     )
@@ -86,14 +139,35 @@ async def twitter_oauth(
             oauth_verifier
         )
 
-        create_update_user(
+        await create_update_user_async(
             session, settings.default_user, auth.access_token, auth.access_token_secret
         )
         return Response(
             content="<p>User updated successfully</p>", media_type="text/html"
         )
     except tweepy.TweepyException as e:
-        print({"error": str(e)})
+        logger.error("Twitter callback failed", extra={"error": str(e)})
+
+
+@app.get("/twitter/queue")
+async def twitter_queue(session=Depends(get_async_session)):
+    return {
+        "rate_limited": ratelimit.queue_depth(),
+        "users": ratelimit.queued,
+        "outbox": await count_outbox_async(session),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics(session=Depends(get_async_session)):
+    leases = await count_expiring_leases_async(session, LEASE_WINDOWS)
+    for window, count in leases.items():
+        metrics.leases_expiring.set(count, window=window)
+    outbox = await count_outbox_async(session)
+    for status in OutboxStatus:
+        metrics.outbox_items.set(outbox.get(status, 0), status=status.value)
+    metrics.rate_limited_posts.set(ratelimit.queue_depth())
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 # @app.get("/update_template")
@@ -106,23 +180,29 @@ async def youtube_hook(
     hub_topic: str = Query(..., alias="hub.topic"),
     lease_seconds: str = Query(..., alias="hub.lease_seconds"),
     hub_mode: str = Query(..., alias="hub.mode"),
-    session=Depends(get_session),
+    session=Depends(get_async_session),
 ):
     if hub_verify_token != settings.youtube_verify_token:
-        print(f"Invalid verify token!: {hub_verify_token}")
+        logger.warning("Invalid verify token", extra={"topic": hub_topic})
         return Response(content="Invalid verify token", status_code=403)
     if hub_mode == "subscribe" and hub_challenge:
-        print(f"Subscribed to Youtube with lease_seconds: {lease_seconds}")
-        update_lease(session, settings.default_user, int(lease_seconds), hub_topic)
+        logger.info(
+            "Subscribed to Youtube",
+            extra={"topic": hub_topic, "lease_seconds": lease_seconds},
+        )
+        lease_date = await update_topic_lease_async(
+            session, hub_topic, int(lease_seconds)
+        )
+        schedule_lease(hub_topic, lease_date)
         return Response(content=hub_challenge, media_type="text/plain")
-    print("Youtube mode invalid")
+    logger.warning("Youtube mode invalid", extra={"mode": hub_mode})
 
 
 @app.post("/youtube/resubscribe")
 async def youtube_resubscribe(
-    session=Depends(get_session),
+    session=Depends(get_async_session),
 ):
-    user = get_user(session, settings.default_user)
+    user = await get_user_async(session, settings.default_user)
     if user:
         await resubscribe(user.hub_topic)
         return {"message": "Resubscribed"}
@@ -132,9 +212,9 @@ async def youtube_resubscribe(
 
 @app.post("/youtube/unsubscribe")
 async def youtube_resubscribe(
-    session=Depends(get_session),
+    session=Depends(get_async_session),
 ):
-    user = get_user(session, settings.default_user)
+    user = await get_user_async(session, settings.default_user)
     if user:
         await unsubscribe(user.hub_topic)
         return {"message": "Unsubscribed for 24h"}
@@ -143,38 +223,87 @@ async def youtube_resubscribe(
 
 
 @app.post("/youtube/hook")
-async def youtube_hook(request: Request, session=Depends(get_session)):
-    print("Received youtube hook")
+async def youtube_hook(request: Request, session=Depends(get_async_session)):
+    logger.debug("Received youtube hook")
+    content_length = request.headers.get("content-length")
+    if (
+        content_length
+        and content_length.isdigit()
+        and int(content_length) > settings.feed_max_bytes
+    ):
+        return Response(status_code=413, content="Feed too large")
+
+    # the body is hashed while the incremental parser reads it, so a body that
+    # isn't an Atom feed is dropped early; forged and re-delivered
+    # notifications are answered before anything is queued
+    signature = request.headers.get("x-hub-signature")
+    topic = self_topic(request.headers.get("link"))
+    if signature:
+        algorithm, _, expected = signature.partition("=")
+        if algorithm not in SIGNATURE_ALGORITHMS or not topic:
+            metrics.deliveries_total.inc(outcome="forged")
+            return Response(status_code=403, content="Invalid signature")
+    elif settings.hub_require_signature:
+        metrics.deliveries_total.inc(outcome="forged")
+        return Response(status_code=403, content="Missing signature")
     try:
-        body = await request.body()
-        root = ET.fromstring(body)
-
-        for entry in root.findall("{http://www.w3.org/2005/Atom}entry"):
-            title = entry.find("{http://www.w3.org/2005/Atom}title").text
-            published = entry.find("{http://www.w3.org/2005/Atom}published").text
-            link = entry.find("{http://www.w3.org/2005/Atom}link").attrib["href"]
-
-            # if published greater than 12 hours ago, ignore
-            published_iso_date = datetime.datetime.fromisoformat(published)
-            if (
-                datetime.datetime.now(datetime.UTC) - published_iso_date
-            ).total_seconds() > 43200:
-                print("Ignoring video published more than 12 hours ago")
-                continue
-
-            await bot.process_youtube(
-                session,
-                title,
-                link,
-                settings,
-                get_user(session, settings.default_user),
+        with metrics.feed_parse_seconds.time():
+            delivery = await read_delivery(
+                request.stream(),
+                settings.feed_max_bytes,
+                settings.feed_max_entries,
+                topic_secret(topic) if signature else None,
+                algorithm if signature else "sha1",
             )
-
-    except ET.ParseError:
-        print("invalid xml")
+    except ParseError:
+        logger.warning("Invalid XML in youtube hook")
         return Response(status_code=400, content="Invalid XML format")
+    except FeedTooLarge as e:
+        logger.warning("Feed too large", extra={"error": str(e)})
+        return Response(status_code=413, content=str(e))
+    except FeedError as e:
+        logger.warning("Invalid feed", extra={"error": str(e)})
+        return Response(status_code=400, content=str(e))
+    # headers are latin-1, compare_digest only takes ASCII strings
+    if signature and not hmac.compare_digest(
+        delivery.signature.encode(), expected.encode("latin-1")
+    ):
+        logger.warning("Invalid hub signature", extra={"topic": topic})
+        metrics.deliveries_total.inc(outcome="forged")
+        return Response(status_code=403, content="Invalid signature")
+    if is_duplicate(delivery):
+        logger.debug("Ignoring re-delivered notification")
+        metrics.deliveries_total.inc(outcome="duplicate")
+        return {"message": "Received"}
+    metrics.deliveries_total.inc(outcome="accepted")
+
+    try:
+        entries = []
+        topics = set()
+        for entry in delivery.entries:
+            if not is_recent(entry):
+                logger.info(
+                    "Ignoring video published more than 12 hours ago",
+                    extra={"link": entry.link},
+                )
+                metrics.videos_total.inc(outcome="too_old")
+                continue
+            metrics.videos_total.inc(outcome="received")
+            entries.append((entry.title, entry.link))
+            if entry.topic:
+                topics.add(entry.topic)
+            if entry.channel_id:
+                topics.update(channel_topics(entry.channel_id))
+
+        # posting happens in the outbox workers so the hub gets its reply right away
+        if entries:
+            with metrics.dedup_seconds.time():
+                await enqueue_youtube_posts_async(session, list(topics), entries)
+            worker.notify()
+        # only once handled, so the hub's retry of a failed delivery goes through
+        remember_delivery(delivery)
     except Exception as e:
-        print(e)
+        logger.exception("Youtube hook failed")
         return Response(status_code=500, content=str(e))
 
     return {"message": "Received"}
@@ -185,23 +314,169 @@ async def get_posts_by_user(
     user_name: str,
     title: str = "YOUTUBE_TITLE_HERE",
     link="YOUTUBE_LINK_HERE",
-    session=Depends(get_session),
+    session=Depends(get_async_session),
 ):
-    text = get_on_youtube_post(session, title, link, user_name)
+    text = await get_on_youtube_post_async(session, title, link, user_name)
     if text:
         return text
     return Response(status_code=404, content="No post found")
 
 
+def local_time(post_time: datetime.datetime) -> datetime.datetime:
+    if post_time.tzinfo:
+        # stored as naive local time, like lease dates
+        return post_time.astimezone().replace(tzinfo=None)
+    return post_time
+
+
 @app.post("/posts")
 async def set_posts_by_user(
     post: Post,
-    session=Depends(get_session),
+    session=Depends(get_async_session),
 ):
     if post.post_trigger == PostScheduleTime.on_scheduled and post.post_time is None:
         return Response(
             status_code=400, content="post_time required for scheduled posts"
         )
-    if post.post_trigger != PostScheduleTime.on_new_video:
-        return Response(status_code=400, content="Not implemented")
-    return create_update_on_youtube_post(session, post.text, post.user_name)
+    if post.post_trigger == PostScheduleTime.on_scheduled:
+        scheduled = await create_scheduled_post_async(
+            session, post.text, post.user_name, local_time(post.post_time)
+        )
+        schedule_post(scheduled.id, scheduled.post_time)
+        return scheduled
+    try:
+        return await create_update_on_youtube_post_async(
+            session, post.text, post.user_name
+        )
+    except TemplateError as e:
+        return Response(status_code=400, content=str(e))
+
+
+@app.post("/posts/bulk")
+async def set_posts_bulk(
+    posts: List[Post],
+    session=Depends(get_async_session),
+):
+    """Sets many post texts in one transaction. Returns a result per post, in
+    order, with either the stored post or the reason it was rejected."""
+    if len(posts) > settings.bulk_posts_max_items:
+        return Response(
+            status_code=413,
+            content=f"At most {settings.bulk_posts_max_items} posts per request",
+        )
+    results = [None] * len(posts)
+    items = []
+    for i, post in enumerate(posts):
+        if post.post_trigger == PostScheduleTime.on_scheduled:
+            if post.post_time is None:
+                results[i] = {"error": "post_time required for scheduled posts"}
+                continue
+            post_time = local_time(post.post_time)
+        else:
+            post_time = None
+        items.append((i, (post.text, post.user_name, post.post_trigger, post_time)))
+    stored = await upsert_posts_async(session, [item for _, item in items])
+    for (i, _), (stored_post, error) in zip(items, stored):
+        if error:
+            results[i] = {"error": error}
+            continue
+        results[i] = {"post": stored_post}
+        if stored_post.post_trigger == PostScheduleTime.on_scheduled:
+            schedule_post(stored_post.id, stored_post.post_time)
+    return results
+
+
+@app.post("/posts/render")
+async def render_posts(
+    request: RenderPosts,
+    session=Depends(get_async_session),
+):
+    """Previews the new video post of many users, like GET /posts/{user_name}."""
+    if len(request.user_names) > settings.bulk_posts_max_items:
+        return Response(
+            status_code=413,
+            content=f"At most {settings.bulk_posts_max_items} users per request",
+        )
+    texts = await render_posts_async(
+        session, request.title, request.link, request.user_names
+    )
+    return [
+        (
+            {"user_name": user_name, "text": texts[user_name]}
+            if texts[user_name] is not None
+            else {"user_name": user_name, "error": "No post found"}
+        )
+        for user_name in request.user_names
+    ]
+
+
+@app.get("/admin/profile")
+async def get_profile(
+    request: Request,
+    format: Literal["collapsed", "pstats"] = "collapsed",
+    reset: bool = False,
+):
+    """The profile sampled so far, as collapsed stacks or a pstats file. Needs
+    the profile_token in an X-Profile-Token header."""
+    if not settings.profile_token:
+        return Response(status_code=404, content="Profiling is not enabled")
+    token = request.headers.get("x-profile-token", "")
+    if not hmac.compare_digest(token.encode(), settings.profile_token.encode()):
+        return Response(status_code=403, content="Invalid profile token")
+    if format == "pstats":
+        response = Response(
+            content=profiling.pstats_dump(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="hexbot.pstats"'},
+        )
+    else:
+        response = Response(content=profiling.collapsed(), media_type="text/plain")
+    if reset:
+        profiling.reset()
+    return response
+
+
+@app.get("/history")
+async def get_history(
+    user_name: Optional[str] = None,
+    before: Optional[int] = None,
+    limit: int = Query(default=settings.history_page_size, ge=1),
+    session=Depends(get_async_session),
+):
+    """Claimed videos, newest first, with the outcome at each of the user's
+    sinks. Pass the returned `next` as `before` for the following page, which
+    costs the same however far back it is."""
+    limit = min(limit, settings.history_max_page_size)
+    uploads = await get_upload_history_async(session, limit, user_name, before)
+    results = await get_publish_results_async(session, uploads)
+    return {
+        "items": [
+            {
+                **upload.model_dump(),
+                "sinks": results.get((upload.link, upload.user), []),
+            }
+            for upload in uploads
+        ],
+        "next": uploads[-1].id if len(uploads) == limit else None,
+    }
+
+
+@app.get("/sinks/{user_name}")
+async def get_sinks(user_name: str, session=Depends(get_async_session)):
+    """The sinks a user's new videos are published to. The user's Twitter
+    account is one of them unless a disabled Twitter sink is listed."""
+    return await get_user_sinks_async(session, user_name)
+
+
+@app.post("/sinks")
+async def add_sink(sink: NewSink, session=Depends(get_async_session)):
+    return await create_sink_async(
+        session, sink.user_name, sink.kind, sink.url, sink.enabled
+    )
+
+
+@app.delete("/sinks/{sink_id}")
+async def remove_sink(sink_id: int, session=Depends(get_async_session)):
+    if not await delete_sink_async(session, sink_id):
+        return Response(status_code=404, content="No sink found")
+    return {"message": "Deleted"}
@@ -0,0 +1,164 @@
+"""In-process counters, gauges and histograms, served by GET /metrics in the
+Prometheus text format.
+
+Recording a value is a dict update, so instrumenting hot paths costs next to
+nothing. Values are per process.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+registry: List["Metric"] = []
+
+
+def _labels(labels: Dict[str, str]) -> LabelValues:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: LabelValues, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[_labels(labels)] = value
+
+
+# seconds, from a fast dict lookup to a slow Twitter call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        # per label set: counts per bucket (non cumulative), sum, count
+        self.values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observes the duration of the block. `labels` may be changed inside it,
+        e.g. to record the outcome."""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _format_labels(labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+feed_parse_seconds = Histogram(
+    "hexbot_feed_parse_seconds", "Time to read and parse a hub notification"
+)
+dedup_seconds = Histogram(
+    "hexbot_dedup_seconds", "Time to deduplicate and queue the videos of a notification"
+)
+deliveries_total = Counter(
+    "hexbot_deliveries_total", "Hub notifications received, by outcome"
+)
+feed_polls_total = Counter(
+    "hexbot_feed_polls_total", "Feeds fetched by the poller, by result"
+)
+videos_total = Counter(
+    "hexbot_videos_total", "Videos received from the hub, by outcome"
+)
+template_render_seconds = Histogram(
+    "hexbot_template_render_seconds", "Time to look up and render a post text"
+)
+tweet_seconds = Histogram(
+    "hexbot_tweet_seconds", "Twitter API calls to create a tweet, by result"
+)
+publish_seconds = Histogram(
+    "hexbot_publish_seconds", "Posts of a new video to a sink, by sink kind and result"
+)
+hub_request_seconds = Histogram(
+    "hexbot_hub_request_seconds", "Requests to the WebSub hub, by mode and result"
+)
+scheduler_job_seconds = Histogram(
+    "hexbot_scheduler_job_seconds",
+    "Background jobs, by job",
+    buckets=DEFAULT_BUCKETS + (30, 60, 300),
+)
+leases_expiring = Gauge(
+    "hexbot_leases_expiring", "Subscribed users whose lease expires within the window"
+)
+leader = Gauge("hexbot_leader", "1 if this process runs the lease renewals")
+outbox_items = Gauge("hexbot_outbox_items", "Outbox items, by status")
+rate_limited_posts = Gauge(
+    "hexbot_rate_limited_posts", "Posts waiting for the Twitter rate limit"
+)
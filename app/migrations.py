@@ -0,0 +1,177 @@
+"""Versioned schema changes for databases created by older releases.
+
+`create_all` only creates missing tables, so every change to an existing table
+(an index, a column) is appended to MIGRATIONS. A migration must also be safe
+to run on a table `create_all` has just created with the current schema.
+
+Boot skips `create_all` once the database is at the latest version, so a new
+table needs a migration too (`create_table`).
+"""
+
+import datetime
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import Connection, Engine, inspect, text
+from sqlalchemy.types import SchemaType
+from sqlmodel import Field, SQLModel, func, select
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaVersion(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    version: int
+    description: str
+    applied_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+
+
+def create_index(connection: Connection, table_name: str, index_name: str) -> None:
+    table = SQLModel.metadata.tables[table_name]
+    index = next(index for index in table.indexes if index.name == index_name)
+    index.create(connection, checkfirst=True)
+
+
+def create_table(connection: Connection, table_name: str) -> None:
+    SQLModel.metadata.tables[table_name].create(connection, checkfirst=True)
+
+
+def add_column(connection: Connection, table_name: str, column_name: str) -> None:
+    columns = inspect(connection).get_columns(table_name)
+    if any(column["name"] == column_name for column in columns):
+        return
+    column = SQLModel.metadata.tables[table_name].c[column_name]
+    if isinstance(column.type, SchemaType):
+        # e.g. the type of a Postgres enum column
+        column.type.create(connection, checkfirst=True)
+    column_type = column.type.compile(connection.dialect)
+    connection.execute(
+        text(f'ALTER TABLE {table_name} ADD COLUMN "{column_name}" {column_type}')
+    )
+
+
+def index_hot_lookups(connection: Connection) -> None:
+    # the unique index can't be built while a link is stored twice
+    connection.execute(
+        text(
+            "DELETE FROM youtubeupload WHERE id NOT IN "
+            "(SELECT MIN(id) FROM youtubeupload GROUP BY link)"
+        )
+    )
+    # replaced by ix_youtubeupload_link_user in "add upload history"
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_youtubeupload_link "
+            "ON youtubeupload (link)"
+        )
+    )
+    create_index(connection, "twitteruser", "ix_twitteruser_user")
+    create_index(connection, "twitteruser", "ix_twitteruser_hub_topic_lease_date")
+    connection.execute(text("DROP INDEX IF EXISTS ix_twitteruser_hub_topic"))
+    create_index(connection, "twitteruser", "ix_twitteruser_lease_date")
+    create_index(connection, "posttext", "ix_posttext_user_post_trigger")
+
+
+def add_scheduled_posts(connection: Connection) -> None:
+    add_column(connection, "posttext", "posted_at")
+    create_index(connection, "posttext", "ix_posttext_schedule")
+
+
+def add_outbox(connection: Connection) -> None:
+    # created by `create_all` before boot started skipping it
+    create_table(connection, "youtubeoutbox")
+
+
+def add_leader_lease(connection: Connection) -> None:
+    create_table(connection, "leaderlease")
+
+
+def add_sinks(connection: Connection) -> None:
+    create_table(connection, "sink")
+    add_column(connection, "youtubeoutbox", "sink_id")
+
+
+def add_upload_history(connection: Connection) -> None:
+    for column in ("user", "posted_at", "status", "tweet_id"):
+        add_column(connection, "youtubeupload", column)
+    # older rows have no date, they are pruned one retention period from now
+    connection.execute(
+        text("UPDATE youtubeupload SET posted_at = :now WHERE posted_at IS NULL"),
+        {"now": datetime.datetime.now()},
+    )
+    create_index(connection, "youtubeupload", "ix_youtubeupload_link_user")
+    connection.execute(text("DROP INDEX IF EXISTS ix_youtubeupload_link"))
+    create_index(connection, "youtubeupload", "ix_youtubeupload_posted_at")
+    create_index(connection, "youtubeupload", "ix_youtubeupload_user_id")
+
+
+def add_publish_results(connection: Connection) -> None:
+    create_table(connection, "publishresult")
+
+
+def add_lease_updated_at(connection: Connection) -> None:
+    add_column(connection, "twitteruser", "lease_updated_at")
+    create_index(connection, "twitteruser", "ix_twitteruser_lease_updated_at")
+
+
+def add_scheduled_post_leases(connection: Connection) -> None:
+    for column in ("status", "attempts", "locked_until", "last_error"):
+        add_column(connection, "posttext", column)
+    connection.execute(text("UPDATE posttext SET attempts = 0 WHERE attempts IS NULL"))
+    # posted_at used to be set when a post was claimed, not when it was sent
+    for status, posted in (("pending", "IS NULL"), ("posted", "IS NOT NULL")):
+        connection.execute(
+            text(
+                f"UPDATE posttext SET status = '{status}' WHERE status IS NULL "
+                f"AND post_time IS NOT NULL AND posted_at {posted}"
+            )
+        )
+
+
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ("index hot lookups", index_hot_lookups),
+    ("add scheduled posts", add_scheduled_posts),
+    ("add outbox", add_outbox),
+    ("add leader lease", add_leader_lease),
+    ("add sinks", add_sinks),
+    ("add upload history", add_upload_history),
+    ("add publish results", add_publish_results),
+    ("add lease updated at", add_lease_updated_at),
+    ("add scheduled post leases", add_scheduled_post_leases),
+]
+
+
+def get_version(connection: Connection) -> int:
+    return connection.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def is_current(engine: Engine) -> bool:
+    """Whether every migration has been applied, i.e. boot has no schema work."""
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(SchemaVersion.__tablename__):
+            return False
+        return get_version(connection) >= len(MIGRATIONS)
+
+
+def migrate(engine: Engine) -> int:
+    """Applies the migrations the database has not seen yet, in order, and
+    returns the schema version."""
+    with engine.begin() as connection:
+        version = get_version(connection)
+        for number, (description, migration) in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            logger.info(
+                "Migrating schema",
+                extra={"version": number, "description": description},
+            )
+            migration(connection)
+            connection.execute(
+                SchemaVersion.__table__.insert().values(
+                    version=number,
+                    description=description,
+                    applied_at=datetime.datetime.now(),
+                )
+            )
+            version = number
+    return version
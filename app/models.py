@@ -1,11 +1,49 @@
 import datetime
-from typing import Optional
-from pydantic import BaseModel
+from typing import List, Optional
+from urllib.parse import urlsplit
+from pydantic import BaseModel, model_validator
+
+from app.db import PostScheduleTime, SinkKind
 
-from app.db import PostScheduleTime
 
 class Post(BaseModel):
     user_name: str
     text: str
     post_trigger: PostScheduleTime
-    post_time: Optional[datetime.datetime] = None
\ No newline at end of file
+    post_time: Optional[datetime.datetime] = None
+
+
+class RenderPosts(BaseModel):
+    user_names: List[str]
+    title: str = "YOUTUBE_TITLE_HERE"
+    link: str = "YOUTUBE_LINK_HERE"
+
+
+# the worker posts to a sink's URL, so only Discord's own webhooks are allowed
+DISCORD_WEBHOOK_HOSTS = {"discord.com", "discordapp.com"}
+
+
+class NewSink(BaseModel):
+    user_name: str
+    kind: SinkKind
+    # the webhook of a Discord sink
+    url: Optional[str] = None
+    # a disabled Twitter sink stops the posts to the user's Twitter account
+    enabled: bool = True
+
+    @model_validator(mode="after")
+    def check_url(self) -> "NewSink":
+        if self.kind != SinkKind.discord:
+            return self
+        if not self.url:
+            raise ValueError("url required for Discord sinks")
+        url = urlsplit(self.url)
+        if (
+            url.scheme != "https"
+            or url.hostname not in DISCORD_WEBHOOK_HOSTS
+            or url.port is not None
+            or url.username is not None
+            or not url.path.startswith("/api/webhooks/")
+        ):
+            raise ValueError("url must be a https://discord.com/api/webhooks/ URL")
+        return self
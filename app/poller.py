@@ -0,0 +1,132 @@
+"""Catch-up polling of the subscribed feeds, for videos the hub never pushed.
+
+Each feed is fetched with the ETag and Last-Modified of the previous fetch, so
+an unchanged feed costs a 304. New entries take the same way as the hook's:
+deduplicated and queued in the outbox.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from app import metrics, profiling, worker
+from app.config import settings
+from app.db import async_session, enqueue_youtube_posts_async, get_topics_async
+from app.feed import is_recent, parse_feed
+from app.youtube import channel_topics
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# its own client, with a cap on the connections to one host
+poll_session: Optional[aiohttp.ClientSession] = None
+# (ETag, Last-Modified) of the last successful fetch of each feed
+validators: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+
+
+def get_poll_session() -> aiohttp.ClientSession:
+    global poll_session
+    if poll_session is None or poll_session.closed:
+        import aiohttp
+
+        poll_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.feed_poll_concurrency,
+                limit_per_host=settings.feed_poll_per_host,
+                keepalive_timeout=settings.http_keepalive_seconds,
+            ),
+            timeout=aiohttp.ClientTimeout(total=settings.http_timeout_seconds),
+        )
+    return poll_session
+
+
+async def close_poll_session() -> None:
+    global poll_session
+    if poll_session is not None:
+        await poll_session.close()
+        poll_session = None
+
+
+def feed_url(topic: str) -> str:
+    # the topic URL of the hub isn't served, the public feed is
+    return topic.replace("://www.youtube.com/xml/feeds/", "://www.youtube.com/feeds/")
+
+
+async def poll_feed(topic: str, session: aiohttp.ClientSession) -> Optional[int]:
+    """Fetches one feed and queues its recent entries.
+
+    Returns the number of videos queued, or None if the feed was unchanged.
+    """
+    etag, last_modified = validators.get(topic, (None, None))
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    async with session.get(feed_url(topic), headers=headers) as resp:
+        if resp.status == 304:
+            return None
+        resp.raise_for_status()
+        entries = []
+        topics = {topic}
+        async for entry in parse_feed(
+            resp.content.iter_any(), settings.feed_max_bytes, settings.feed_max_entries
+        ):
+            if not is_recent(entry):
+                continue
+            entries.append((entry.title, entry.link))
+            if entry.channel_id:
+                topics.update(channel_topics(entry.channel_id))
+        queued = 0
+        if entries:
+            async with async_session() as db_session:
+                queued = await enqueue_youtube_posts_async(
+                    db_session, list(topics), entries
+                )
+        # only once queued, so a failure is fetched in full next time
+        validators[topic] = (
+            resp.headers.get("ETag"),
+            resp.headers.get("Last-Modified"),
+        )
+        return queued
+
+
+async def poll_feeds(topics: Optional[List[str]] = None) -> Dict[str, int]:
+    """Polls every subscribed feed concurrently. Returns how many feeds were
+    unchanged, changed or failed, and how many videos were queued."""
+    if topics is None:
+        async with async_session() as db_session:
+            topics = await get_topics_async(db_session)
+    session = get_poll_session()
+    limit = asyncio.Semaphore(settings.feed_poll_concurrency)
+    stats = {"unchanged": 0, "changed": 0, "failed": 0, "queued": 0}
+
+    async def poll(topic: str):
+        async with limit:
+            try:
+                queued = await poll_feed(topic, session)
+            except Exception as e:
+                logger.warning(
+                    "Error polling feed", extra={"topic": topic, "error": str(e)}
+                )
+                stats["failed"] += 1
+                metrics.feed_polls_total.inc(result="failed")
+                return
+        if queued is None:
+            stats["unchanged"] += 1
+            metrics.feed_polls_total.inc(result="unchanged")
+            return
+        stats["changed"] += 1
+        stats["queued"] += queued
+        metrics.feed_polls_total.inc(result="changed")
+
+    with profiling.profile(), metrics.scheduler_job_seconds.time(job="poll_feeds"):
+        await asyncio.gather(*(poll(topic) for topic in topics))
+    if stats["queued"]:
+        worker.notify()
+    logger.info("Polled feeds", extra=stats)
+    return stats
@@ -0,0 +1,160 @@
+"""Opt-in sampling profiler for requests and scheduler jobs.
+
+A sampled request or job turns on a thread that records the event loop's
+stack every `profile_interval_ms`, until nothing sampled is in flight. The
+loop is shared, so a sample shows whatever it runs at that moment, sampled or
+not; the stacks still point at the hot paths. Unsampled requests only cost a
+random number.
+
+Samples add up until they are reset, and can be exported as collapsed stacks
+(for flame graph tools) or as a pstats file.
+"""
+
+import marshal
+import random
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from app.config import settings
+
+# (filename, first line, function name), like the keys of pstats
+Func = Tuple[str, int, str]
+
+# stacks of the event loop, outermost call first, by number of samples
+samples: Counter = Counter()
+samples_lock = threading.Lock()
+# sampled requests and jobs in flight
+active = 0
+# the event loop's thread, which the sampler records
+loop_thread: Optional[int] = None
+sampler: Optional[threading.Thread] = None
+wakeup = threading.Event()
+stopping = threading.Event()
+
+
+def is_sampled() -> bool:
+    rate = settings.profile_sample_rate
+    return rate > 0 and random.random() < rate
+
+
+def stack(frame) -> Tuple[Func, ...]:
+    funcs = []
+    while frame is not None:
+        code = frame.f_code
+        funcs.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(funcs))
+
+
+def run_sampler() -> None:
+    interval = settings.profile_interval_ms / 1000
+    while not stopping.is_set():
+        if not active:
+            wakeup.wait()
+            wakeup.clear()
+            continue
+        frame = sys._current_frames().get(loop_thread)
+        if frame is not None:
+            with samples_lock:
+                samples[stack(frame)] += 1
+        stopping.wait(interval)
+
+
+@contextmanager
+def profile():
+    """Samples the block, if chosen by `profile_sample_rate`."""
+    global active, loop_thread, sampler
+    if not is_sampled():
+        yield
+        return
+    loop_thread = threading.get_ident()
+    if sampler is None or not sampler.is_alive():
+        stopping.clear()
+        sampler = threading.Thread(target=run_sampler, name="profiler", daemon=True)
+        sampler.start()
+    active += 1
+    wakeup.set()
+    try:
+        yield
+    finally:
+        active -= 1
+
+
+def stop_sampler() -> None:
+    global sampler
+    if sampler is not None:
+        stopping.set()
+        wakeup.set()
+        sampler.join()
+        sampler = None
+
+
+def reset() -> None:
+    with samples_lock:
+        samples.clear()
+
+
+class ProfilerMiddleware:
+    """Samples a share of the HTTP requests, see `profile_sample_rate`."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with profile():
+            await self.app(scope, receive, send)
+
+
+def collapsed() -> str:
+    """The samples as collapsed stacks, one `frame;frame;... count` line each."""
+    with samples_lock:
+        stacks = list(samples.items())
+    return "".join(
+        ";".join(f"{name} ({filename}:{line})" for filename, line, name in funcs)
+        + f" {count}\n"
+        for funcs, count in stacks
+    )
+
+
+def pstats_dump() -> bytes:
+    """The samples in the file format of `pstats.Stats`.
+
+    Call counts are the numbers of samples a function was seen in and times
+    are those counts times the sampling interval.
+    """
+    interval = settings.profile_interval_ms / 1000
+    with samples_lock:
+        stacks = list(samples.items())
+    # func: [samples it was in, samples it was running in, {caller: samples}]
+    stats: Dict[Func, list] = {}
+    for funcs, count in stacks:
+        seen = set()
+        for i, func in enumerate(funcs):
+            entry = stats.setdefault(func, [0, 0, {}])
+            # a recursive function counts once per sample
+            if func not in seen:
+                seen.add(func)
+                entry[0] += count
+            if i == len(funcs) - 1:
+                entry[1] += count
+            if i > 0:
+                caller = funcs[i - 1]
+                entry[2][caller] = entry[2].get(caller, 0) + count
+    return marshal.dumps(
+        {
+            func: (
+                total,
+                total,
+                own * interval,
+                total * interval,
+                {caller: (n, n, 0.0, n * interval) for caller, n in callers.items()},
+            )
+            for func, (total, own, callers) in stats.items()
+        }
+    )
@@ -0,0 +1,78 @@
+"""Publishing a new video to the sinks a user has configured.
+
+Every sink kind has a publisher in PUBLISHERS. The outbox holds one item per
+sink, so sinks are posted to side by side and each is retried, completed or
+failed on its own. Webhook sinks share the app's pooled http client.
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from app import bot, metrics
+from app.config import settings
+from app.db import Sink, SinkKind, TwitterUser
+from app.ratelimit import RateLimited
+from app.youtube import get_http_session
+
+logger = logging.getLogger(__name__)
+
+# Discord's limit on a message's content
+DISCORD_MAX_LENGTH = 2000
+
+
+class SinkRejected(Exception):
+    """The sink refused the post, retrying will not help."""
+
+
+async def publish_twitter(
+    user: TwitterUser, sink: Optional[Sink], text: str
+) -> Optional[str]:
+    return bot.tweet_id(await bot.send_tweet(settings, user, text))
+
+
+async def publish_discord(
+    user: TwitterUser, sink: Optional[Sink], text: str
+) -> Optional[str]:
+    import aiohttp
+
+    session = get_http_session()
+    async with session.post(
+        sink.url,
+        json={"content": text[:DISCORD_MAX_LENGTH]},
+        timeout=aiohttp.ClientTimeout(total=settings.sink_timeout_seconds),
+    ) as resp:
+        if resp.status == 429:
+            retry_after = resp.headers.get("Retry-After")
+            raise RateLimited(float(retry_after) if retry_after else 1)
+        if 400 <= resp.status < 500:
+            raise SinkRejected(f"Discord answered {resp.status}: {await resp.text()}")
+        resp.raise_for_status()
+    return None
+
+
+# a publisher returns the id of the tweet it posted, if it posts tweets
+Publisher = Callable[[TwitterUser, Optional[Sink], str], Awaitable[Optional[str]]]
+
+PUBLISHERS: Dict[SinkKind, Publisher] = {
+    SinkKind.twitter: publish_twitter,
+    SinkKind.discord: publish_discord,
+}
+
+
+async def publish(user: TwitterUser, sink: Optional[Sink], text: str) -> Optional[str]:
+    """Posts the text to one sink, None being the user's Twitter account.
+    Returns the tweet id of a Twitter sink."""
+    kind = sink.kind if sink else SinkKind.twitter
+    with metrics.publish_seconds.time(sink=kind, result="ok") as labels:
+        try:
+            tweet_id = await PUBLISHERS[kind](user, sink, text)
+        except RateLimited:
+            labels["result"] = "rate_limited"
+            raise
+        except Exception:
+            labels["result"] = "error"
+            raise
+    logger.info("Published", extra={"user": user.user, "sink": kind})
+    return tweet_id
@@ -0,0 +1,120 @@
+import asyncio
+import random
+import time
+from typing import Dict, Mapping
+
+from app.config import settings
+
+
+class RateLimited(Exception):
+    """Posting now would exceed a Twitter rate limit, try again in `retry_in`."""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"Rate limited, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class TokenBucket:
+    """Allows `capacity` posts per `period` seconds, refilled continuously.
+
+    Twitter's rate limit headers keep it in sync with the server's own count.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def sync(self, remaining: int, reset: float, now: float) -> None:
+        """Applies `remaining` calls left until the unix time `reset`."""
+        self.refill(now)
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0:
+            self.blocked_until = max(
+                self.blocked_until, now + max(0.0, reset - time.time())
+            )
+
+
+app_bucket = TokenBucket(
+    settings.twitter_app_posts_per_window, settings.twitter_app_window_seconds
+)
+user_buckets: Dict[str, TokenBucket] = {}
+# posts waiting for a token, by user
+queued: Dict[str, int] = {}
+
+
+def user_bucket(user_name: str) -> TokenBucket:
+    if user_name not in user_buckets:
+        user_buckets[user_name] = TokenBucket(
+            settings.twitter_user_posts_per_window,
+            settings.twitter_user_window_seconds,
+        )
+    return user_buckets[user_name]
+
+
+def wait_time(user_name: str) -> float:
+    now = time.monotonic()
+    return max(app_bucket.wait_time(now), user_bucket(user_name).wait_time(now))
+
+
+def queue_depth() -> int:
+    return sum(queued.values())
+
+
+async def acquire(user_name: str) -> None:
+    """Waits until both the app and the user may post.
+
+    Raises RateLimited instead of waiting longer than `twitter_max_wait_seconds`,
+    so the post goes back to its queue rather than holding a worker.
+    """
+    queued[user_name] = queued.get(user_name, 0) + 1
+    try:
+        while True:
+            wait = wait_time(user_name)
+            if wait <= 0:
+                app_bucket.take()
+                user_bucket(user_name).take()
+                return
+            # jitter so posts queued together don't all retry at the same instant
+            wait *= random.uniform(1, 1.2)
+            if wait > settings.twitter_max_wait_seconds:
+                raise RateLimited(wait)
+            await asyncio.sleep(wait)
+    finally:
+        queued[user_name] -= 1
+        if not queued[user_name]:
+            del queued[user_name]
+
+
+def update_from_headers(user_name: str, headers: Mapping[str, str]) -> None:
+    """Syncs the buckets with the limits Twitter reported for a request."""
+    now = time.monotonic()
+    for prefix, bucket in (
+        ("x-rate-limit", user_bucket(user_name)),
+        ("x-user-limit-24hour", user_bucket(user_name)),
+        ("x-app-limit-24hour", app_bucket),
+    ):
+        remaining = headers.get(f"{prefix}-remaining")
+        reset = headers.get(f"{prefix}-reset")
+        if remaining is None or reset is None:
+            continue
+        try:
+            bucket.sync(int(remaining), float(reset), now)
+        except ValueError:
+            continue
@@ -0,0 +1,155 @@
+import asyncio
+import datetime
+import heapq
+import logging
+from typing import List, Optional, Tuple
+
+from app import bot, metrics
+from app.config import settings
+from app.db import (
+    PostText,
+    async_session,
+    claim_scheduled_posts_async,
+    complete_scheduled_post_async,
+    get_pending_scheduled_posts_async,
+    get_user_async,
+    retry_scheduled_post_async,
+)
+from app.ratelimit import RateLimited
+from app.worker import is_permanent, retry_delay
+
+logger = logging.getLogger(__name__)
+
+# (post_time, post id) of upcoming scheduled posts, earliest first. The heap is
+# only a wake-up list: the database decides which process sends each post.
+upcoming: List[Tuple[datetime.datetime, int]] = []
+dispatcher: Optional[asyncio.Task] = None
+wakeup: Optional[asyncio.Event] = None
+
+
+def schedule_post(post_id: int, post_time: datetime.datetime) -> None:
+    if upcoming and upcoming[0] <= (post_time, post_id):
+        heapq.heappush(upcoming, (post_time, post_id))
+        return
+    heapq.heappush(upcoming, (post_time, post_id))
+    # the dispatcher is sleeping until a later post
+    if wakeup is not None:
+        wakeup.set()
+
+
+def pop_due(now: datetime.datetime) -> List[int]:
+    due = []
+    while (
+        upcoming
+        and upcoming[0][0] <= now
+        and len(due) < settings.scheduled_posts_batch_size
+    ):
+        due.append(heapq.heappop(upcoming)[1])
+    return due
+
+
+async def send_post(post: PostText, limit: asyncio.Semaphore) -> None:
+    async with limit, async_session() as session:
+        user = await get_user_async(session, post.user)
+        if not user:
+            logger.warning("User not found", extra={"user": post.user})
+            await retry_scheduled_post_async(
+                session, post.id, f"User {post.user} not found", None
+            )
+            return
+        try:
+            await bot.send_tweet(settings, user, post.text)
+        except RateLimited as e:
+            logger.info(
+                "Scheduled post deferred", extra={"post_id": post.id, "error": str(e)}
+            )
+            await retry_scheduled_post_async(
+                session, post.id, str(e), e.retry_in, count_attempt=False
+            )
+            schedule_post(
+                post.id,
+                datetime.datetime.now() + datetime.timedelta(seconds=e.retry_in),
+            )
+            return
+        except Exception as e:
+            retry_in = None if is_permanent(e) else retry_delay(post.attempts)
+            logger.warning(
+                "Scheduled post failed",
+                extra={"post_id": post.id, "retry_in": retry_in, "error": str(e)},
+            )
+            await retry_scheduled_post_async(session, post.id, str(e), retry_in)
+            if retry_in is not None:
+                schedule_post(
+                    post.id,
+                    datetime.datetime.now() + datetime.timedelta(seconds=retry_in),
+                )
+            return
+        await complete_scheduled_post_async(session, post.id)
+
+
+async def dispatch(post_ids: List[int]) -> None:
+    with metrics.scheduler_job_seconds.time(job="scheduled_posts"):
+        async with async_session() as session:
+            posts = await claim_scheduled_posts_async(
+                session, post_ids, settings.outbox_lock_seconds
+            )
+            # locked by another process, which may crash before sending them
+            claimed = {post.id for post in posts}
+            locked = [post_id for post_id in post_ids if post_id not in claimed]
+            if locked:
+                for when, post_id in await get_pending_scheduled_posts_async(
+                    session, locked
+                ):
+                    schedule_post(post_id, when)
+        limit = asyncio.Semaphore(settings.post_concurrency)
+        await asyncio.gather(*(send_post(post, limit) for post in posts))
+
+
+async def load_scheduled_posts() -> None:
+    async with async_session() as session:
+        pending = await get_pending_scheduled_posts_async(session)
+    upcoming.extend(pending)
+    heapq.heapify(upcoming)
+    logger.info("Loaded scheduled posts", extra={"count": len(pending)})
+
+
+async def run_dispatcher() -> None:
+    """Sleeps until the earliest scheduled post is due, then sends every due
+    post in batches. New posts wake it up if they are due sooner."""
+    await load_scheduled_posts()
+    while True:
+        wakeup.clear()
+        due = pop_due(datetime.datetime.now())
+        if due:
+            try:
+                await dispatch(due)
+            except Exception:
+                logger.exception("Scheduled post dispatch error")
+                # the posts are still pending in the database
+                for post_id in due:
+                    schedule_post(
+                        post_id,
+                        datetime.datetime.now()
+                        + datetime.timedelta(seconds=settings.outbox_poll_seconds),
+                    )
+            continue
+        timeout = None
+        if upcoming:
+            timeout = (upcoming[0][0] - datetime.datetime.now()).total_seconds()
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_dispatcher() -> None:
+    global dispatcher, wakeup
+    wakeup = asyncio.Event()
+    upcoming.clear()
+    dispatcher = asyncio.create_task(run_dispatcher())
+
+
+async def stop_dispatcher() -> None:
+    if dispatcher is not None:
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
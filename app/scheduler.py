@@ -1,22 +1,242 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from app.db import get_users_to_resub, get_session, engine
-from app.youtube import resubscribe
-from sqlmodel import Session
-import asyncio
+import datetime
+import logging
+import os
+import random
+import socket
+from typing import Dict, Optional
+import uuid
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from app import metrics, profiling
+from app.config import settings
+from app.db import (
+    acquire_leadership_async,
+    async_session,
+    compact_uploads_async,
+    get_topic_leases_async,
+    prune_publish_results_async,
+    prune_uploads_async,
+    release_leadership_async,
+)
+from app.feed import MAX_AGE
+from app.poller import poll_feeds
+from app.youtube import resubscribe, resubscribe_all
+
+logger = logging.getLogger(__name__)
+
+# runs jobs on the app's own event loop
+scheduler = AsyncIOScheduler()
+
+# every process elects a leader, only the leader schedules lease renewals
+LEADER_LEASE = "scheduler"
+instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+is_leader = False
+# the lease date each topic's renewal was scheduled for
+scheduled_leases: Dict[str, datetime.datetime] = {}
+# when the last lease check started, the next one only reads leases updated
+# since. None until the first check of a new leader, which reads them all.
+last_lease_check: Optional[datetime.datetime] = None
+# re-read leases updated shortly before a check, in case their transaction
+# committed after it
+LEASE_CHECK_OVERLAP = datetime.timedelta(minutes=1)
 
-scheduler = BackgroundScheduler()
 
 def init_scheduler():
-    scheduler.add_job(lambda: asyncio.run(check_subscriptions()), "interval", hours=24)
     scheduler.start()
+    scheduler.add_job(
+        elect_leader,
+        "interval",
+        seconds=settings.leader_renew_seconds,
+        next_run_time=datetime.datetime.now(),
+        id="elect_leader",
+    )
+
+
+async def shutdown_scheduler():
+    scheduler.shutdown(wait=False)
+    if is_leader:
+        step_down()
+        try:
+            async with async_session() as session:
+                await release_leadership_async(session, LEADER_LEASE, instance_id)
+        except Exception as e:
+            logger.error("Error releasing leadership", extra={"error": str(e)})
+
+
+async def elect_leader():
+    """Takes or keeps the leader lease, starting or stopping the lease renewals
+    when leadership changes hands."""
+    global is_leader
+    try:
+        async with async_session() as session:
+            leader = await acquire_leadership_async(
+                session, LEADER_LEASE, instance_id, settings.leader_lease_seconds
+            )
+    except Exception as e:
+        # without a renewed lease another process may take over, stop first
+        logger.error("Leader election failed", extra={"error": str(e)})
+        leader = False
+    if leader and not is_leader:
+        logger.info("Elected leader", extra={"instance": instance_id})
+        is_leader = True
+        metrics.leader.set(1)
+        scheduler.add_job(
+            check_subscriptions,
+            "interval",
+            seconds=settings.lease_check_seconds,
+            next_run_time=datetime.datetime.now(),
+            id="check_subscriptions",
+            replace_existing=True,
+        )
+        if settings.feed_poll_seconds > 0:
+            scheduler.add_job(
+                poll_feeds,
+                "interval",
+                seconds=settings.feed_poll_seconds,
+                id="poll_feeds",
+                replace_existing=True,
+            )
+        if settings.upload_retention_days > 0:
+            scheduler.add_job(
+                prune_uploads,
+                "interval",
+                seconds=settings.upload_prune_seconds,
+                id="prune_uploads",
+                replace_existing=True,
+            )
+    elif not leader and is_leader:
+        step_down()
+
+
+def step_down():
+    global is_leader, last_lease_check
+    logger.warning("No longer leader", extra={"instance": instance_id})
+    is_leader = False
+    metrics.leader.set(0)
+    for job in scheduler.get_jobs():
+        if job.id != "elect_leader":
+            job.remove()
+    scheduled_leases.clear()
+    last_lease_check = None
+
+
+def renewal_time(lease_date: datetime.datetime) -> datetime.datetime:
+    """When to renew a lease, spread randomly over the jitter window so leases
+    granted together aren't all renewed at once.
+
+    The margin is at most half of what is left of the lease, so a lease shorter
+    than the margin isn't renewed right away, again and again.
+    """
+    seconds = settings.lease_renew_margin_seconds + random.uniform(
+        0, settings.lease_renew_jitter_seconds
+    )
+    remaining = (lease_date - datetime.datetime.now()).total_seconds()
+    seconds = min(seconds, max(remaining, 0) / 2)
+    return lease_date - datetime.timedelta(seconds=seconds)
+
+
+def schedule_renewal(topic: str, run_date: datetime.datetime):
+    scheduler.add_job(
+        renew_topic,
+        "date",
+        run_date=max(run_date, datetime.datetime.now()),
+        args=[topic],
+        id=f"renew:{topic}",
+        replace_existing=True,
+        misfire_grace_time=None,
+    )
+
+
+def schedule_lease(topic: str, lease_date: datetime.datetime):
+    """(Re)schedules the renewal of a topic after its lease changed. On other
+    processes than the leader, its next check_subscriptions picks it up."""
+    if not is_leader:
+        return
+    scheduled_leases[topic] = lease_date
+    schedule_renewal(topic, renewal_time(lease_date))
+
+
+def schedule_retry(topic: str):
+    schedule_renewal(
+        topic,
+        datetime.datetime.now()
+        + datetime.timedelta(seconds=settings.lease_retry_seconds),
+    )
+
+
+async def renew_topic(topic: str):
+    # if the hub never verifies the renewal, try again later. Otherwise the
+    # verification reschedules this job for the new lease.
+    schedule_retry(topic)
+    with metrics.scheduler_job_seconds.time(job="renew_topic"):
+        try:
+            await resubscribe(topic)
+        except Exception as e:
+            logger.error("Error resubscribing", extra={"topic": topic, "error": str(e)})
 
 
 async def check_subscriptions():
-    with Session(engine) as session:
-        resub_jobs = get_users_to_resub(session)
-
-        for user in resub_jobs:
-            try:
-                await resubscribe(user.hub_topic)
-            except Exception as e:
-                print(f"Error resubscribing user {user.user}: {e}")
+    """Schedules the renewal of every leased topic whose lease changed,
+    renewing overdue ones now. Only the first check of a leader reads every
+    lease, the others the leases updated since the previous check."""
+    with profiling.profile(), metrics.scheduler_job_seconds.time(
+        job="check_subscriptions"
+    ):
+        await _check_subscriptions()
+
+
+async def _check_subscriptions():
+    global last_lease_check
+    now = datetime.datetime.now()
+    since = last_lease_check - LEASE_CHECK_OVERLAP if last_lease_check else None
+    async with async_session() as session:
+        leases = await get_topic_leases_async(session, since)
+    last_lease_check = now
+
+    overdue = []
+    for topic, lease_date in leases:
+        # unchanged since the last check, keep the job (or its retry)
+        if scheduled_leases.get(topic) == lease_date:
+            continue
+        scheduled_leases[topic] = lease_date
+        run_date = renewal_time(lease_date)
+        if run_date <= now:
+            overdue.append(topic)
+        else:
+            schedule_renewal(topic, run_date)
+
+    if not overdue:
+        return
+    results = await resubscribe_all(overdue)
+    for topic, error in results.items():
+        # like renew_topic, the hub's verification replaces the retry
+        schedule_retry(topic)
+        if error:
+            logger.error(
+                "Error resubscribing", extra={"topic": topic, "error": str(error)}
+            )
+
+
+async def prune_uploads() -> int:
+    """Deletes the uploads and publish results past the retention period, a
+    batch per transaction so the hook's claims are never held up for long,
+    then refreshes the uploads' statistics. Returns how many were deleted."""
+    # a video older than MAX_AGE is never queued again, its row can go
+    retention = max(datetime.timedelta(days=settings.upload_retention_days), MAX_AGE)
+    before = datetime.datetime.now() - retention
+    pruned = 0
+    with profiling.profile(), metrics.scheduler_job_seconds.time(job="prune_uploads"):
+        async with async_session() as session:
+            for prune in (prune_uploads_async, prune_publish_results_async):
+                while True:
+                    deleted = await prune(
+                        session, before, settings.upload_prune_batch_size
+                    )
+                    pruned += deleted
+                    if deleted < settings.upload_prune_batch_size:
+                        break
+            if pruned:
+                await compact_uploads_async(session)
+    logger.info("Pruned uploads", extra={"pruned": pruned})
+    return pruned
@@ -0,0 +1,49 @@
+from string import Formatter
+from typing import List, Optional, Tuple
+
+TEMPLATE_FIELDS = ("title", "link")
+
+# (literal text, field name, format spec, conversion) as produced by Formatter.parse
+ParsedTemplate = List[Tuple[str, Optional[str], str, Optional[str]]]
+
+formatter = Formatter()
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def render_template(template: ParsedTemplate, **values: str) -> str:
+    parts = []
+    for literal, field, spec, conversion in template:
+        parts.append(literal)
+        if field is not None:
+            value = formatter.convert_field(values[field], conversion)
+            parts.append(format(value, spec))
+    return "".join(parts)
+
+
+def parse_template(text: str) -> ParsedTemplate:
+    """Parses a post text once so it can be rendered without re-parsing.
+
+    Raises TemplateError if the text is not a valid format string or uses any
+    field other than {title} and {link}.
+    """
+    try:
+        template = list(formatter.parse(text))
+    except ValueError as e:
+        raise TemplateError(f"Invalid post text: {e}")
+    for _, field, spec, _ in template:
+        if field is None:
+            continue
+        if field not in TEMPLATE_FIELDS:
+            raise TemplateError(
+                f"Invalid post text field {{{field}}}, use {{title}} or {{link}}"
+            )
+        if "{" in spec:
+            raise TemplateError(f"Invalid post text format for {{{field}}}")
+    try:
+        render_template(template, title="", link="")
+    except ValueError as e:
+        raise TemplateError(f"Invalid post text: {e}")
+    return template
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import random
+from typing import Dict, List, Optional
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import publishers
+from app.config import settings
+from app import metrics
+from app.db import (
+    PostScheduleTime,
+    Sink,
+    TwitterUser,
+    YoutubeOutbox,
+    async_session,
+    claim_outbox_async,
+    complete_outbox_async,
+    get_on_youtube_post_async,
+    get_post_templates_async,
+    get_sinks_by_id_async,
+    get_users_async,
+    retry_outbox_async,
+)
+from app.ratelimit import RateLimited
+from app.templates import ParsedTemplate, TemplateError, render_template
+
+logger = logging.getLogger(__name__)
+
+
+workers: List[asyncio.Task] = []
+wakeup: Optional[asyncio.Event] = None
+# shared by all workers, caps how many posts are in flight at once
+post_limit: Optional[asyncio.Semaphore] = None
+
+
+def is_permanent(error: Exception) -> bool:
+    """The post itself was rejected, retrying will not help."""
+    import tweepy
+
+    return isinstance(
+        error,
+        (
+            tweepy.BadRequest,
+            tweepy.Unauthorized,
+            tweepy.Forbidden,
+            TemplateError,
+            publishers.SinkRejected,
+        ),
+    )
+
+
+def notify() -> None:
+    """Wakes idle workers after new items were added to the outbox."""
+    if wakeup is not None:
+        wakeup.set()
+
+
+def retry_delay(attempts: int) -> Optional[float]:
+    if attempts >= settings.outbox_max_attempts:
+        return None
+    delay = settings.outbox_retry_seconds * 2 ** (attempts - 1)
+    return delay * random.uniform(0.5, 1.5)
+
+
+async def process_batch(items: List[YoutubeOutbox]) -> None:
+    """Looks up the users, sinks and post texts of a batch with one query each,
+    then posts every item side by side."""
+    user_names = list({item.user for item in items})
+    sink_ids = list({item.sink_id for item in items if item.sink_id is not None})
+    async with async_session() as session:
+        users = await get_users_async(session, user_names)
+        sinks = await get_sinks_by_id_async(session, sink_ids) if sink_ids else {}
+        try:
+            with metrics.template_render_seconds.time():
+                templates = await get_post_templates_async(
+                    session, list(users), PostScheduleTime.on_new_video
+                )
+        except TemplateError:
+            # an invalid text saved by an older release, fail its items alone
+            templates = None
+    await asyncio.gather(
+        *(
+            process_item(item, users.get(item.user), sinks.get(item.sink_id), templates)
+            for item in items
+        )
+    )
+
+
+async def process_item(
+    item: YoutubeOutbox,
+    user: Optional[TwitterUser],
+    sink: Optional[Sink],
+    templates: Optional[Dict[str, Optional[ParsedTemplate]]],
+) -> None:
+    async with post_limit:
+        async with async_session() as session:
+            await post_item(session, item, user, sink, templates)
+
+
+async def post_item(
+    session: AsyncSession,
+    item: YoutubeOutbox,
+    user: Optional[TwitterUser],
+    sink: Optional[Sink],
+    templates: Optional[Dict[str, Optional[ParsedTemplate]]],
+) -> None:
+    if not user:
+        logger.warning("User not found", extra={"user": item.user})
+        await retry_outbox_async(session, item.id, f"User {item.user} not found", None)
+        return
+    if item.sink_id is not None and sink is None:
+        logger.warning("Sink not found", extra={"sink_id": item.sink_id})
+        await retry_outbox_async(
+            session, item.id, f"Sink {item.sink_id} not found", None
+        )
+        return
+    try:
+        if templates is None:
+            with metrics.template_render_seconds.time():
+                text = await get_on_youtube_post_async(
+                    session, item.title, item.link, item.user
+                )
+        elif templates.get(item.user):
+            text = render_template(
+                templates[item.user], title=item.title, link=item.link
+            )
+        else:
+            text = None
+        tweet_id = None
+        if text:
+            tweet_id = await publishers.publish(user, sink, text)
+        else:
+            logger.warning("No post text saved", extra={"user": item.user})
+    except RateLimited as e:
+        logger.info(
+            "Outbox item deferred", extra={"outbox_id": item.id, "error": str(e)}
+        )
+        await retry_outbox_async(
+            session, item.id, str(e), e.retry_in, count_attempt=False
+        )
+        return
+    except Exception as e:
+        retry_in = None if is_permanent(e) else retry_delay(item.attempts)
+        logger.warning(
+            "Outbox item failed",
+            extra={"outbox_id": item.id, "retry_in": retry_in, "error": str(e)},
+        )
+        await retry_outbox_async(session, item.id, str(e), retry_in)
+        return
+    await complete_outbox_async(session, item.id, tweet_id)
+
+
+async def run_worker() -> None:
+    while True:
+        wakeup.clear()
+        try:
+            async with async_session() as session:
+                items = await claim_outbox_async(
+                    session,
+                    settings.outbox_batch_size,
+                    settings.outbox_lock_seconds,
+                )
+            # one video fans out to many users, post them side by side
+            if items:
+                await process_batch(items)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Outbox worker error")
+            items = []
+        if not items:
+            try:
+                await asyncio.wait_for(
+                    wakeup.wait(), timeout=settings.outbox_poll_seconds
+                )
+            except asyncio.TimeoutError:
+                pass
+
+
+def start_workers() -> None:
+    global wakeup, post_limit
+    wakeup = asyncio.Event()
+    post_limit = asyncio.Semaphore(settings.post_concurrency)
+    for _ in range(settings.outbox_workers):
+        workers.append(asyncio.create_task(run_worker()))
+
+
+async def stop_workers() -> None:
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
@@ -1,47 +1,184 @@
-import aiohttp
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import re
+from typing import TYPE_CHECKING, AsyncIterable, Dict, List, NamedTuple, Optional
+
+from cachetools import TTLCache
+
+from app import metrics
 from app.config import settings
+from app.feed import FeedEntry, parse_feed
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# app-scoped client so hub requests reuse pooled keep-alive connections
+http_session: Optional[aiohttp.ClientSession] = None
+
+# digests of recently handled notifications, only used from the event loop
+recent_deliveries = TTLCache(
+    maxsize=settings.delivery_cache_size, ttl=settings.delivery_cache_seconds
+)
+
+# algorithms a hub may sign notifications with, as named in X-Hub-Signature
+SIGNATURE_ALGORITHMS = {"sha1", "sha256", "sha384", "sha512"}
+
+SELF_LINK = re.compile(r'<([^>]*)>\s*;\s*rel="?self"?')
+
+
+class Delivery(NamedTuple):
+    digest: str
+    # hex HMAC of the body, if a secret was given
+    signature: Optional[str]
+    entries: List[FeedEntry]
+
+
+def channel_topics(channel_id: str) -> list[str]:
+    """The feed URLs a channel's notifications can be subscribed as."""
+    return [
+        f"https://www.youtube.com/xml/feeds/videos.xml?channel_id={channel_id}",
+        f"https://www.youtube.com/feeds/videos.xml?channel_id={channel_id}",
+    ]
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    # imported on the first hub request, it is slow to import
+    import aiohttp
+
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=settings.http_pool_size,
+            keepalive_timeout=settings.http_keepalive_seconds,
+        ),
+        timeout=aiohttp.ClientTimeout(total=settings.http_timeout_seconds),
+    )
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+
+async def close_http_session() -> None:
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+
+def topic_secret(topic: str) -> str:
+    """The hub.secret of a subscription, derived from the app's secret key so
+    each topic has its own without storing it."""
+    return hmac.new(
+        settings.secret_key.encode(), topic.encode(), hashlib.sha256
+    ).hexdigest()
+
 
+def self_topic(link_header: Optional[str]) -> Optional[str]:
+    """The topic of a notification, from the rel="self" Link header."""
+    match = SELF_LINK.search(link_header or "")
+    return match.group(1) if match else None
 
-async def resubscribe(topic: str):
-    print(f"Resubscribing to {topic}")
-    async with aiohttp.ClientSession() as session:
-        data = {
-            "hub.callback": f"{settings.base_url}/youtube/hook",
-            "hub.mode": "subscribe",
-            "hub.topic": topic,
-            "hub.verify": "async",
-            "hub.verify_token": settings.youtube_verify_token,
-        }
-        print(data)
-        async with session.post(
-            "https://pubsubhubbub.appspot.com/subscribe",
-            data=data,
-        ) as resp:
+
+async def read_delivery(
+    chunks: AsyncIterable[bytes],
+    max_bytes: int,
+    max_entries: int,
+    secret: Optional[str] = None,
+    algorithm: str = "sha1",
+) -> Delivery:
+    """Reads and parses a notification body in one pass, hashing it as it
+    arrives.
+
+    Each chunk goes to the incremental feed parser once it is hashed, so a body
+    that isn't an Atom feed or is over the limits is abandoned unread, and only
+    the parsed entries are kept, never the whole body. The signature and digest
+    are only known once the body is read, so forged and re-delivered
+    notifications are parsed too, within the same limits; they are rejected
+    before anything is queued.
+
+    Raises FeedTooLarge, FeedError or ParseError like parse_feed.
+    """
+    digest = hashlib.sha256()
+    mac = hmac.new(secret.encode(), digestmod=algorithm) if secret else None
+
+    async def hashed():
+        async for chunk in chunks:
+            digest.update(chunk)
+            if mac:
+                mac.update(chunk)
+            yield chunk
+
+    entries = [entry async for entry in parse_feed(hashed(), max_bytes, max_entries)]
+    return Delivery(digest.hexdigest(), mac.hexdigest() if mac else None, entries)
+
+
+def is_duplicate(delivery: Delivery) -> bool:
+    return delivery.digest in recent_deliveries
+
+
+def remember_delivery(delivery: Delivery) -> None:
+    recent_deliveries[delivery.digest] = True
+
+
+async def hub_request(
+    mode: str, topic: str, session: Optional[aiohttp.ClientSession] = None
+):
+    session = session or get_http_session()
+    data = {
+        "hub.callback": f"{settings.base_url}/youtube/hook",
+        "hub.mode": mode,
+        "hub.topic": topic,
+        "hub.verify": "async",
+        "hub.verify_token": settings.youtube_verify_token,
+        "hub.secret": topic_secret(topic),
+    }
+    logger.debug("Sending hub request", extra={"mode": mode, "topic": topic})
+    with metrics.hub_request_seconds.time(mode=mode, result="error") as labels:
+        async with session.post(settings.hub_url, data=data) as resp:
             if resp.ok:
-                print(f"Resubscribed to {topic}")
+                labels["result"] = "ok"
+                logger.info("Sent hub request", extra={"mode": mode, "topic": topic})
             else:
                 raise Exception(
-                    f"Failed to resubscribe to {topic} with status {resp.status}: {await resp.text()}"
+                    f"Failed to {mode} to {topic} with status {resp.status}: {await resp.text()}"
                 )
 
-async def unsubscribe(topic: str):
-    print(f"Resubscribing to {topic}")
-    async with aiohttp.ClientSession() as session:
-        data = {
-            "hub.callback": f"{settings.base_url}/youtube/hook",
-            "hub.mode": "unsubscribe",
-            "hub.topic": topic,
-            "hub.verify": "async",
-            "hub.verify_token": settings.youtube_verify_token,
-        }
-        print(data)
-        async with session.post(
-            "https://pubsubhubbub.appspot.com/subscribe",
-            data=data,
-        ) as resp:
-            if resp.ok:
-                print(f"Resubscribed to {topic}")
-            else:
-                raise Exception(
-                    f"Failed to resubscribe to {topic} with status {resp.status}: {await resp.text()}"
-                )
\ No newline at end of file
+
+async def resubscribe(topic: str, session: Optional[aiohttp.ClientSession] = None):
+    logger.debug("Resubscribing", extra={"topic": topic})
+    await hub_request("subscribe", topic, session)
+
+
+async def unsubscribe(topic: str, session: Optional[aiohttp.ClientSession] = None):
+    logger.debug("Unsubscribing", extra={"topic": topic})
+    await hub_request("unsubscribe", topic, session)
+
+
+async def resubscribe_all(
+    topics: List[str], session: Optional[aiohttp.ClientSession] = None
+) -> Dict[str, Optional[Exception]]:
+    """Renews many topics concurrently, at most `hub_concurrency` at a time.
+
+    Returns the error raised for each topic, or None if it was renewed.
+    """
+    limit = asyncio.Semaphore(settings.hub_concurrency)
+
+    async def renew(topic: str) -> Optional[Exception]:
+        async with limit:
+            try:
+                await resubscribe(topic, session)
+            except Exception as e:
+                return e
+        return None
+
+    results = await asyncio.gather(*(renew(topic) for topic in topics))
+    return dict(zip(topics, results))
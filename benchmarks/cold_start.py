@@ -0,0 +1,122 @@
+"""Import-time and startup profile of the app, as seen by a fresh worker.
+
+    python -m benchmarks.cold_start --runs 5
+    python -m benchmarks.cold_start --profile 30
+
+Every run starts a new interpreter that imports app.main and runs the
+lifespan startup until the app is ready to serve, like a uvicorn worker does.
+The first run boots on an empty database (schema and seed work), the others
+are restarts. Reports the median import and startup time of the restarts, the
+top-level imports that cost the most (from `python -X importtime`), and with
+--profile the functions the startup spends its time in.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+BOOT = """
+import asyncio, json, time
+start = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+
+async def boot():
+    async with app.main.app.router.lifespan_context(app.main.app):
+        return time.perf_counter()
+
+ready = asyncio.run(boot())
+print(json.dumps({"import": imported - start, "startup": ready - imported}))
+"""
+
+PROFILE = """
+import asyncio, cProfile, pstats
+import app.main
+
+async def boot():
+    async with app.main.app.router.lifespan_context(app.main.app):
+        pass
+
+profile = cProfile.Profile()
+profile.runcall(asyncio.run, boot())
+pstats.Stats(profile).sort_stats("cumulative").print_stats({limit})
+"""
+
+IMPORT_LINE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)")
+
+
+def run(code: str, env: dict, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def top_imports(env: dict, limit: int) -> list:
+    """Modules imported directly by app.main, by cumulative microseconds."""
+    lines = run("import app.main", env, "-X", "importtime").stderr.splitlines()
+    parsed = [match.groups() for match in map(IMPORT_LINE.match, lines) if match]
+    # a module is listed after everything it imported, one level deeper
+    main = next(i for i, (_, _, name) in enumerate(parsed) if name == "app.main")
+    depth = len(parsed[main][1])
+    imports = []
+    for micros, indent, name in reversed(parsed[:main]):
+        if len(indent) <= depth:
+            break
+        if len(indent) == depth + 2:
+            imports.append((int(micros), name))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--imports", type=int, default=15, help="imports to list")
+    parser.add_argument("--profile", type=int, help="list this many functions")
+    parser.add_argument("--db", default="sqlite:///./bench.sqlite3")
+    args = parser.parse_args()
+
+    env = dict(
+        os.environ,
+        DB_CONNECTION_STRING=args.db,
+        # renewals at boot fail fast instead of reaching the real hub
+        HUB_URL="http://127.0.0.1:9/subscribe",
+        LOG_LEVEL="WARNING",
+    )
+    if args.db.startswith("sqlite:///"):
+        # with the WAL and shared memory files of the journal
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db[10:] + suffix):
+                os.remove(args.db[10:] + suffix)
+
+    runs = [
+        json.loads(run(BOOT, env).stdout.splitlines()[-1]) for _ in range(args.runs)
+    ]
+    first, restarts = runs[0], runs[1:] or runs
+    print(f"{'':<14}{'import ms':>10}{'startup ms':>12}")
+    print(
+        f"{'first boot':<14}{first['import'] * 1000:>10.0f}{first['startup'] * 1000:>12.0f}"
+    )
+    print(
+        f"{'restart p50':<14}"
+        f"{statistics.median(r['import'] for r in restarts) * 1000:>10.0f}"
+        f"{statistics.median(r['startup'] for r in restarts) * 1000:>12.0f}"
+    )
+
+    print(f"\n{'import':<40}{'ms':>8}")
+    for micros, module in top_imports(env, args.imports):
+        print(f"{module:<40}{micros / 1000:>8.1f}")
+
+    if args.profile:
+        print(run(PROFILE.format(limit=args.profile), env).stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""Load test of the hook-to-tweet pipeline against a fake hub and Twitter API.
+
+    python -m benchmarks.hook_pipeline --deliveries 500 --concurrency 20
+    python -m benchmarks.hook_pipeline --save benchmarks/baseline.json
+    python -m benchmarks.hook_pipeline --compare benchmarks/baseline.json
+
+Runs the app under uvicorn on a local port, with its own sqlite database. A
+fake Twitter client with tunable latency and error rate stands in for
+tweepy.Client, and a local fake hub answers subscriptions and sends the
+verification GET back to the app. The load generator posts synthetic Atom
+deliveries (some re-delivered) and verification requests at the given
+concurrency, waits for every video to be tweeted, and reports throughput and
+p50/p95/p99 latency for each stage:
+
+    hook        POST /youtube/hook response time
+    queue       from the hook's reply until the tweet is sent
+    tweet       the Twitter API call
+    end_to_end  from sending the delivery until the tweet is posted
+    verify      GET /youtube/hook (lease verification) response time
+    resubscribe POST /youtube/resubscribe until the hub has verified it
+
+Everything shares one machine, so compare runs made on the same machine only.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+from typing import Dict, List
+
+feed_xml = """<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015"
+        xmlns="http://www.w3.org/2005/Atom">
+<link rel="hub" href="https://pubsubhubbub.appspot.com"/>
+<link rel="self" href="https://www.youtube.com/xml/feeds/videos.xml?channel_id={channel}"/>
+<title>YouTube video feed</title>
+<updated>{published}</updated>
+{entries}
+</feed>"""
+
+entry_xml = """<entry>
+    <id>yt:video:{video}</id>
+    <yt:videoId>{video}</yt:videoId>
+    <yt:channelId>{channel}</yt:channelId>
+    <title>Video {video}</title>
+    <link rel="alternate" href="http://www.youtube.com/watch?v={video}"/>
+    <author><name>Channel {channel}</name></author>
+    <published>{published}</published>
+    <updated>{published}</updated>
+</entry>"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+
+    def at(p: float) -> float:
+        return samples[round(p / 100 * (len(samples) - 1))] * 1000
+
+    return {"count": len(samples), "p50": at(50), "p95": at(95), "p99": at(99)}
+
+
+def make_delivery(channel: str, videos: List[str]) -> str:
+    published = datetime.datetime.now(datetime.UTC).isoformat()
+    entries = "".join(
+        entry_xml.format(video=video, channel=channel, published=published)
+        for video in videos
+    )
+    return feed_xml.format(channel=channel, published=published, entries=entries)
+
+
+class FakeTwitter:
+    """Stands in for tweepy.Client, one shared instance for every user."""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.posted: Dict[str, float] = {}
+        self.durations: List[float] = []
+        self.started: Dict[str, float] = {}
+
+    def create_tweet(self, text: str):
+        import requests
+        import tweepy
+
+        start = time.perf_counter()
+        link = re.search(r"http://www\.youtube\.com/watch\?v=\S+", text).group()
+        with self.lock:
+            self.started.setdefault(link, start)
+        time.sleep(random.expovariate(1 / self.latency) if self.latency else 0)
+        if random.random() < self.error_rate:
+            response = requests.Response()
+            response.status_code = 503
+            response.reason = "Service Unavailable"
+            response._content = b"{}"
+            raise tweepy.TwitterServerError(response)
+        with self.lock:
+            self.durations.append(time.perf_counter() - start)
+            self.posted[link] = time.perf_counter()
+        response = requests.Response()
+        response.status_code = 201
+        response._content = b'{"data": {"id": "1", "text": ""}}'
+        return response
+
+
+async def start_fake_hub(port: int, verified: Dict[str, float]):
+    """A hub that accepts every subscription and verifies it right away."""
+    import aiohttp
+    from aiohttp import web
+
+    session = aiohttp.ClientSession()
+
+    async def verify(form):
+        params = {
+            "hub.mode": form["hub.mode"],
+            "hub.topic": form["hub.topic"],
+            "hub.challenge": str(random.random()),
+            "hub.verify_token": form["hub.verify_token"],
+            "hub.lease_seconds": "432000",
+        }
+        async with session.get(form["hub.callback"], params=params) as resp:
+            await resp.read()
+        verified[form["hub.topic"]] = time.perf_counter()
+
+    async def subscribe(request):
+        form = await request.post()
+        asyncio.get_running_loop().create_task(verify(dict(form)))
+        return web.Response(status=202)
+
+    hub = web.Application()
+    hub.router.add_post("/subscribe", subscribe)
+    runner = web.AppRunner(hub)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, session
+
+
+async def run(args) -> dict:
+    import aiohttp
+    import uvicorn
+    from unittest.mock import patch
+
+    from app.config import settings
+    from app.main import app
+
+    twitter = FakeTwitter(args.twitter_latency, args.twitter_error_rate)
+    hub_verified: Dict[str, float] = {}
+    hub_runner, hub_session = await start_fake_hub(args.hub_port, hub_verified)
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning")
+    )
+    patcher = patch("app.bot.get_twitter_client", return_value=twitter)
+    patcher.start()
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    samples: Dict[str, List[float]] = {
+        "hook": [],
+        "verify": [],
+        "resubscribe": [],
+    }
+    replied: Dict[str, float] = {}
+    sent: Dict[str, float] = {}
+    deliveries = []
+    for n in range(args.deliveries):
+        if deliveries and random.random() < args.redeliver:
+            deliveries.append(random.choice(deliveries))
+            continue
+        videos = [f"BENCH_{args.seed}_{n}_{e}" for e in range(args.entries)]
+        deliveries.append((f"CHANNEL_{n % args.channels}", videos))
+
+    limit = asyncio.Semaphore(args.concurrency)
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(base_url) as client:
+
+        async def deliver(channel: str, videos: List[str]):
+            async with limit:
+                body = make_delivery(channel, videos)
+                begin = time.perf_counter()
+                for video in videos:
+                    sent.setdefault(f"http://www.youtube.com/watch?v={video}", begin)
+                async with client.post(
+                    "/youtube/hook",
+                    data=body,
+                    headers={"content-type": "application/atom+xml"},
+                ) as resp:
+                    await resp.read()
+                    assert resp.status == 200, await resp.text()
+                end = time.perf_counter()
+                samples["hook"].append(end - begin)
+                for video in videos:
+                    replied.setdefault(f"http://www.youtube.com/watch?v={video}", end)
+
+        async def verification(n: int):
+            async with limit:
+                params = {
+                    "hub.mode": "subscribe",
+                    "hub.challenge": str(n),
+                    "hub.verify_token": settings.youtube_verify_token,
+                    "hub.lease_seconds": "432000",
+                    "hub.topic": f"https://www.youtube.com/xml/feeds/videos.xml?channel_id=CHANNEL_{n % args.channels}",
+                }
+                begin = time.perf_counter()
+                async with client.get("/youtube/hook", params=params) as resp:
+                    assert await resp.text() == str(n)
+                samples["verify"].append(time.perf_counter() - begin)
+
+        async def resubscription():
+            async with limit:
+                hub_verified.clear()
+                begin = time.perf_counter()
+                async with client.post("/youtube/resubscribe") as resp:
+                    await resp.read()
+                while not hub_verified:
+                    await asyncio.sleep(0.001)
+                samples["resubscribe"].append(next(iter(hub_verified.values())) - begin)
+
+        jobs = [deliver(channel, videos) for channel, videos in deliveries]
+        jobs += [verification(n) for n in range(args.verifications)]
+        random.shuffle(jobs)
+        await asyncio.gather(*jobs)
+        for _ in range(args.resubscriptions):
+            await resubscription()
+        hook_seconds = time.perf_counter() - start
+
+        expected = len(sent)
+        deadline = time.perf_counter() + args.timeout
+        while len(twitter.posted) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+    total_seconds = time.perf_counter() - start
+
+    server.should_exit = True
+    await server_task
+    patcher.stop()
+    await hub_session.close()
+    await hub_runner.cleanup()
+
+    posted = dict(twitter.posted)
+    samples["tweet"] = twitter.durations
+    samples["queue"] = [
+        twitter.started[link] - replied[link] for link in posted if link in replied
+    ]
+    samples["end_to_end"] = [posted[link] - sent[link] for link in posted]
+    return {
+        "params": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("save", "compare", "port", "hub_port")
+        },
+        "throughput": {
+            "deliveries_per_second": len(deliveries) / hook_seconds,
+            "tweets_per_second": len(posted) / total_seconds,
+            "tweets": len(posted),
+            "videos": expected,
+        },
+        "stages": {stage: percentiles(values) for stage, values in samples.items()},
+    }
+
+
+def report(result: dict, baseline: dict = None) -> None:
+    throughput = result["throughput"]
+    print(
+        f"{throughput['deliveries_per_second']:.1f} deliveries/s, "
+        f"{throughput['tweets_per_second']:.1f} tweets/s, "
+        f"{throughput['tweets']}/{throughput['videos']} videos tweeted"
+    )
+    print(f"{'stage':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in result["stages"].items():
+        line = (
+            f"{stage:<12}{stats['count']:>7}"
+            f"{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}"
+        )
+        if baseline and stage in baseline["stages"]:
+            before = baseline["stages"][stage]["p95"]
+            if before:
+                line += f"   p95 {(stats['p95'] - before) / before:+.0%} vs baseline"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--deliveries", type=int, default=300)
+    parser.add_argument("--entries", type=int, default=1, help="videos per delivery")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--redeliver", type=float, default=0.2)
+    parser.add_argument("--verifications", type=int, default=100)
+    parser.add_argument("--resubscriptions", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--twitter-latency", type=float, default=0.2)
+    parser.add_argument("--twitter-error-rate", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", default="sqlite:///./bench.sqlite3")
+    parser.add_argument("--port", type=int, default=free_port())
+    parser.add_argument("--hub-port", type=int, default=free_port())
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results to compare with")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # must be set before the app reads its settings
+    os.environ.update(
+        {
+            "DB_CONNECTION_STRING": args.db,
+            "BASE_URL": f"http://127.0.0.1:{args.port}",
+            "HUB_URL": f"http://127.0.0.1:{args.hub_port}/subscribe",
+            "OUTBOX_RETRY_SECONDS": "0.1",
+            "TWITTER_USER_POSTS_PER_WINDOW": "1000000000",
+            "TWITTER_APP_POSTS_PER_WINDOW": "1000000000",
+            "LOG_LEVEL": "WARNING",
+        }
+    )
+    if args.db.startswith("sqlite:///"):
+        # with the WAL and shared memory files of the journal
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db[10:] + suffix):
+                os.remove(args.db[10:] + suffix)
+
+    # the app logs every request, keep the report readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Query plans and latency of the hot lookups on a large database.
+
+    python -m benchmarks.query_plans --users 100000 --uploads 1000000
+    python -m benchmarks.query_plans --without-indexes
+
+Fills a fresh database (a sqlite file by default, --url for Postgres) with
+synthetic users, post texts and uploads, then prints the plan and the
+p50/p95 latency of every query the hook, the outbox workers and the lease
+scheduler run. --without-indexes drops the non-unique indexes first, to compare
+with the schema before migration 1.
+"""
+
+import argparse
+import datetime
+import os
+import statistics
+import time
+
+from sqlalchemy import create_engine, text
+from sqlmodel import Session, SQLModel, func, select
+
+from app.db import (
+    PostScheduleTime,
+    PostText,
+    TwitterUser,
+    YoutubeUpload,
+    claim_posts,
+    get_topic_leases,
+    get_upload_history,
+    get_topic_users,
+    get_user,
+    twitter_users,
+)
+from app.migrations import migrate
+
+BATCH = 50_000
+
+
+def topic(n: int) -> str:
+    return f"https://www.youtube.com/xml/feeds/videos.xml?channel_id=CHANNEL_{n}"
+
+
+def fill(engine, users: int, uploads: int) -> None:
+    now = datetime.datetime.now()
+    with engine.begin() as connection:
+        for start in range(0, users, BATCH):
+            rows = range(start, min(start + BATCH, users))
+            connection.execute(
+                TwitterUser.__table__.insert(),
+                [
+                    {
+                        "user": f"user_{n}",
+                        "access_token": "token",
+                        "access_token_secret": "secret",
+                        "lease_date": now + datetime.timedelta(minutes=n % 7200),
+                        "lease_updated_at": now - datetime.timedelta(minutes=n % 7200),
+                        "hub_topic": topic(n // 2),
+                    }
+                    for n in rows
+                ],
+            )
+            connection.execute(
+                PostText.__table__.insert(),
+                [
+                    {
+                        "text": "{title} {link}",
+                        "user": f"user_{n}",
+                        "post_trigger": PostScheduleTime.on_new_video.name,
+                        "post_time": None,
+                    }
+                    for n in rows
+                ],
+            )
+        for start in range(0, uploads, BATCH):
+            connection.execute(
+                YoutubeUpload.__table__.insert(),
+                [
+                    {
+                        "link": f"http://www.youtube.com/watch?v=VIDEO_{n}",
+                        "user": f"user_{n % max(users, 1)}",
+                        "posted_at": now - datetime.timedelta(minutes=uploads - n),
+                    }
+                    for n in range(start, min(start + BATCH, uploads))
+                ],
+            )
+
+
+def drop_indexes(engine) -> None:
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                # claim_posts needs the unique index on links
+                if not index.unique:
+                    index.drop(connection, checkfirst=True)
+
+
+def explain(session: Session, statement) -> str:
+    dialect = session.get_bind().dialect
+    sql = str(
+        statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+    )
+    if dialect.name == "sqlite":
+        rows = session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        return "\n".join(f"    {row[-1]}" for row in rows)
+    rows = session.execute(text(f"EXPLAIN ANALYZE {sql}")).all()
+    return "\n".join(f"    {row[0]}" for row in rows)
+
+
+def uncached_get_user(session: Session, user_name: str):
+    # every run queries, a cache hit would say nothing about the plan
+    twitter_users.clear()
+    return get_user(session, user_name)
+
+
+def measure(run, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="sqlite:///./bench.sqlite3")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--uploads", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--without-indexes", action="store_true")
+    args = parser.parse_args()
+
+    if args.url.startswith("sqlite:///") and os.path.exists(args.url[10:]):
+        os.remove(args.url[10:])
+    engine = create_engine(args.url)
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    migrate(engine)
+    start = time.perf_counter()
+    fill(engine, args.users, args.uploads)
+    print(
+        f"Filled {args.users} users and {args.uploads} uploads "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    if args.without_indexes:
+        drop_indexes(engine)
+
+    middle = args.users // 2
+    check_since = datetime.datetime.now() - datetime.timedelta(minutes=10)
+    queries = [
+        (
+            "get_user",
+            select(TwitterUser).where(TwitterUser.user == f"user_{middle}"),
+            lambda session: uncached_get_user(session, f"user_{middle}"),
+        ),
+        (
+            "get_topic_users",
+            select(TwitterUser.user).where(
+                TwitterUser.hub_topic.in_([topic(middle // 2)])
+            ),
+            lambda session: get_topic_users(session, [topic(middle // 2)]),
+        ),
+        (
+            "post template",
+            select(PostText).where(
+                PostText.user == f"user_{middle}",
+                PostText.post_trigger == PostScheduleTime.on_new_video,
+            ),
+            lambda session: session.exec(
+                select(PostText).where(
+                    PostText.user == f"user_{middle}",
+                    PostText.post_trigger == PostScheduleTime.on_new_video,
+                )
+            ).first(),
+        ),
+        (
+            "claim_posts (already posted)",
+            select(YoutubeUpload.link).where(
+                YoutubeUpload.link.in_(
+                    [f"http://www.youtube.com/watch?v=VIDEO_{middle}"]
+                )
+            ),
+            lambda session: claim_posts(
+                session,
+                [f"http://www.youtube.com/watch?v=VIDEO_{middle}"],
+                [f"user_{middle}"],
+            ),
+        ),
+        (
+            "upload history (deep page)",
+            select(YoutubeUpload)
+            .where(YoutubeUpload.user == f"user_{middle}", YoutubeUpload.id < middle)
+            .order_by(YoutubeUpload.id.desc())
+            .limit(50),
+            lambda session: get_upload_history(
+                session, 50, f"user_{middle}", before=middle
+            ),
+        ),
+        (
+            "get_topic_leases",
+            select(TwitterUser.hub_topic, func.min(TwitterUser.lease_date))
+            .where(
+                TwitterUser.hub_topic.is_not(None), TwitterUser.lease_date.is_not(None)
+            )
+            .group_by(TwitterUser.hub_topic),
+            get_topic_leases,
+        ),
+        (
+            "get_topic_leases (changed in the last check interval)",
+            select(TwitterUser.hub_topic, func.min(TwitterUser.lease_date))
+            .where(
+                TwitterUser.hub_topic.is_not(None),
+                TwitterUser.lease_date.is_not(None),
+                TwitterUser.hub_topic.in_(
+                    select(TwitterUser.hub_topic).where(
+                        TwitterUser.lease_updated_at >= check_since
+                    )
+                ),
+            )
+            .group_by(TwitterUser.hub_topic),
+            lambda session: get_topic_leases(session, check_since),
+        ),
+    ]
+    with Session(engine) as session:
+        for name, statement, run in queries:
+            repeat = args.repeat if name != "get_topic_leases" else 5
+            p50, p95 = measure(lambda: run(session), repeat)
+            session.rollback()
+            print(f"{name}: p50 {p50:.3f}ms p95 {p95:.3f}ms")
+            print(explain(session, statement))
+
+
+if __name__ == "__main__":
+    main()
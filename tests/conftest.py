@@ -0,0 +1,28 @@
+import socket
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+
+
+@pytest.fixture
+def http_server():
+    """Serves an aiohttp app on a free local port, as a stand-in for a remote
+    service. Used as `async with http_server(app) as url`, inside the test's
+    event loop."""
+
+    @asynccontextmanager
+    async def serve(app: web.Application):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.SockSite(runner, sock).start()
+            yield f"http://127.0.0.1:{port}"
+        finally:
+            await runner.cleanup()
+            sock.close()
+
+    return serve
@@ -1,13 +1,28 @@
 import asyncio
 import datetime
+import hashlib
+import hmac
+import time
 from fastapi.testclient import TestClient
 from unittest.mock import MagicMock, patch
 
 import pytest
-from sqlmodel import SQLModel
+from sqlmodel import Session, SQLModel, select
 from app.config import settings
-from app.db import PostScheduleTime, engine
+from app import publishers
+from app.db import (
+    OutboxStatus,
+    PostScheduleTime,
+    PostText,
+    ScheduledPostStatus,
+    SinkKind,
+    TwitterUser,
+    YoutubeOutbox,
+    engine,
+    posted_links,
+)
 from app.main import app
+from app.youtube import recent_deliveries, topic_secret
 from app.models import Post  # Import your FastAPI app
 
 # Simulating a YouTube notification
@@ -46,6 +61,19 @@ def client():
     SQLModel.metadata.drop_all(engine)
 
 
+def wait_for_outbox(timeout: float = 5):
+    """Waits until the outbox workers have picked up every queued video."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with Session(engine) as session:
+            if not session.exec(
+                select(YoutubeOutbox).where(YoutubeOutbox.status != OutboxStatus.failed)
+            ).first():
+                return
+        time.sleep(0.05)
+    raise AssertionError("outbox was not drained")
+
+
 def test_youtube_invalid_verify_token(client: TestClient):
     # Simulating YouTube's subscription verification request
     response = client.get(
@@ -93,7 +121,7 @@ def test_youtube_hook_ignores_old_request(client: TestClient):
     assert response.json() == {"message": "Received"}
 
 
-@patch("app.main.bot.get_twitter_client")
+@patch("app.bot.get_twitter_client")
 def test_youtube_hook_submits_new_request(get_twitter_client, client: TestClient):
     get_twitter_client.return_value = MagicMock()
 
@@ -110,8 +138,11 @@ def test_youtube_hook_submits_new_request(get_twitter_client, client: TestClient
     assert response.status_code == 200
     assert response.json() == {"message": "Received"}
 
+    wait_for_outbox()
+    get_twitter_client.return_value.create_tweet.assert_called_once()
+
 
-@patch("app.main.get_user")
+@patch("app.main.get_user_async")
 @patch("aiohttp.ClientSession.post")
 def test_youtube_resubscribe_user_found(mock_post, mock_get_user, client: TestClient):
     # Mock the response from YouTube
@@ -130,7 +161,7 @@ def test_youtube_resubscribe_user_found(mock_post, mock_get_user, client: TestCl
     assert response.json() == {"message": "Resubscribed"}
 
 
-@patch("app.main.get_user")
+@patch("app.main.get_user_async")
 @patch("aiohttp.ClientSession.post")
 def test_youtube_resubscribe_user_not_found(
     mock_post, mock_get_user, client: TestClient
@@ -149,7 +180,7 @@ def test_youtube_resubscribe_user_not_found(
     assert response.json() == {"message": "User not found"}
 
 
-@patch("app.main.get_on_youtube_post")
+@patch("app.main.get_on_youtube_post_async")
 def test_get_posts_by_user(mock_get_on_youtube_post, client: TestClient):
     mock_get_on_youtube_post.return_value = "Test post text"
 
@@ -158,7 +189,7 @@ def test_get_posts_by_user(mock_get_on_youtube_post, client: TestClient):
     assert response.json() == "Test post text"
 
 
-@patch("app.main.create_update_on_youtube_post")
+@patch("app.main.create_update_on_youtube_post_async")
 def test_set_posts_by_user(mock_create_update_on_youtube_post, client: TestClient):
     post_data = {
         "text": "Test post text",
@@ -209,3 +240,400 @@ def test_create_and_update_post(client: TestClient):
     response = client.get("/posts/testuser")
     assert response.status_code == 200
     assert response.json() == "Updated test post text"
+
+
+@patch("app.bot.get_twitter_client")
+def test_outbox_retries_failed_tweet(get_twitter_client, client: TestClient):
+    api = get_twitter_client.return_value
+    api.create_tweet.side_effect = [Exception("Twitter is down"), None]
+
+    with patch("app.worker.retry_delay", return_value=0):
+        response = client.post(
+            "/youtube/hook",
+            content=xml_data.format(
+                published_date=(
+                    datetime.datetime.utcnow() - datetime.timedelta(minutes=2)
+                ).isoformat()
+            ).replace("VIDEO_ID", "RETRY_VIDEO_ID"),
+            headers={"content-type": "application/atom+xml"},
+        )
+        assert response.status_code == 200
+        wait_for_outbox()
+
+    assert api.create_tweet.call_count == 2
+
+
+@patch("app.bot.get_twitter_client")
+def test_youtube_hook_posts_redelivered_video_once(
+    get_twitter_client, client: TestClient
+):
+    content = xml_data.format(
+        published_date=(
+            datetime.datetime.utcnow() - datetime.timedelta(minutes=2)
+        ).isoformat()
+    ).replace("VIDEO_ID", "REDELIVERED_VIDEO_ID")
+    headers = {"content-type": "application/atom+xml"}
+
+    assert client.post("/youtube/hook", content=content, headers=headers).is_success
+    # forget the in-memory caches so the second delivery hits the unique index
+    recent_deliveries.clear()
+    posted_links.clear()
+    assert client.post("/youtube/hook", content=content, headers=headers).is_success
+    # and the third the cache of posted links
+    recent_deliveries.clear()
+    with patch("app.db.claim_posts") as claim_posts:
+        response = client.post("/youtube/hook", content=content, headers=headers)
+        assert response.is_success
+        claim_posts.assert_not_called()
+    wait_for_outbox()
+
+    get_twitter_client.return_value.create_tweet.assert_called_once()
+
+
+def test_set_posts_rejects_invalid_template(client: TestClient):
+    post_data = {
+        "text": "New video {video_title}",
+        "user_name": "testuser",
+        "post_trigger": PostScheduleTime.on_new_video,
+        "post_time": None,
+    }
+    response = client.post("/posts", json=post_data)
+    assert response.status_code == 400
+    assert "video_title" in response.text
+
+
+@patch("app.bot.get_twitter_client")
+def test_youtube_hook_fans_out_to_topic_users(get_twitter_client, client: TestClient):
+    api = MagicMock()
+    posted_as = set()
+
+    def twitter_client(config, user):
+        posted_as.add(user.user)
+        return api
+
+    get_twitter_client.side_effect = twitter_client
+    topic = "https://www.youtube.com/xml/feeds/videos.xml?channel_id=FANOUT_CHANNEL"
+    with Session(engine) as session:
+        for user_name in ("fanout_a", "fanout_b"):
+            session.add(TwitterUser(user=user_name, hub_topic=topic))
+        session.commit()
+    for user_name in ("fanout_a", "fanout_b"):
+        post_data = {
+            "text": f"{user_name} {{link}}",
+            "user_name": user_name,
+            "post_trigger": PostScheduleTime.on_new_video,
+        }
+        assert client.post("/posts", json=post_data).status_code == 200
+
+    response = client.post(
+        "/youtube/hook",
+        content=xml_data.format(
+            published_date=(
+                datetime.datetime.utcnow() - datetime.timedelta(minutes=2)
+            ).isoformat()
+        )
+        .replace("CHANNEL_ID", "FANOUT_CHANNEL")
+        .replace("VIDEO_ID", "FANOUT_VIDEO_ID"),
+        headers={"content-type": "application/atom+xml"},
+    )
+    assert response.status_code == 200
+    wait_for_outbox()
+
+    assert posted_as == {"fanout_a", "fanout_b"}
+    texts = {call.kwargs["text"] for call in api.create_tweet.call_args_list}
+    assert texts == {
+        "fanout_a http://www.youtube.com/watch?v=FANOUT_VIDEO_ID",
+        "fanout_b http://www.youtube.com/watch?v=FANOUT_VIDEO_ID",
+    }
+
+
+@patch("app.bot.get_twitter_client")
+def test_youtube_hook_publishes_to_every_sink(get_twitter_client, client: TestClient):
+    discord_calls = []
+
+    async def failing_discord(user, sink, text):
+        discord_calls.append(sink.url)
+        # a slow sink that fails for good
+        await asyncio.sleep(0.2)
+        raise publishers.SinkRejected("Unknown Webhook")
+
+    topic = "https://www.youtube.com/xml/feeds/videos.xml?channel_id=SINK_CHANNEL"
+    with Session(engine) as session:
+        session.add(TwitterUser(user="sink_user", hub_topic=topic))
+        session.commit()
+    client.post(
+        "/posts",
+        json={
+            "text": "{link}",
+            "user_name": "sink_user",
+            "post_trigger": PostScheduleTime.on_new_video,
+        },
+    )
+    for url in (
+        None,
+        "http://127.0.0.1/api/webhooks/1/token",
+        "https://discord.com.evil.example/api/webhooks/1/token",
+        "https://discord.com/api/users/1",
+    ):
+        response = client.post(
+            "/sinks", json={"user_name": "sink_user", "kind": "discord", "url": url}
+        )
+        assert response.status_code == 422
+    # a Discord sink alone, the user's Twitter account stays a sink
+    sink = {
+        "user_name": "sink_user",
+        "kind": "discord",
+        "url": "https://discord.com/api/webhooks/1/token",
+    }
+    assert client.post("/sinks", json=sink).status_code == 200
+    sinks = client.get("/sinks/sink_user").json()
+    assert [sink["kind"] for sink in sinks] == ["discord"]
+
+    with patch.dict("app.publishers.PUBLISHERS", {SinkKind.discord: failing_discord}):
+        response = client.post(
+            "/youtube/hook",
+            content=xml_data.format(
+                published_date=(
+                    datetime.datetime.utcnow() - datetime.timedelta(minutes=2)
+                ).isoformat()
+            )
+            .replace("CHANNEL_ID", "SINK_CHANNEL")
+            .replace("VIDEO_ID", "SINK_VIDEO_ID"),
+            headers={"content-type": "application/atom+xml"},
+        )
+        assert response.status_code == 200
+        wait_for_outbox()
+
+    get_twitter_client.return_value.create_tweet.assert_called_once_with(
+        text="http://www.youtube.com/watch?v=SINK_VIDEO_ID"
+    )
+    assert discord_calls == ["https://discord.com/api/webhooks/1/token"]
+    with Session(engine) as session:
+        items = session.exec(
+            select(YoutubeOutbox).where(YoutubeOutbox.user == "sink_user")
+        ).all()
+    # the Twitter item is done, the Discord one failed on its own
+    assert [item.sink_id for item in items] == [sinks[0]["id"]]
+    assert items[0].status == OutboxStatus.failed
+    # the failed sink doesn't hide the post
+    history = client.get("/history", params={"user_name": "sink_user"}).json()
+    assert [item["status"] for item in history["items"]] == ["posted"]
+    # and each sink's outcome is kept
+    outcomes = {
+        (result["sink_id"], result["status"]) for result in history["items"][0]["sinks"]
+    }
+    assert outcomes == {(None, "posted"), (sinks[0]["id"], "failed")}
+    assert history["next"] is None
+
+    assert client.delete(f"/sinks/{sinks[0]['id']}").status_code == 200
+    assert client.delete(f"/sinks/{sinks[0]['id']}").status_code == 404
+
+
+@patch("app.bot.get_twitter_client")
+def test_scheduled_post_is_posted_when_due(get_twitter_client, client: TestClient):
+    post_data = {
+        "text": "Scheduled post",
+        "user_name": settings.default_user,
+        "post_trigger": PostScheduleTime.on_scheduled,
+        "post_time": (
+            datetime.datetime.now() + datetime.timedelta(seconds=0.5)
+        ).isoformat(),
+    }
+    response = client.post("/posts", json=post_data)
+    assert response.status_code == 200
+    post_id = response.json()["id"]
+    get_twitter_client.return_value.create_tweet.assert_not_called()
+
+    # marked posted only once the tweet is sent
+    deadline = time.monotonic() + 5
+    while True:
+        with Session(engine) as session:
+            post = session.get(PostText, post_id)
+        if post.status == ScheduledPostStatus.posted:
+            break
+        assert time.monotonic() < deadline, "scheduled post was not sent"
+        time.sleep(0.05)
+
+    get_twitter_client.return_value.create_tweet.assert_called_once_with(
+        text="Scheduled post"
+    )
+    assert post.posted_at is not None
+    assert post.attempts == 1
+
+
+def test_metrics(client: TestClient):
+    with Session(engine) as session:
+        session.add(
+            TwitterUser(
+                user="expiring",
+                access_token="token",
+                access_token_secret="secret",
+                hub_topic="expiring_topic",
+                lease_date=datetime.datetime.now() + datetime.timedelta(hours=1),
+            )
+        )
+        session.commit()
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert 'hexbot_leases_expiring{window="1d"} 1' in lines
+    assert 'hexbot_outbox_items{status="pending"} 0' in lines
+    assert "# TYPE hexbot_tweet_seconds histogram" in lines
+
+
+def test_bulk_posts(client: TestClient):
+    client.post(
+        "/posts",
+        json={
+            "text": "Old text {link}",
+            "user_name": "bulk_a",
+            "post_trigger": PostScheduleTime.on_new_video,
+        },
+    )
+    posts = [
+        {
+            "text": "New text {title}",
+            "user_name": "bulk_a",
+            "post_trigger": PostScheduleTime.on_new_video,
+        },
+        {
+            "text": "Hello {link}",
+            "user_name": "bulk_b",
+            "post_trigger": PostScheduleTime.on_new_video,
+        },
+        {
+            "text": "Broken {views}",
+            "user_name": "bulk_c",
+            "post_trigger": PostScheduleTime.on_new_video,
+        },
+        {
+            "text": "Later",
+            "user_name": "bulk_b",
+            "post_trigger": PostScheduleTime.on_scheduled,
+        },
+        {
+            "text": "Scheduled in bulk",
+            "user_name": settings.default_user,
+            "post_trigger": PostScheduleTime.on_scheduled,
+            "post_time": (
+                datetime.datetime.now() + datetime.timedelta(seconds=0.5)
+            ).isoformat(),
+        },
+    ]
+    with patch("app.bot.get_twitter_client") as get_twitter_client:
+        response = client.post("/posts/bulk", json=posts)
+        assert response.status_code == 200
+        results = response.json()
+        assert results[0]["post"]["text"] == "New text {title}"
+        assert results[1]["post"]["user"] == "bulk_b"
+        assert "views" in results[2]["error"]
+        assert results[3] == {"error": "post_time required for scheduled posts"}
+
+        scheduled_id = results[4]["post"]["id"]
+        deadline = time.monotonic() + 5
+        while True:
+            with Session(engine) as session:
+                post = session.get(PostText, scheduled_id)
+            if post.status == ScheduledPostStatus.posted:
+                break
+            assert time.monotonic() < deadline, "bulk scheduled post was not sent"
+            time.sleep(0.05)
+        get_twitter_client.return_value.create_tweet.assert_called_once_with(
+            text="Scheduled in bulk"
+        )
+
+    with Session(engine) as session:
+        texts = session.exec(
+            select(PostText.text).where(PostText.user == "bulk_a")
+        ).all()
+    assert texts == ["New text {title}"]
+
+    response = client.post(
+        "/posts/render",
+        json={"user_names": ["bulk_a", "bulk_b", "bulk_c"], "title": "T", "link": "L"},
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {"user_name": "bulk_a", "text": "New text T"},
+        {"user_name": "bulk_b", "text": "Hello L"},
+        {"user_name": "bulk_c", "error": "No post found"},
+    ]
+
+
+def signed_headers(content: str, topic: str, secret: str = None) -> dict:
+    secret = secret or topic_secret(topic)
+    digest = hmac.new(secret.encode(), content.encode(), hashlib.sha1).hexdigest()
+    return {
+        "content-type": "application/atom+xml",
+        "link": f"<https://pubsubhubbub.appspot.com>; rel=hub, <{topic}>; rel=self",
+        "x-hub-signature": f"sha1={digest}",
+    }
+
+
+@patch("app.main.enqueue_youtube_posts_async")
+def test_youtube_hook_verifies_signature(enqueue, client: TestClient):
+    topic = "https://www.youtube.com/xml/feeds/videos.xml?channel_id=CHANNEL_ID"
+    content = xml_data.format(
+        published_date=(
+            datetime.datetime.utcnow() - datetime.timedelta(minutes=2)
+        ).isoformat()
+    ).replace("VIDEO_ID", "SIGNED_VIDEO_ID")
+
+    headers = signed_headers(content, topic, secret="forged")
+    response = client.post("/youtube/hook", content=content, headers=headers)
+    assert response.status_code == 403
+    enqueue.assert_not_called()
+
+    headers["x-hub-signature"] = "sha1=\xe9\xe9".encode("latin-1")
+    response = client.post("/youtube/hook", content=content, headers=headers)
+    assert response.status_code == 403
+    enqueue.assert_not_called()
+
+    headers = signed_headers(content, topic)
+    response = client.post("/youtube/hook", content=content, headers=headers)
+    assert response.status_code == 200
+    enqueue.assert_called_once()
+
+    # a re-delivery is answered without being queued again
+    response = client.post("/youtube/hook", content=content, headers=headers)
+    assert response.status_code == 200
+    enqueue.assert_called_once()
+
+    # a body that isn't an Atom feed is rejected while it is read
+    response = client.post(
+        "/youtube/hook",
+        content="<html>" + "x" * 100_000,
+        headers=signed_headers("<html>", topic),
+    )
+    assert response.status_code == 400
+
+
+@patch("app.config.settings.hub_require_signature", True)
+def test_youtube_hook_requires_signature(client: TestClient):
+    response = client.post(
+        "/youtube/hook",
+        content=xml_data.format(published_date="2024-01-01T00:00:00"),
+        headers={"content-type": "application/atom+xml"},
+    )
+    assert response.status_code == 403
+
+
+def test_admin_profile(client: TestClient):
+    assert client.get("/admin/profile").status_code == 404
+    with patch("app.config.settings.profile_token", "profile-secret"):
+        response = client.get("/admin/profile", headers={"X-Profile-Token": "wrong"})
+        assert response.status_code == 403
+
+        with patch("app.config.settings.profile_sample_rate", 1):
+            assert client.get("/").status_code == 200
+        headers = {"X-Profile-Token": "profile-secret"}
+        response = client.get("/admin/profile", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        response = client.get(
+            "/admin/profile", params={"format": "pstats"}, headers=headers
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/octet-stream"
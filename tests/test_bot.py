@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+from unittest.mock import MagicMock
+
+import requests
+
+from app import bot
+from app.config import settings
+from app.db import TwitterUser
+
+
+def test_create_tweet_does_not_block_event_loop():
+    api = MagicMock()
+    threads = []
+
+    def slow_create_tweet(text):
+        threads.append(threading.current_thread().name)
+        time.sleep(0.2)
+        return text
+
+    api.create_tweet.side_effect = slow_create_tweet
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        response = await bot.create_tweet(api, "hello")
+        task.cancel()
+        return response, ticks
+
+    response, ticks = asyncio.run(run())
+    assert response == "hello"
+    assert threads[0].startswith("tweet")
+    # the loop kept running while the tweet was in flight
+    assert ticks > 5
+
+
+def test_twitter_client_is_reused_until_credentials_change():
+    user = TwitterUser(user="client_user", access_token="a", access_token_secret="b")
+
+    api = bot.get_twitter_client(settings, user)
+    assert bot.get_twitter_client(settings, user) is api
+
+    user.access_token = "renewed"
+    renewed = bot.get_twitter_client(settings, user)
+    assert renewed is not api
+    assert renewed.access_token == "renewed"
+
+    bot.close_twitter_clients()
+    assert bot.get_twitter_client(settings, user) is not renewed
+    bot.close_twitter_clients()
+
+
+def test_tweet_id():
+    response = requests.models.Response()
+    response._content = b'{"data": {"id": "1234", "text": "hello"}}'
+    assert bot.tweet_id(response) == "1234"
+    response._content = b"not json"
+    assert bot.tweet_id(response) is None
+    assert bot.tweet_id(MagicMock()) is None
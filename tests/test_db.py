@@ -0,0 +1,294 @@
+import asyncio
+import datetime
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import event, text
+from sqlmodel import Session, SQLModel, func, select, update
+
+from app.config import settings
+from app.db import (
+    PostText,
+    ScheduledPostStatus,
+    TwitterUser,
+    YoutubeOutbox,
+    YoutubeUpload,
+    SinkKind,
+    acquire_leadership,
+    async_connection_string,
+    async_session,
+    claim_posts,
+    claim_scheduled_posts,
+    complete_scheduled_post,
+    create_scheduled_post,
+    create_sink,
+    create_update_user,
+    engine,
+    engine_options,
+    enqueue_youtube_posts,
+    get_pending_scheduled_posts,
+    get_topic_leases,
+    get_upload_history,
+    get_user,
+    get_user_async,
+    init_db,
+    posted_links,
+    prune_uploads,
+    release_leadership,
+    retry_scheduled_post,
+    update_topic_lease,
+    update_lease_async,
+)
+
+
+@pytest.fixture
+def tables():
+    SQLModel.metadata.create_all(engine)
+    yield
+    SQLModel.metadata.drop_all(engine)
+
+
+def test_async_connection_string():
+    assert (
+        async_connection_string("sqlite:///./db.sqlite3")
+        == "sqlite+aiosqlite:///./db.sqlite3"
+    )
+    assert (
+        async_connection_string("postgresql://hex:secret@db:5432/hex")
+        == "postgresql+asyncpg://hex:secret@db:5432/hex"
+    )
+    assert (
+        async_connection_string("postgresql+psycopg2://hex@db/hex")
+        == "postgresql+asyncpg://hex@db/hex"
+    )
+
+
+@patch("app.config.settings.db_pool_size", 7)
+@patch("app.config.settings.db_statement_cache_size", 0)
+def test_engine_options():
+    assert "pool_size" not in engine_options("sqlite:///./db.sqlite3")
+    options = engine_options("postgresql://hex@db/hex")
+    assert options["pool_size"] == 7
+    assert "connect_args" not in options
+    options = engine_options("postgresql://hex@db/hex", is_async=True)
+    assert options["connect_args"] == {"statement_cache_size": 0}
+
+
+def test_sqlite_pragmas():
+    with engine.connect() as connection:
+        journal_mode = connection.execute(text("PRAGMA journal_mode")).scalar()
+        busy_timeout = connection.execute(text("PRAGMA busy_timeout")).scalar()
+    assert journal_mode == settings.sqlite_journal_mode.lower()
+    assert busy_timeout == settings.sqlite_busy_timeout_ms
+
+
+def test_async_helpers_unknown_user(tables):
+    async def run():
+        async with async_session() as session:
+            await update_lease_async(session, "nobody", 60, "topic")
+            return await get_user_async(session, "nobody")
+
+    assert asyncio.run(run()) is None
+
+
+def test_init_db_seeds_once():
+    init_db()
+    # a restart finds the schema and the seed rows in place
+    init_db()
+
+    with Session(engine) as session:
+        users = session.exec(
+            select(func.count()).where(TwitterUser.user == settings.default_user)
+        ).one()
+        posts = session.exec(
+            select(func.count()).where(PostText.user == settings.default_user)
+        ).one()
+    assert (users, posts) == (1, 1)
+    SQLModel.metadata.drop_all(engine)
+
+
+def test_leader_lease(tables):
+    with Session(engine) as session:
+        assert acquire_leadership(session, "jobs", "a", 60)
+        # held by a until it expires or is released
+        assert not acquire_leadership(session, "jobs", "b", 60)
+        assert acquire_leadership(session, "jobs", "a", 60)
+
+        release_leadership(session, "jobs", "a")
+        assert acquire_leadership(session, "jobs", "b", 0)
+        # b did not renew in time
+        assert acquire_leadership(session, "jobs", "a", 60)
+
+
+def test_get_user_is_cached_until_updated(tables):
+    with Session(engine) as session:
+        create_update_user(session, "cached_user", "token", "secret")
+        user = get_user(session, "cached_user")
+        assert user.access_token == "token"
+    with patch.object(Session, "exec") as exec:
+        assert get_user(Session(engine), "cached_user") is user
+        exec.assert_not_called()
+
+    with Session(engine) as session:
+        create_update_user(session, "cached_user", "new_token", "new_secret")
+        assert get_user(session, "cached_user").access_token == "new_token"
+
+
+def test_claim_posts(tables):
+    with Session(engine) as session:
+        assert claim_posts(session, ["a", "b", "a"], ["u"]) == [("a", "u"), ("b", "u")]
+        assert claim_posts(session, ["b", "c"], ["u", "v"]) == [("c", "u"), ("c", "v")]
+        assert claim_posts(session, [], ["u"]) == []
+
+
+def test_upload_history_and_retention(tables):
+    old = datetime.datetime.now() - datetime.timedelta(days=60)
+    with Session(engine) as session:
+        claim_posts(session, [f"history_{n}" for n in range(5)], ["history_user"])
+        session.exec(
+            update(YoutubeUpload)
+            .where(YoutubeUpload.link.in_(["history_0", "history_1"]))
+            .values(posted_at=old)
+        )
+        session.commit()
+
+        first = get_upload_history(session, 2, "history_user")
+        assert [upload.link for upload in first] == ["history_4", "history_3"]
+        second = get_upload_history(session, 2, "history_user", before=first[-1].id)
+        assert [upload.link for upload in second] == ["history_2", "history_1"]
+
+        before = datetime.datetime.now() - datetime.timedelta(days=30)
+        assert prune_uploads(session, before, 1) == 1
+        assert prune_uploads(session, before, 10) == 1
+        assert prune_uploads(session, before, 10) == 0
+        history = get_upload_history(session, 10, "history_user")
+        assert [upload.link for upload in history] == [
+            "history_4",
+            "history_3",
+            "history_2",
+        ]
+
+
+def test_enqueue_takes_the_same_statements_for_any_number_of_entries(tables):
+    with Session(engine) as session:
+        for name in ("batch_a", "batch_b"):
+            session.add(TwitterUser(user=name, hub_topic="batch_topic"))
+        session.commit()
+
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    def enqueue(count_entries: int, prefix: str) -> int:
+        entries = [(f"title {n}", f"{prefix}_{n}") for n in range(count_entries)]
+        with Session(engine) as session:
+            return enqueue_youtube_posts(session, ["batch_topic"], entries)
+
+    posted_links.clear()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        assert enqueue(1, "single") == 2
+        single = len(statements)
+        statements.clear()
+        assert enqueue(20, "many") == 40
+        assert len(statements) == single
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    with Session(engine) as session:
+        users = session.exec(
+            select(YoutubeOutbox.user).where(YoutubeOutbox.link == "many_3")
+        ).all()
+    assert sorted(users) == ["batch_a", "batch_b"]
+
+
+def test_enqueue_keeps_twitter_unless_disabled(tables):
+    with Session(engine) as session:
+        for name in ("sinks_a", "sinks_b"):
+            session.add(TwitterUser(user=name, hub_topic="sinks_topic"))
+        session.commit()
+        discord = {
+            "kind": SinkKind.discord,
+            "url": "https://discord.com/api/webhooks/1/x",
+        }
+        a_discord = create_sink(session, "sinks_a", **discord).id
+        b_discord = create_sink(session, "sinks_b", **discord).id
+        create_sink(session, "sinks_b", SinkKind.twitter, enabled=False)
+
+        posted_links.clear()
+        entries = [("title", "sinks_link")]
+        assert enqueue_youtube_posts(session, ["sinks_topic"], entries) == 3
+        items = session.exec(
+            select(YoutubeOutbox.user, YoutubeOutbox.sink_id).where(
+                YoutubeOutbox.link == "sinks_link"
+            )
+        ).all()
+    assert sorted(items, key=str) == sorted(
+        [("sinks_a", None), ("sinks_a", a_discord), ("sinks_b", b_discord)],
+        key=str,
+    )
+
+
+def test_get_topic_leases_since(tables):
+    with Session(engine) as session:
+        for name, topic in (("since_a", "topic_a"), ("since_b", "topic_b")):
+            session.add(TwitterUser(user=name, hub_topic=topic))
+        session.commit()
+        update_topic_lease(session, "topic_a", 3600)
+        checked = datetime.datetime.now()
+        update_topic_lease(session, "topic_b", 7200)
+
+        assert {topic for topic, _ in get_topic_leases(session)} == {
+            "topic_a",
+            "topic_b",
+        }
+        assert [topic for topic, _ in get_topic_leases(session, checked)] == ["topic_b"]
+
+
+def test_scheduled_post_lease(tables):
+    now = datetime.datetime.now()
+    with Session(engine) as session:
+        post_id = create_scheduled_post(session, "text", "lease_user", now).id
+        failed_id = create_scheduled_post(session, "text", "lease_user", now).id
+
+        claimed = claim_scheduled_posts(session, [post_id, failed_id], 60)
+        assert [post.id for post in claimed] == [post_id, failed_id]
+        assert claimed[0].status == ScheduledPostStatus.processing
+        assert claimed[0].attempts == 1
+        assert claimed[0].posted_at is None
+        # locked by the first claim
+        assert claim_scheduled_posts(session, [post_id], 60) == []
+        assert [post_id for _, post_id in get_pending_scheduled_posts(session)] == [
+            post_id,
+            failed_id,
+        ]
+
+        retry_scheduled_post(session, failed_id, "rejected", None)
+        # the lock of a crashed process expires
+        session.execute(
+            update(PostText)
+            .where(PostText.id == post_id)
+            .values(locked_until=now - datetime.timedelta(seconds=1))
+        )
+        session.commit()
+        assert [
+            post.id for post in claim_scheduled_posts(session, [post_id, failed_id], 60)
+        ] == [post_id]
+
+        retry_scheduled_post(session, post_id, "timeout", 30)
+        assert claim_scheduled_posts(session, [post_id], 60) == []
+        [(retry_at, _)] = get_pending_scheduled_posts(session, [post_id])
+        assert retry_at > now + datetime.timedelta(seconds=29)
+
+        complete_scheduled_post(session, post_id)
+        assert get_pending_scheduled_posts(session) == []
+        session.expire_all()
+        post = session.get(PostText, post_id)
+        assert post.status == ScheduledPostStatus.posted
+        assert post.posted_at is not None
+        assert post.attempts == 2
+        assert post.last_error is None
+        failed = session.get(PostText, failed_id)
+        assert failed.status == ScheduledPostStatus.failed
+        assert failed.last_error == "rejected"
@@ -0,0 +1,64 @@
+import asyncio
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from app.feed import FeedError, FeedTooLarge, parse_feed
+
+entry_xml = """
+    <entry>
+        <title>Video {n}</title>
+        <link rel="alternate" href="http://www.youtube.com/watch?v={n}"/>
+        <published>2024-02-20T10:00:00+00:00</published>
+    </entry>
+"""
+
+
+def feed_xml(entries: int) -> str:
+    return (
+        '<feed xmlns="http://www.w3.org/2005/Atom"><title>feed</title>'
+        + "".join(entry_xml.format(n=n) for n in range(entries))
+        + "</feed>"
+    )
+
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk.encode() if isinstance(chunk, str) else chunk
+
+
+def parse(chunks, max_bytes=100_000, max_entries=10):
+    async def run():
+        return [e async for e in parse_feed(chunks, max_bytes, max_entries)]
+
+    return asyncio.run(run())
+
+
+def test_parse_feed_yields_entries_across_chunks():
+    body = feed_xml(3)
+    chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+    entries = parse(stream(*chunks))
+    assert [e.title for e in entries] == ["Video 0", "Video 1", "Video 2"]
+    assert entries[2].link == "http://www.youtube.com/watch?v=2"
+    assert entries[0].published.tzinfo is not None
+
+
+def test_parse_feed_rejects_non_atom_without_reading_body():
+    async def chunks():
+        yield b"<html><body>"
+        raise AssertionError("body should not be read further")
+
+    with pytest.raises(FeedError):
+        parse(chunks())
+
+
+def test_parse_feed_limits_size_and_entries():
+    with pytest.raises(FeedTooLarge):
+        parse(stream(feed_xml(3)), max_bytes=100)
+    with pytest.raises(FeedTooLarge):
+        parse(stream(feed_xml(3)), max_entries=2)
+
+
+def test_parse_feed_invalid_xml():
+    with pytest.raises(ET.ParseError):
+        parse(stream('<feed xmlns="http://www.w3.org/2005/Atom"><entry>'))
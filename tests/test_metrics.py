@@ -0,0 +1,64 @@
+import json
+import logging
+
+from app import metrics
+from app.logs import StructuredFormatter
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("test_seconds", "Test", buckets=(0.1, 1))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5, stage="a")
+
+    lines = histogram.render().splitlines()
+    assert lines[:2] == ["# HELP test_seconds Test", "# TYPE test_seconds histogram"]
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="a"} 5.55' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+    metrics.registry.remove(histogram)
+
+
+def test_histogram_time_records_changed_labels():
+    histogram = metrics.Histogram("test_timed_seconds", "Test")
+    try:
+        with histogram.time(result="ok") as labels:
+            raise ValueError()
+    except ValueError:
+        pass
+    with histogram.time(result="ok") as labels:
+        labels["result"] = "error"
+
+    assert histogram.values[(("result", "ok"),)][2] == 1
+    assert histogram.values[(("result", "error"),)][2] == 1
+    metrics.registry.remove(histogram)
+
+
+def test_counter_and_gauge():
+    counter = metrics.Counter("test_total", "Test")
+    gauge = metrics.Gauge("test_items", "Test")
+    counter.inc(outcome="received")
+    counter.inc(2, outcome="received")
+    gauge.set(3)
+    gauge.set(1)
+
+    assert 'test_total{outcome="received"} 3' in counter.render()
+    assert gauge.render().splitlines()[-1] == "test_items 1"
+    metrics.registry.remove(counter)
+    metrics.registry.remove(gauge)
+
+
+def test_structured_formatter_includes_extra():
+    record = logging.makeLogRecord(
+        {"name": "app.test", "levelname": "INFO", "msg": "Posted", "user": "bob"}
+    )
+
+    line = StructuredFormatter().format(record)
+    assert 'msg="Posted"' in line
+    assert 'user="bob"' in line
+
+    fields = json.loads(StructuredFormatter(as_json=True).format(record))
+    assert fields["user"] == "bob"
+    assert fields["level"] == "INFO"
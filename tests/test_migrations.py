@@ -0,0 +1,72 @@
+from sqlalchemy import create_engine, inspect, text
+
+from app import db  # registers the tables
+from app.migrations import MIGRATIONS, get_version, is_current, migrate
+
+# the schema of the first release, before any index existed
+old_schema = [
+    "CREATE TABLE twitteruser (id INTEGER PRIMARY KEY, user VARCHAR NOT NULL, "
+    "access_token VARCHAR, access_token_secret VARCHAR, lease_date DATETIME, "
+    "hub_topic VARCHAR)",
+    "CREATE TABLE posttext (id INTEGER PRIMARY KEY, text VARCHAR NOT NULL, "
+    "user VARCHAR NOT NULL, post_trigger VARCHAR(9), post_time DATETIME)",
+    "CREATE TABLE youtubeupload (id INTEGER PRIMARY KEY, link VARCHAR NOT NULL)",
+]
+
+
+def test_migrate_indexes_existing_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.sqlite3'}")
+    with engine.begin() as connection:
+        for statement in old_schema:
+            connection.execute(text(statement))
+        connection.execute(
+            text("INSERT INTO youtubeupload (link) VALUES ('a'), ('a'), ('b')")
+        )
+        connection.execute(
+            text(
+                "INSERT INTO posttext (text, user, post_time) "
+                "VALUES ('scheduled', 'u', '2024-01-01 00:00:00')"
+            )
+        )
+    db.SQLModel.metadata.create_all(engine)
+
+    assert migrate(engine) == len(MIGRATIONS)
+    # already applied migrations are skipped
+    assert migrate(engine) == len(MIGRATIONS)
+
+    inspector = inspect(engine)
+    indexes = {
+        index["name"]
+        for table in ("twitteruser", "posttext", "youtubeupload")
+        for index in inspector.get_indexes(table)
+    }
+    assert {
+        "ix_twitteruser_user",
+        "ix_twitteruser_hub_topic_lease_date",
+        "ix_twitteruser_lease_date",
+        "ix_posttext_user_post_trigger",
+        "ix_youtubeupload_link_user",
+        "ix_youtubeupload_posted_at",
+    } <= indexes
+    assert "ix_youtubeupload_link" not in indexes
+    with engine.connect() as connection:
+        assert get_version(connection) == len(MIGRATIONS)
+        links = connection.execute(
+            text("SELECT link FROM youtubeupload WHERE posted_at IS NOT NULL")
+        ).all()
+        posts = connection.execute(
+            text("SELECT status, attempts FROM posttext WHERE text = 'scheduled'")
+        ).all()
+    assert sorted(link for link, in links) == ["a", "b"]
+    assert posts == [("pending", 0)]
+
+
+def test_is_current(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'new.sqlite3'}")
+    assert not is_current(engine)
+
+    db.SQLModel.metadata.create_all(engine)
+    assert not is_current(engine)
+
+    migrate(engine)
+    assert is_current(engine)
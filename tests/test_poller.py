@@ -0,0 +1,87 @@
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, patch
+
+from aiohttp import web
+
+from app import poller
+
+FEED = """<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015"
+      xmlns="http://www.w3.org/2005/Atom">
+  <entry>
+    <yt:videoId>POLLED_VIDEO_ID</yt:videoId>
+    <yt:channelId>POLLED_CHANNEL_ID</yt:channelId>
+    <title>Polled video</title>
+    <link rel="alternate" href="http://www.youtube.com/watch?v=POLLED_VIDEO_ID"/>
+    <published>{published}</published>
+  </entry>
+  <entry>
+    <title>Old video</title>
+    <link rel="alternate" href="http://www.youtube.com/watch?v=OLD_VIDEO_ID"/>
+    <published>2015-03-06T21:40:57+00:00</published>
+  </entry>
+</feed>"""
+
+
+def feeds_app(requests: list) -> web.Application:
+    """A stand-in for the YouTube feeds, answering 304 to a matching ETag."""
+    published = datetime.datetime.now(datetime.UTC).isoformat()
+
+    async def feed(request: web.Request):
+        requests.append(request.headers.get("If-None-Match"))
+        if request.match_info["name"] == "broken":
+            return web.Response(status=500)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(
+            text=FEED.format(published=published),
+            content_type="application/atom+xml",
+            headers={"ETag": '"v1"'},
+        )
+
+    app = web.Application()
+    app.router.add_get("/feeds/{name}", feed)
+    return app
+
+
+@patch("app.poller.worker.notify")
+@patch("app.poller.enqueue_youtube_posts_async", new_callable=AsyncMock)
+def test_poll_feeds_skips_unchanged_feeds(enqueue, notify, http_server):
+    enqueue.return_value = 1
+    requests = []
+
+    async def run():
+        async with http_server(feeds_app(requests)) as url:
+            topics = [f"{url}/feeds/channel", f"{url}/feeds/broken"]
+            try:
+                first = await poller.poll_feeds(topics)
+                second = await poller.poll_feeds(topics)
+            finally:
+                await poller.close_poll_session()
+        return topics, first, second
+
+    poller.validators.clear()
+    topics, first, second = asyncio.run(run())
+
+    assert first == {"unchanged": 0, "changed": 1, "failed": 1, "queued": 1}
+    assert second == {"unchanged": 1, "changed": 0, "failed": 1, "queued": 0}
+    enqueue.assert_awaited_once()
+    queued_topics, entries = enqueue.await_args.args[1:]
+    assert topics[0] in queued_topics
+    assert (
+        "https://www.youtube.com/xml/feeds/videos.xml?channel_id=POLLED_CHANNEL_ID"
+        in queued_topics
+    )
+    # the old video is not posted
+    assert entries == [
+        ("Polled video", "http://www.youtube.com/watch?v=POLLED_VIDEO_ID")
+    ]
+    assert sorted(requests, key=str) == sorted([None, None, '"v1"', None], key=str)
+    notify.assert_called_once()
+
+
+def test_feed_url():
+    assert (
+        poller.feed_url("https://www.youtube.com/xml/feeds/videos.xml?channel_id=C")
+        == "https://www.youtube.com/feeds/videos.xml?channel_id=C"
+    )
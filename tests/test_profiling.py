@@ -0,0 +1,47 @@
+import asyncio
+import pstats
+import time
+from unittest.mock import patch
+
+from app import profiling
+
+
+def busy_handler():
+    deadline = time.monotonic() + 0.1
+    while time.monotonic() < deadline:
+        pass
+
+
+@patch("app.config.settings.profile_interval_ms", 1)
+def test_profile_samples_the_event_loop(tmp_path):
+    async def run():
+        with profiling.profile():
+            busy_handler()
+        # not sampled
+        with patch("app.config.settings.profile_sample_rate", 0):
+            with profiling.profile():
+                assert profiling.active == 0
+
+    profiling.reset()
+    with patch("app.config.settings.profile_sample_rate", 1):
+        asyncio.run(run())
+    profiling.stop_sampler()
+
+    # the innermost frame of each stack comes last
+    leaves = [
+        line.rsplit(" ", 1)[0].split(";")[-1]
+        for line in profiling.collapsed().splitlines()
+    ]
+    assert any(leaf.startswith("busy_handler ") for leaf in leaves)
+    path = tmp_path / "hexbot.pstats"
+    path.write_bytes(profiling.pstats_dump())
+    stats = pstats.Stats(str(path)).stats
+    ((calls, _, own, total, callers),) = [
+        entry for func, entry in stats.items() if func[2] == "busy_handler"
+    ]
+    assert calls > 10
+    assert total >= own > 0
+    assert any(caller[2] == "run" for caller in callers)
+
+    profiling.reset()
+    assert profiling.collapsed() == ""
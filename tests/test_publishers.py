@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from app import publishers, youtube
+from app.db import Sink, SinkKind, TwitterUser
+from app.ratelimit import RateLimited
+
+
+def webhook_app(messages: list) -> web.Application:
+    """A stand-in for Discord webhooks, answering by the webhook's name."""
+
+    async def webhook(request: web.Request):
+        name = request.match_info["name"]
+        if name == "limited":
+            return web.Response(status=429, headers={"Retry-After": "7"})
+        if name == "deleted":
+            return web.Response(status=404, text="Unknown Webhook")
+        messages.append(await request.json())
+        return web.Response(status=204)
+
+    app = web.Application()
+    app.router.add_post("/webhooks/{name}", webhook)
+    return app
+
+
+def test_publish_discord(http_server):
+    user = TwitterUser(user="discord_user")
+    messages = []
+
+    async def run():
+        async with http_server(webhook_app(messages)) as url:
+
+            def sink(name):
+                return Sink(
+                    user=user.user, kind=SinkKind.discord, url=f"{url}/webhooks/{name}"
+                )
+
+            try:
+                await publishers.publish(user, sink("ok"), "new video")
+                with pytest.raises(RateLimited) as limited:
+                    await publishers.publish(user, sink("limited"), "new video")
+                assert limited.value.retry_in == 7
+                with pytest.raises(publishers.SinkRejected):
+                    await publishers.publish(user, sink("deleted"), "new video")
+            finally:
+                await youtube.close_http_session()
+
+    asyncio.run(run())
+
+    assert messages == [{"content": "new video"}]
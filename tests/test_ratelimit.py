@@ -0,0 +1,66 @@
+import asyncio
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+import tweepy
+
+from app import bot, ratelimit
+from app.ratelimit import RateLimited, TokenBucket
+
+
+def test_token_bucket_refills_over_time():
+    bucket = TokenBucket(capacity=2, period=10)
+    now = bucket.updated
+    assert bucket.wait_time(now) == 0
+    bucket.take()
+    bucket.take()
+    assert bucket.wait_time(now) == pytest.approx(5)
+    assert bucket.wait_time(now + 5) == pytest.approx(0)
+
+
+def test_token_bucket_syncs_with_headers():
+    bucket = TokenBucket(capacity=100, period=900)
+    now = bucket.updated
+    bucket.sync(remaining=0, reset=time.time() + 60, now=now)
+    assert bucket.wait_time(now) == pytest.approx(60, abs=1)
+
+
+@patch("app.config.settings.twitter_max_wait_seconds", 1)
+def test_acquire_requeues_long_waits():
+    ratelimit.update_from_headers(
+        "limited_user",
+        {
+            "x-rate-limit-remaining": "0",
+            "x-rate-limit-reset": str(time.time() + 120),
+        },
+    )
+    with pytest.raises(RateLimited) as error:
+        asyncio.run(ratelimit.acquire("limited_user"))
+    assert error.value.retry_in >= 120 - 1
+    assert ratelimit.queue_depth() == 0
+    # other users are not affected
+    asyncio.run(ratelimit.acquire("other_user"))
+
+
+@patch("app.bot.get_twitter_client")
+def test_send_tweet_turns_429_into_rate_limited(get_twitter_client):
+    response = requests.Response()
+    response.status_code = 429
+    response.reason = "Too Many Requests"
+    response._content = b"{}"
+    response.headers.update(
+        {
+            "x-rate-limit-remaining": "0",
+            "x-rate-limit-reset": str(time.time() + 300),
+        }
+    )
+    get_twitter_client.return_value.create_tweet.side_effect = tweepy.TooManyRequests(
+        response
+    )
+    user = MagicMock(user="throttled_user")
+
+    with pytest.raises(RateLimited) as error:
+        asyncio.run(bot.send_tweet(MagicMock(), user, "hello"))
+    assert error.value.retry_in == pytest.approx(300, abs=2)
@@ -0,0 +1,20 @@
+import datetime
+from unittest.mock import patch
+
+from app import scheduled_posts
+
+
+@patch("app.config.settings.scheduled_posts_batch_size", 2)
+def test_pop_due_returns_due_posts_in_order():
+    now = datetime.datetime.now()
+    scheduled_posts.upcoming.clear()
+    for post_id, minutes in [(1, 5), (2, -1), (3, -3), (4, -2), (5, 60)]:
+        scheduled_posts.schedule_post(
+            post_id, now + datetime.timedelta(minutes=minutes)
+        )
+
+    assert scheduled_posts.pop_due(now) == [3, 4]
+    assert scheduled_posts.pop_due(now) == [2]
+    assert scheduled_posts.pop_due(now) == []
+    assert [post_id for _, post_id in sorted(scheduled_posts.upcoming)] == [1, 5]
+    scheduled_posts.upcoming.clear()
@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app import scheduler
+
+
+@patch("app.config.settings.lease_renew_margin_seconds", 3600)
+@patch("app.config.settings.lease_renew_jitter_seconds", 600)
+def test_renewal_time_is_spread_before_lease_expiry():
+    lease_date = datetime.datetime.now() + datetime.timedelta(days=5)
+    times = {scheduler.renewal_time(lease_date) for _ in range(20)}
+    assert len(times) > 1
+    for run_date in times:
+        assert lease_date - datetime.timedelta(seconds=4200) <= run_date
+        assert run_date <= lease_date - datetime.timedelta(seconds=3600)
+
+
+def test_short_lease_is_renewed_halfway():
+    now = datetime.datetime.now()
+    lease_date = now + datetime.timedelta(hours=2)
+    for _ in range(20):
+        run_date = scheduler.renewal_time(lease_date)
+        # not right away, as the default margin of a day or more would
+        assert now + datetime.timedelta(minutes=59) <= run_date
+        assert run_date <= lease_date - datetime.timedelta(minutes=59)
+    # an expired lease is renewed at once
+    assert scheduler.renewal_time(now) == now
+
+
+@patch("app.scheduler.resubscribe_all", new_callable=AsyncMock)
+@patch("app.scheduler.get_topic_leases_async")
+@patch("app.scheduler.scheduler")
+def test_check_subscriptions_schedules_leases(
+    mock_scheduler: MagicMock, get_topic_leases, resubscribe_all
+):
+    now = datetime.datetime.now()
+    get_topic_leases.return_value = [
+        ("expiring_topic", now - datetime.timedelta(minutes=1)),
+        ("short_topic", now + datetime.timedelta(hours=1)),
+        ("leased_topic", now + datetime.timedelta(days=5)),
+    ]
+    resubscribe_all.return_value = {"expiring_topic": None}
+    scheduler.scheduled_leases.clear()
+    scheduler.last_lease_check = None
+
+    asyncio.run(scheduler.check_subscriptions())
+    # the first check reads every lease
+    assert get_topic_leases.await_args.args[1] is None
+
+    resubscribe_all.assert_awaited_once_with(["expiring_topic"])
+    jobs = {
+        call.kwargs["id"]: call.kwargs["run_date"]
+        for call in mock_scheduler.add_job.call_args_list
+    }
+    assert jobs.keys() == {
+        "renew:expiring_topic",
+        "renew:short_topic",
+        "renew:leased_topic",
+    }
+    # the renewed topic is retried unless the hub verifies it first
+    assert jobs["renew:expiring_topic"] < now + datetime.timedelta(hours=2)
+    # a lease shorter than the margin is renewed halfway
+    assert jobs["renew:short_topic"] >= now + datetime.timedelta(minutes=29)
+    assert jobs["renew:leased_topic"] > now + datetime.timedelta(days=3)
+
+    # the next only those updated since, and leaves unchanged ones alone
+    mock_scheduler.add_job.reset_mock()
+    asyncio.run(scheduler.check_subscriptions())
+    mock_scheduler.add_job.assert_not_called()
+    since = get_topic_leases.await_args.args[1]
+    assert now - scheduler.LEASE_CHECK_OVERLAP <= since < now
+
+
+@patch("app.scheduler.acquire_leadership_async", new_callable=AsyncMock)
+@patch("app.scheduler.scheduler")
+def test_elect_leader_starts_and_stops_renewals(
+    mock_scheduler: MagicMock, acquire_leadership
+):
+    renewal = MagicMock(id="renew:topic")
+    mock_scheduler.get_jobs.return_value = [MagicMock(id="elect_leader"), renewal]
+
+    acquire_leadership.return_value = False
+    asyncio.run(scheduler.elect_leader())
+    assert not scheduler.is_leader
+    mock_scheduler.add_job.assert_not_called()
+
+    acquire_leadership.return_value = True
+    asyncio.run(scheduler.elect_leader())
+    assert scheduler.is_leader
+    jobs = {call.kwargs["id"] for call in mock_scheduler.add_job.call_args_list}
+    assert jobs == {"check_subscriptions", "poll_feeds", "prune_uploads"}
+
+    acquire_leadership.side_effect = Exception("database is down")
+    asyncio.run(scheduler.elect_leader())
+    assert not scheduler.is_leader
+    renewal.remove.assert_called_once()
+
+
+@patch("app.scheduler.scheduler")
+def test_only_the_leader_schedules_leases(mock_scheduler: MagicMock):
+    lease_date = datetime.datetime.now() + datetime.timedelta(days=5)
+    with patch("app.scheduler.is_leader", False):
+        scheduler.schedule_lease("topic", lease_date)
+    mock_scheduler.add_job.assert_not_called()
+
+    with patch("app.scheduler.is_leader", True):
+        scheduler.schedule_lease("topic", lease_date)
+    mock_scheduler.add_job.assert_called_once()
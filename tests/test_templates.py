@@ -0,0 +1,19 @@
+import pytest
+
+from app.templates import TemplateError, parse_template, render_template
+
+
+def test_render_template():
+    template = parse_template("New video {title}!\n{link} {{tag}} {title!r:>8}")
+    assert (
+        render_template(template, title="Hi", link="http://yt")
+        == "New video Hi!\nhttp://yt {tag}     'Hi'"
+    )
+
+
+@pytest.mark.parametrize(
+    "text", ["{name}", "{0}", "{}", "{title", "{title:{link}}", "{link:d}"]
+)
+def test_parse_template_rejects_invalid_text(text):
+    with pytest.raises(TemplateError):
+        parse_template(text)
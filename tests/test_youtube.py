@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import hmac
+from unittest.mock import patch
+
+import pytest
+
+from app import youtube
+from app.feed import FeedError, FeedTooLarge
+from app.youtube import read_delivery
+
+
+class FakeHubResponse:
+    def __init__(self, ok: bool):
+        self.ok = ok
+        self.status = 200 if ok else 500
+
+    async def text(self):
+        return "error"
+
+
+class FakeHubSession:
+    """Answers hub requests after a short delay, tracking how many overlap."""
+
+    def __init__(self, failing_topic: str):
+        self.failing_topic = failing_topic
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.topics = []
+
+    def post(self, url, data):
+        session = self
+
+        class Request:
+            async def __aenter__(self):
+                session.in_flight += 1
+                session.max_in_flight = max(session.max_in_flight, session.in_flight)
+                await asyncio.sleep(0.01)
+                session.topics.append(data["hub.topic"])
+                return FakeHubResponse(data["hub.topic"] != session.failing_topic)
+
+            async def __aexit__(self, *args):
+                session.in_flight -= 1
+
+        return Request()
+
+
+@patch("app.config.settings.hub_concurrency", 5)
+def test_resubscribe_all_renews_topics_concurrently():
+    topics = [f"topic_{n}" for n in range(20)]
+    session = FakeHubSession(failing_topic="topic_3")
+
+    results = asyncio.run(youtube.resubscribe_all(topics, session))
+
+    assert sorted(session.topics) == sorted(topics)
+    assert session.max_in_flight == 5
+    assert isinstance(results["topic_3"], Exception)
+    assert all(results[topic] is None for topic in topics if topic != "topic_3")
+
+
+def test_hub_requests_share_one_client():
+    async def run():
+        first = youtube.get_http_session()
+        assert youtube.get_http_session() is first
+        await youtube.close_http_session()
+        assert youtube.http_session is None
+
+    asyncio.run(run())
+
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+def test_read_delivery_hashes_and_parses_body():
+    feed = (
+        b'<feed xmlns="http://www.w3.org/2005/Atom"><entry><title>Video</title>'
+        b'<link href="https://youtu.be/v"/><published>2024-01-01T00:00:00+00:00'
+        b"</published></entry></feed>"
+    )
+    parts = [feed[:50], feed[50:]]
+    delivery = asyncio.run(read_delivery(chunks(*parts), 1000, 10, "secret"))
+
+    assert [entry.link for entry in delivery.entries] == ["https://youtu.be/v"]
+    assert delivery.digest == hashlib.sha256(feed).hexdigest()
+    assert delivery.signature == hmac.new(b"secret", feed, hashlib.sha1).hexdigest()
+    with pytest.raises(FeedTooLarge):
+        asyncio.run(read_delivery(chunks(*parts), 60, 10))
+
+
+def test_read_delivery_stops_at_a_foreign_root():
+    read = []
+
+    async def body():
+        for chunk in (b"<html>", b"x" * 1000, b"</html>"):
+            read.append(chunk)
+            yield chunk
+
+    with pytest.raises(FeedError):
+        asyncio.run(read_delivery(body(), 10_000, 10))
+    assert read == [b"<html>"]
+
+
+def test_self_topic():
+    link = "<https://pubsubhubbub.appspot.com>; rel=hub, <https://topic>; rel=self"
+    assert youtube.self_topic(link) == "https://topic"
+    assert youtube.self_topic('<https://topic>; rel="self"') == "https://topic"
+    assert youtube.self_topic(None) is None
+
+
+def test_subscriptions_have_their_own_secret():
+    session = FakeHubSession(failing_topic="")
+    session.data = []
+    post = session.post
+    session.post = lambda url, data: session.data.append(data) or post(url, data)
+
+    asyncio.run(youtube.resubscribe("topic_a", session))
+    asyncio.run(youtube.resubscribe("topic_b", session))
+
+    secrets = [data["hub.secret"] for data in session.data]
+    assert secrets == [youtube.topic_secret("topic_a"), youtube.topic_secret("topic_b")]
+    assert secrets[0] != secrets[1]